@@ -0,0 +1,299 @@
+"""
+offline benchmark for ec2_teleporter against moto
+
+every scenario builds a synthetic inventory, then runs the code under test twice, at a small and
+a large scale. it reports the AWS API calls made, wall time and peak memory. a scenario fails when
+its call count goes over its budget, and the budgets are written so that a new N+1 pattern trips them.
+
+    pip install -r requirements-dev.txt
+    python benchmark.py [--scale 10] [--only get_vpc] [--json results.json]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+# THE TELEPORTER ONLY KNOWS THE src AND dst PROFILES, POINT THEM AT FAKE CREDENTIALS BEFORE boto3 LOADS
+_workdir = tempfile.mkdtemp(prefix="ec2_teleporter_bench_")
+with open(os.path.join(_workdir,"credentials"),'w') as f:
+    f.write("[src]\naws_access_key_id = testing\naws_secret_access_key = testing\n")
+    f.write("[dst]\naws_access_key_id = testing\naws_secret_access_key = testing\n")
+os.environ["AWS_SHARED_CREDENTIALS_FILE"] = os.path.join(_workdir,"credentials")
+os.environ["AWS_CONFIG_FILE"] = os.devnull
+
+# EVERY SERVICE, service-quotas INCLUDED, HAS TO BE MOCKED OR PREFLIGHT REACHES REAL AWS
+from moto import mock_aws
+
+import ec2_teleporter as teleporter
+
+SRC_REGION = "us-east-1"
+DST_REGION = "us-west-2"
+
+def reset_teleporter():
+    # EVERY MOCK STARTS FROM AN EMPTY ACCOUNT SO NOTHING CACHED MAY SURVIVE BETWEEN RUNS
+    for cache in (teleporter._sessions,teleporter._clients,teleporter._account_ids,teleporter._pollers,teleporter._kms_catalogs,teleporter._network_inventories,teleporter._launch_templates):
+        cache.clear()
+    teleporter.telemetry.__init__()
+    teleporter.governor.__init__()
+    teleporter.configure_discovery_cache(enabled=False)
+    teleporter.configure_journal(tempfile.mkdtemp(dir=_workdir))
+    teleporter.POLL_MIN_DELAY = 0.01
+    teleporter.POLL_MAX_DELAY = 0.05
+
+def api_calls():
+    return {k: v["calls"] for k,v in teleporter.telemetry.summary()["api"].items()}
+
+def src():
+    return teleporter.get_session("src",SRC_REGION)
+
+def src_copy():
+    return teleporter.get_session("src",DST_REGION)
+
+def dst():
+    return teleporter.get_session("dst",DST_REGION)
+
+def base_image(session):
+    # MOTO'S FIRST AMAZON IMAGES ARE WINDOWS, AND PREFLIGHT REFUSES SNAPSHOT MODE AND PRESTAGING FOR THOSE
+    images = teleporter.get_client(session,'ec2').describe_images(Owners=["amazon"])["Images"]
+    return next(i["ImageId"] for i in images if i.get("Platform") != "windows")
+
+def make_network(session,vpcs,subnets_per_vpc=3,sgs_per_vpc=2,az=None):
+    client = teleporter.get_client(session,'ec2')
+    placement = {"AvailabilityZone": az} if az else {}
+    first = None
+    for v in range(vpcs):
+        vpc = client.create_vpc(CidrBlock=f"10.{v}.0.0/16",TagSpecifications=[{"ResourceType": "vpc","Tags": [{"Key": "Name","Value": f"vpc-{v}"}]}])["Vpc"]["VpcId"]
+        for s in range(subnets_per_vpc):
+            subnet = client.create_subnet(VpcId=vpc,CidrBlock=f"10.{v}.{s}.0/24",**placement)["Subnet"]["SubnetId"]
+        for g in range(sgs_per_vpc):
+            sg = client.create_security_group(GroupName=f"sg-{v}-{g}",Description="bench",VpcId=vpc)["GroupId"]
+        first = first or (vpc,subnet,sg)
+    return first
+
+def make_instances(session,count,volumes=1,kms=None):
+    client = teleporter.get_client(session,'ec2')
+    ebs = {"VolumeSize": 10}
+    if kms:
+        ebs.update(Encrypted=True,KmsKeyId=kms)
+    mappings = [{"DeviceName": f"/dev/sd{chr(ord('f') + i)}","Ebs": dict(ebs)} for i in range(volumes)]
+    instances = client.run_instances(ImageId=base_image(session),MinCount=count,MaxCount=count,InstanceType="m5.large",BlockDeviceMappings=mappings,
+        TagSpecifications=[{"ResourceType": "instance","Tags": [{"Key": "Name","Value": "bench"},{"Key": "team","Value": "migration"}]}])["Instances"]
+    return [i["InstanceId"] for i in instances]
+
+def make_keys(session,count):
+    client = teleporter.get_client(session,'kms')
+    keys = []
+    for i in range(count):
+        key = client.create_key()["KeyMetadata"]
+        client.create_alias(AliasName=f"alias/bench-{i}",TargetKeyId=key["KeyId"])
+        keys.append(key["Arn"])
+    return keys
+
+def make_profile(session):
+    teleporter.get_client(session,'iam').create_instance_profile(InstanceProfileName="bench")
+    return "bench"
+
+# EVERY SCENARIO: setup(scale) RETURNS THE CALLABLE THAT IS MEASURED, budget(scale) IS THE MOST
+# API CALLS THE MEASURED CALLABLE MAY MAKE
+
+def setup_get_vpc(scale):
+    make_network(dst(),scale)
+    return lambda: teleporter.get_vpc(dst())
+
+def setup_kms_catalog(scale):
+    make_keys(dst(),scale * 10)
+    return lambda: teleporter.get_kms_catalog(dst())
+
+def setup_describe_instance(scale):
+    key = make_keys(src(),1)[0]
+    instance_id = make_instances(src(),1,volumes=scale,kms=key)[0]
+    return lambda: teleporter.describe_instance(src(),dst(),instance_id)
+
+def setup_create_ami(scale):
+    instance_id = make_instances(src(),1,volumes=scale)[0]
+    teleporter.get_client(src(),'ec2').stop_instances(InstanceIds=[instance_id])
+    instance = teleporter.describe_instance(src(),dst(),instance_id)[0]
+    return lambda: teleporter.create_ami(src(),instance,reuse=True,poller=teleporter.get_poller(src()))
+
+def setup_copy_ami(scale):
+    instance_id = make_instances(src(),1,volumes=scale)[0]
+    ami = teleporter.get_client(src(),'ec2').create_image(InstanceId=instance_id,Name="bench")["ImageId"]
+    return lambda: teleporter.copy_ami(src_copy(),ami,SRC_REGION,DST_REGION,False,reuse=True,poller=teleporter.get_poller(src_copy()))
+
+def setup_deploy_instance(scale):
+    _,subnet,sg = make_network(dst(),1)
+    profile = make_profile(dst())
+    ami = base_image(dst())
+    tags = [{"Key": "Name","Value": "bench"}]
+    mappings = [{"DeviceName": f"/dev/sd{chr(ord('f') + i)}","Ebs": {"VolumeSize": 10,"DeleteOnTermination": True}} for i in range(scale)]
+    return lambda: teleporter.deploy_instance(dst(),ami,"m5.large",tags,mappings,subnet,sg,profile,None,"on demand")
+
+def teleport_specs(scale,**overrides):
+    _,subnet,sg = make_network(dst(),1)
+    profile = make_profile(dst())
+    return [{**teleporter.MANIFEST_DEFAULTS,"instance_id": i,"src_region": SRC_REGION,"dst_region": DST_REGION,"subnet": subnet,"security_group": sg,"profile": profile,"cleanup": True,**overrides}
+        for i in make_instances(src(),scale,volumes=VOLUMES)]
+
+def run_teleports(specs,phase="full"):
+    state = "prestaged" if phase == "prestage" else "teleported"
+    results = teleporter.run_batch(specs,phase=phase)
+    failed = [r for r in results if r["state"] != state]
+    if failed:
+        raise RuntimeError(f"{len(failed)} teleports failed: {failed[0]['error']}")
+
+def setup_teleport(scale):
+    specs = teleport_specs(scale)
+    return lambda: run_teleports(specs)
+
+def setup_teleport_snapshot(scale):
+    specs = teleport_specs(scale,mode="snapshot",seed=True)
+    return lambda: run_teleports(specs)
+
+def setup_prestage(scale):
+    specs = teleport_specs(scale)
+    return lambda: run_teleports(specs,phase="prestage")
+
+def setup_cutover(scale):
+    specs = teleport_specs(scale)
+    with redirect_stdout(io.StringIO()):
+        run_teleports(specs,phase="prestage")
+    return lambda: run_teleports(specs,phase="cutover")
+
+def setup_fanout(scale):
+    # scale TARGETS SPLIT OVER THE SOURCE REGION AND ONE OTHER, STILL ONE IMAGE COPY. MOTO DOESN'T
+    # OFFER EVERY TYPE IN EVERY AZ SO THE SUBNETS ARE PINNED
+    targets = []
+    for i,region in enumerate((SRC_REGION,DST_REGION)):
+        _,subnet,sg = make_network(teleporter.get_session("dst",region),1,az=f"{region}a")
+        targets += [{"dst_region": region,"subnet": subnet,"security_group": sg}] * len(range(i,scale,2))
+    profile = make_profile(dst())
+    spec = {**teleporter.MANIFEST_DEFAULTS,"instance_id": make_instances(src(),1,volumes=VOLUMES)[0],"src_region": SRC_REGION,"profile": profile,"cleanup": True,"targets": targets}
+    def run():
+        result = teleporter.run_batch([spec])[0]
+        if result["state"] != "teleported":
+            raise RuntimeError(f"fan-out failed: {result['error']}")
+    return run
+
+def setup_preflight(scale):
+    _,subnet,sg = make_network(dst(),1)
+    key = make_keys(src(),1)[0]
+    dst_key = make_keys(dst(),1)[0]
+    specs = [{**teleporter.MANIFEST_DEFAULTS,"instance_id": i,"src_region": SRC_REGION,"dst_region": DST_REGION,"subnet": subnet,"security_group": sg,"profile": "bench","kms": dst_key}
+        for i in make_instances(src(),scale,volumes=2,kms=key)]
+    return lambda: teleporter.preflight(specs)
+
+# THE CALLS EACH STEP OF A TELEPORT IS MEANT TO MAKE, THE PIPELINE BUDGETS ARE BUILT FROM THESE AND NOT
+# FROM WHAT A RUN HAPPENED TO MEASURE. A WAIT IS ONE POLL SINCE MOTO FINISHES EVERYTHING AT ONCE
+VOLUMES = 2
+# sts, INSTANCES, VOLUMES AND INSTANCE TYPES OF THE SOURCES
+PREFLIGHT_SOURCE = 4
+# sts, VPCS, SUBNETS, SECURITY GROUPS, OFFERINGS, INSTANCE TYPES, RUNNING INSTANCES AND THE vCPU QUOTA OF A DESTINATION
+PREFLIGHT_DESTINATION = 8
+PREFLIGHT = PREFLIGHT_SOURCE + PREFLIGHT_DESTINATION
+# ONE SHARED LAUNCH TEMPLATE, CREATED AND DELETED
+TEMPLATE = 2
+# THE INSTANCE, ITS VOLUMES AND ITS TAGS
+PREPARE = 3
+# STOP AND WAIT
+STOP = 2
+# LOOK FOR A REUSABLE IMAGE, CREATE, WAIT AND READ ITS MAPPINGS
+AMI = 4
+# LOOK FOR A REUSABLE COPY, COPY AND WAIT
+COPY_AMI = 3
+# COPY_AMI, THE SNAPSHOT SIZES AND THE COPY'S MAPPINGS
+COPY = COPY_AMI + 2
+# LOOK FOR A REUSABLE COPY, READ THE SOURCE IMAGE, COPY AND WAIT PER VOLUME, REGISTER AND READ ITS MAPPINGS
+COPY_BY_SNAPSHOTS = 2 + 2 * VOLUMES + 2
+# ONE CreateSnapshots, A WAIT PER SNAPSHOT, THEN COPY AND WAIT PER VOLUME
+SNAPSHOT_AND_COPY = 1 + VOLUMES + 2 * VOLUMES
+# THE DELTA SNAPSHOTS, THEN REGISTER, WAIT AND READ THE MAPPINGS
+DELTA = SNAPSHOT_AND_COPY + 3
+# RUN AND WAIT
+LAUNCH = 2
+
+def cleanup(images,snapshots):
+    return images + snapshots
+
+def fanout_budget(n):
+    # ONE IMAGE, COPIED INTO EVERY OTHER REGION AND ITS SNAPSHOT SIZES READ ONCE. EVERY REGION IS A DESTINATION
+    # WITH ITS OWN TEMPLATE, READS ITS COPY'S MAPPINGS AND CLEANS UP ITS IMAGE. A REGION'S TARGETS GO OUT IN
+    # ONE MULTI-COUNT LAUNCH, BUT MOTO ONLY STARTS MinCount INSTANCES, SO HERE EVERY TARGET HAS ITS OWN LAUNCH
+    regions = min(n,2)
+    region = PREFLIGHT_DESTINATION + TEMPLATE + 1 + cleanup(1,VOLUMES)
+    return PREFLIGHT_SOURCE + PREPARE + STOP + AMI + 1 + (regions - 1) * COPY_AMI + regions * region + n * LAUNCH
+
+SCENARIOS = [
+    # NAME, SETUP, BUDGET
+    ("get_vpc", setup_get_vpc, lambda n: 4),
+    ("kms_catalog", setup_kms_catalog, lambda n: n * 10 + 3),
+    ("describe_instance", setup_describe_instance, lambda n: 6),
+    ("create_ami", setup_create_ami, lambda n: 3),
+    ("copy_ami", setup_copy_ami, lambda n: 3),
+    ("deploy_instance", setup_deploy_instance, lambda n: 2),
+    ("preflight", setup_preflight, lambda n: 16),
+    ("teleport", setup_teleport, lambda n: PREFLIGHT + TEMPLATE + n * (PREPARE + STOP + AMI + COPY + LAUNCH + cleanup(2,2 * VOLUMES))),
+    # THE SEED AND THE IMAGE'S OWN SNAPSHOTS, EACH IN BOTH REGIONS, ARE ALL DELETED
+    ("teleport_snapshot", setup_teleport_snapshot, lambda n: PREFLIGHT + TEMPLATE + n * (PREPARE + SNAPSHOT_AND_COPY + STOP + AMI + COPY_BY_SNAPSHOTS + LAUNCH + cleanup(2,4 * VOLUMES))),
+    ("prestage", setup_prestage, lambda n: PREFLIGHT + n * (PREPARE + SNAPSHOT_AND_COPY)),
+    # ONLY THE REGISTERED IMAGE, BUT THE SEED AND DELTA SNAPSHOTS IN BOTH REGIONS
+    ("cutover", setup_cutover, lambda n: PREFLIGHT + TEMPLATE + n * (PREPARE + STOP + DELTA + LAUNCH + cleanup(1,4 * VOLUMES))),
+    ("fanout", setup_fanout, fanout_budget),
+]
+
+def run_scenario(setup,scale):
+    reset_teleporter()
+    with mock_aws():
+        measured = setup(scale)
+        before = api_calls()
+        tracemalloc.start()
+        started = time.perf_counter()
+        # THE TELEPORTER'S OWN TABLES WOULD BREAK UP THE BENCHMARK'S
+        with redirect_stdout(io.StringIO()):
+            measured()
+        wall = time.perf_counter() - started
+        _,peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        after = api_calls()
+    calls = {k: v - before.get(k,0) for k,v in after.items() if v - before.get(k,0)}
+    return {"scale": scale,"calls": sum(calls.values()),"operations": calls,"seconds": round(wall,3),"peak_mb": round(peak / 2 ** 20,2)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ec2_teleporter against moto")
+    parser.add_argument("--scale",type=int,default=10,help="size of the large run, the small run is always 1")
+    parser.add_argument("--only",action="append",choices=[s[0] for s in SCENARIOS],help="run just this scenario (repeatable)")
+    parser.add_argument("--json",help="write the results to this file")
+    args = parser.parse_args(argv)
+    teleporter.log = lambda obj: None
+    results = []
+    failures = []
+    print(f'{"scenario":<18} {"scale":>5} {"calls":>6} {"budget":>6} {"seconds":>8} {"peak MB":>8}')
+    for name,setup,budget in SCENARIOS:
+        if args.only and name not in args.only:
+            continue
+        for scale in (1,args.scale):
+            try:
+                result = run_scenario(setup,scale)
+            except Exception as e:
+                failures.append(f"{name} at scale {scale} raised {e!r}")
+                print(f"{name:<18} {scale:>5} {'error':>6}")
+                continue
+            result.update(scenario=name,budget=budget(scale))
+            results.append(result)
+            over = result["calls"] > result["budget"]
+            print(f'{name:<18} {scale:>5} {result["calls"]:>6} {result["budget"]:>6} {result["seconds"]:>8} {result["peak_mb"]:>8}' + ("  OVER BUDGET" if over else ""))
+            if over:
+                failures.append(f'{name} at scale {scale} made {result["calls"]} calls, budget is {result["budget"]}: {json.dumps(result["operations"])}')
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump(results,f,indent=2)
+    for failure in failures:
+        print(f"FAIL {failure}",file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
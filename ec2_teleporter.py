@@ -1,30 +1,61 @@
 
 import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import DeferredRefreshableCredentials
 import time
-from fabulous.color import bold, green, highlight_red
-from pyfiglet import Figlet
-from PyInquirer import style_from_dict, Token, prompt,Separator
-from PyInquirer import Validator, ValidationError
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, BoundedSemaphore, Condition, Thread
 import sys
+import os
+import random
+import re
+import hashlib
+import shlex
+import sqlite3
 from pprint import pformat
 from datetime import datetime
+from contextlib import contextmanager
 
 
-style = style_from_dict({
-    Token.Separator: '#cc5454',
-    Token.QuestionMark: '#673ab7 bold',
-    Token.Selected: '#cc5454',  # default
-    Token.Pointer: '#673ab7 bold',
-    Token.Instruction: '',  # default
-    Token.Answer: '#f44336 bold',
-    Token.Question: '',
-})
+# THE UI LIBRARIES ARE ONLY IMPORTED ONCE SOMETHING IS ACTUALLY ASKED OR RENDERED SO HEADLESS
+# RUNS FROM SCHEDULERS AND CI NEITHER PAY FOR THEM NOR NEED THEM INSTALLED
+HEADLESS = False
+_style = None
 
+def configure_headless(headless=True):
+    global HEADLESS
+    HEADLESS = headless
+
+def _prompt(questions):
+    global _style
+    if HEADLESS:
+        raise TeleportError(f'{questions[0]["message"].strip()} needs an answer but this is a headless run, put it in the plan')
+    from PyInquirer import style_from_dict, Token, prompt
+    if _style is None:
+        _style = style_from_dict({
+            Token.Separator: '#cc5454',
+            Token.QuestionMark: '#673ab7 bold',
+            Token.Selected: '#cc5454',  # default
+            Token.Pointer: '#673ab7 bold',
+            Token.Instruction: '',  # default
+            Token.Answer: '#f44336 bold',
+            Token.Question: '',
+        })
+    return prompt(questions, style=_style)
+
+_log_lock = Lock()
 
 def log(obj):
     now = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
     message = f">{now} -- {obj}"
-    print(bold(green(message)))
+    if sys.stdout.isatty():
+        from fabulous.color import bold, green
+        message = bold(green(message))
+    with _log_lock:
+        print(message)
 
 def confirm(string,eject=False):
     questions = [
@@ -35,93 +66,732 @@ def confirm(string,eject=False):
             "default": False
         }
     ]    
-    value = prompt(questions, style=style)["use"]
+    value = _prompt(questions)["use"]
     if not value and eject:
         log("Ejecting out of this situation...Goodbye.")
         sys.exit()
         return;
     return value
 
+class Telemetry:
+    """
+    per stage durations, per operation API call counts/latency/retries/throttles and snapshot
+    bytes copied. events stream to a JSON lines file, totals can be written as a prometheus textfile
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.sink = None
+        self.stages = {}
+        self.api = {}
+        self.bytes_copied = 0
+
+    def configure(self,path=None):
+        with self.lock:
+            self.sink = open(path,'a') if path else None
+
+    def emit(self,event):
+        if self.sink:
+            with self.lock:
+                self.sink.write(json.dumps({"ts": time.time(),**event},default=str) + "\n")
+                self.sink.flush()
+
+    @contextmanager
+    def stage(self,name,instance_id=None):
+        started = time.time()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            duration = time.time() - started
+            with self.lock:
+                totals = self.stages.setdefault(name,{"count": 0,"seconds": 0.0,"max": 0.0,"failed": 0})
+                totals["count"] += 1
+                totals["seconds"] += duration
+                totals["max"] = max(totals["max"],duration)
+                totals["failed"] += 1 if error else 0
+            self.emit({"type": "stage","stage": name,"instance_id": instance_id,"seconds": round(duration,3),"error": error})
+
+    def api_call(self,service,operation,seconds,retries,throttles,code):
+        with self.lock:
+            totals = self.api.setdefault((service,operation),{"calls": 0,"seconds": 0.0,"retries": 0,"throttles": 0,"errors": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["retries"] += retries
+            totals["throttles"] += throttles
+            totals["errors"] += 1 if code else 0
+
+    def add_bytes(self,count,instance_id=None):
+        with self.lock:
+            self.bytes_copied += count
+        self.emit({"type": "bytes","instance_id": instance_id,"bytes": count})
+
+    def instrument(self,client):
+        service = client.meta.service_model.service_name
+        def before(model,context,**kwargs):
+            context["telemetry_started"] = time.time()
+            context["telemetry_operation"] = model.name
+            context["telemetry_throttles"] = 0
+        def retry(response,request_dict,**kwargs):
+            # EVERY ATTEMPT, THE LAST ONE INCLUDED, GOES THROUGH needs-retry
+            context = request_dict.get("context",{})
+            if response and response[1].get("Error",{}).get("Code") in THROTTLE_CODES:
+                context["telemetry_throttles"] = context.get("telemetry_throttles",0) + 1
+        def after(model,parsed,context,**kwargs):
+            metadata = parsed.get("ResponseMetadata",{})
+            code = parsed.get("Error",{}).get("Code")
+            self.api_call(service,model.name,time.time() - context.get("telemetry_started",time.time()),metadata.get("RetryAttempts",0),context.get("telemetry_throttles",0),code)
+        def failed(context,exception,**kwargs):
+            # NO RESPONSE AT ALL, CONNECTION ERRORS AND TIMEOUTS THAT OUTLASTED THE RETRIES
+            retries = context.get("retries",{}).get("attempt",1) - 1
+            self.api_call(service,context.get("telemetry_operation","unknown"),time.time() - context.get("telemetry_started",time.time()),retries,context.get("telemetry_throttles",0),type(exception).__name__)
+        client.meta.events.register('before-call',before)
+        client.meta.events.register('needs-retry',retry)
+        client.meta.events.register('after-call',after)
+        client.meta.events.register('after-call-error',failed)
+
+    def summary(self):
+        with self.lock:
+            api = {f"{k[0]}.{k[1]}": dict(v) for k,v in sorted(self.api.items())}
+            return {"stages": {k: dict(v) for k,v in self.stages.items()},"api": api,"bytes_copied": self.bytes_copied}
+
+    def write_prometheus(self,path):
+        summary = self.summary()
+        lines = []
+        def metric(name,kind,help,samples):
+            lines.append(f"# HELP ec2_teleporter_{name} {help}")
+            lines.append(f"# TYPE ec2_teleporter_{name} {kind}")
+            for labels,value in samples:
+                label = ",".join(f'{k}="{v}"' for k,v in labels.items())
+                lines.append(f"ec2_teleporter_{name}{{{label}}} {value}" if label else f"ec2_teleporter_{name} {value}")
+        stages = summary["stages"].items()
+        metric("stage_seconds_total","counter","time spent in each teleport stage",[({"stage": k},round(v["seconds"],3)) for k,v in stages])
+        metric("stage_runs_total","counter","teleport stage runs",[({"stage": k},v["count"]) for k,v in stages])
+        metric("stage_failures_total","counter","teleport stage failures",[({"stage": k},v["failed"]) for k,v in stages])
+        api = [(dict(zip(("service","operation"),k.split(".",1))),v) for k,v in summary["api"].items()]
+        metric("api_calls_total","counter","AWS API calls",[(l,v["calls"]) for l,v in api])
+        metric("api_seconds_total","counter","AWS API call latency",[(l,round(v["seconds"],3)) for l,v in api])
+        metric("api_retries_total","counter","AWS API retries done by botocore",[(l,v["retries"]) for l,v in api])
+        metric("api_throttles_total","counter","AWS API attempts that were throttled",[(l,v["throttles"]) for l,v in api])
+        metric("api_errors_total","counter","AWS API calls that ended in an error",[(l,v["errors"]) for l,v in api])
+        metric("snapshot_bytes_copied_total","counter","snapshot data copied across regions",[({},summary["bytes_copied"])])
+        tmp = path + ".tmp"
+        with open(tmp,'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp,path)
+
+    def finish(self,prometheus=None):
+        if self.stages or self.api:
+            self.log_summary()
+        if prometheus:
+            self.write_prometheus(prometheus)
+        if self.sink:
+            self.sink.close()
+            self.sink = None
+
+    def log_summary(self):
+        summary = self.summary()
+        for name,v in summary["stages"].items():
+            log(f'stage {name}: {v["count"]} runs, mean {round(v["seconds"] / v["count"],1)}s, max {round(v["max"],1)}s')
+        calls = sum(v["calls"] for v in summary["api"].values())
+        throttles = sum(v["throttles"] for v in summary["api"].values())
+        retries = sum(v["retries"] for v in summary["api"].values())
+        log(f'{calls} API calls, {retries} retries, {throttles} throttled, {round(summary["bytes_copied"] / 2 ** 30,1)} GiB of snapshots copied')
+        self.emit({"type": "summary",**summary})
+
+telemetry = Telemetry()
+
+# REQUEST GOVERNOR, SEE Governor
+# (STEADY REQUESTS PER SECOND, BURST) PER (ACCOUNT, REGION, SERVICE, API CLASS), SEEDED FROM THE
+# PUBLISHED EC2 AND KMS REQUEST RATE LIMITS, EVERYTHING ELSE GETS GOVERNOR_DEFAULT_RATE
+GOVERNOR_RATES = {
+    ("ec2","describe"): (20,100),
+    ("ec2","mutate"): (5,200),
+    ("ec2","intensive"): (2,50),
+    ("kms","describe"): (100,200),
+    ("kms","mutate"): (50,50),
+}
+GOVERNOR_DEFAULT_RATE = (10,20)
+GOVERNOR_START_CONCURRENCY = 10
+# EC2 ACTIONS AWS METERS IN THEIR OWN, SLOWER BUCKETS
+INTENSIVE_OPERATIONS = ("RunInstances","StartInstances","StopInstances","TerminateInstances","CreateImage","CopyImage","RegisterImage","CreateSnapshot","CreateSnapshots","CopySnapshot")
+# CONCURRENT IN FLIGHT COPIES AWS ALLOWS PER ACCOUNT AND DESTINATION REGION
+GOVERNOR_QUOTAS = {"CopyImage": 50,"CopySnapshot": 20}
+QUOTA_CODES = ("ResourceLimitExceeded",)
+
+def api_class(operation):
+    if operation in INTENSIVE_OPERATIONS:
+        return "intensive"
+    if operation.startswith(("Describe","List","Get")):
+        return "describe"
+    return "mutate"
+
+class TokenBucket:
+    """
+    token bucket rate limit plus an AIMD concurrency limit: every clean call grows the limit
+    by 1/limit, every throttled attempt halves it and drains the bucket. a call holds one slot
+    and spends a token on each of its attempts
+    """
+    def __init__(self,rate,burst,limit):
+        self.cond = Condition()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.limit = limit
+        self.max_limit = limit
+        self.active = 0
+
+    def acquire(self,slot=True):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst,self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if (not slot or self.active < int(self.limit)) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1 if slot else 0
+                    return
+                # OUT OF TOKENS WAKES UP WHEN THE NEXT ONE IS DUE, OUT OF SLOTS WHEN A CALL RELEASES
+                self.cond.wait((1 - self.tokens) / self.rate if self.tokens < 1 else None)
+
+    def release(self,clean):
+        with self.cond:
+            self.active -= 1
+            if clean:
+                self.limit = min(self.max_limit,self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def throttled(self):
+        with self.cond:
+            self.limit = max(1,self.limit / 2)
+            self.tokens = min(self.tokens,0)
+
+class Quota:
+    """
+    slots for operations AWS caps by how many run at once, held until the work finishes.
+    the limit shrinks when AWS reports the quota is full and grows back one slot per success
+    """
+    def __init__(self,limit):
+        self.cond = Condition()
+        self.limit = limit
+        self.max_limit = limit
+        self.active = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def exceeded(self):
+        with self.cond:
+            self.limit = max(1,self.active - 1)
+
+    def succeeded(self):
+        with self.cond:
+            self.limit = min(self.max_limit,self.limit + 1)
+            self.cond.notify_all()
+
+class Governor:
+    """
+    paces every AWS call of every shared client so parallel teleports run at the highest rate
+    AWS sustains instead of failing on RequestLimitExceeded. calls wait in before-call for a
+    token and a concurrency slot of their (account, region, service, API class) bucket, and
+    every botocore retry waits for another token
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.enabled = True
+        self.buckets = {}
+        self.quotas = {}
+
+    def configure(self,enabled=True):
+        self.enabled = enabled
+
+    def bucket(self,account,region,service,operation):
+        cls = api_class(operation)
+        key = (account,region,service,cls)
+        with self.lock:
+            if key not in self.buckets:
+                rate,burst = GOVERNOR_RATES.get((service,cls),GOVERNOR_DEFAULT_RATE)
+                self.buckets[key] = TokenBucket(rate,burst,min(GOVERNOR_START_CONCURRENCY,CLIENT_POOL_SIZE))
+            return self.buckets[key]
+
+    def quota(self,account,region,operation):
+        key = (account,region,operation)
+        with self.lock:
+            if key not in self.quotas:
+                self.quotas[key] = Quota(GOVERNOR_QUOTAS[operation])
+            return self.quotas[key]
+
+    @contextmanager
+    def slot(self,session,region,operation):
+        """
+        hold one of the account's concurrent operation slots in region, e.g. while a copy runs
+        """
+        quota = self.quota(session_key(session),region or session.region_name,operation)
+        if self.enabled:
+            quota.acquire()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                quota.release()
+
+    def instrument(self,client,account):
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+        def before(model,context,**kwargs):
+            if self.enabled:
+                bucket = self.bucket(account,region,service,model.name)
+                bucket.acquire()
+                context["governor_bucket"] = bucket
+        def attempt(request,**kwargs):
+            # request-created FIRES FOR EVERY ATTEMPT, A RETRY AFTER A THROTTLE FINDS THE BUCKET DRAINED
+            # AND WAITS FOR IT TO REFILL ON TOP OF BOTOCORE'S BACKOFF
+            context = getattr(request,"context",{})
+            bucket = context.get("governor_bucket")
+            if bucket and context.get("retries",{}).get("attempt",1) > 1:
+                bucket.acquire(slot=False)
+        def retry(response,request_dict,**kwargs):
+            bucket = request_dict.get("context",{}).get("governor_bucket")
+            if bucket and response and response[1].get("Error",{}).get("Code") in THROTTLE_CODES:
+                bucket.throttled()
+                context = request_dict["context"]
+                context["governor_throttled"] = True
+        def after(model,context,parsed=None,**kwargs):
+            bucket = context.pop("governor_bucket",None)
+            if not bucket:
+                return
+            code = (parsed or {}).get("Error",{}).get("Code")
+            bucket.release(clean=parsed is not None and not context.get("governor_throttled"))
+            if model.name in GOVERNOR_QUOTAS:
+                quota = self.quota(account,region,model.name)
+                if code in QUOTA_CODES:
+                    quota.exceeded()
+                elif parsed is not None and not code:
+                    quota.succeeded()
+        def failed(context,**kwargs):
+            bucket = context.pop("governor_bucket",None)
+            if bucket:
+                bucket.release(clean=False)
+        client.meta.events.register('before-call',before)
+        # AHEAD OF THE SIGNER, SO THE SIGNATURE ISN'T AGED BY THE WAIT
+        client.meta.events.register_first('request-created',attempt)
+        client.meta.events.register('needs-retry',retry)
+        client.meta.events.register('after-call',after)
+        client.meta.events.register('after-call-error',failed)
+
+governor = Governor()
+
+# CLIENT REGISTRY, BOTOCORE LOADS THE SERVICE MODEL AND A NEW CONNECTION POOL FOR EVERY CLIENT
+# SO CLIENTS ARE BUILT ONCE PER (IDENTITY, REGION, SERVICE) AND SHARED, CLIENTS ARE THREAD SAFE.
+# AN IDENTITY IS A PROFILE, OR A ROLE ASSUMED FROM A PROFILE
+CLIENT_POOL_SIZE = 50
+ROLE_SESSION_NAME = "ec2-teleporter"
+DEFAULT_ROLE_NAME = "OrganizationAccountAccessRole"
+_registry_lock = Lock()
+_sessions = {}
+_clients = {}
+_account_ids = {}
+_role_credentials = {}
+
+def configure_clients(pool_size):
+    global CLIENT_POOL_SIZE
+    CLIENT_POOL_SIZE = pool_size
+
+def session_key(session):
+    return getattr(session,"teleport_key",None) or session.profile_name
+
+def role_arn(role,role_name=DEFAULT_ROLE_NAME):
+    # A BARE ACCOUNT ID MEANS THE ACCOUNT'S role_name ROLE
+    return role if role.startswith("arn:") else f"arn:aws:iam::{role}:role/{role_name}"
+
+def role_credentials(profile,role,external_id=None):
+    """
+    credentials of role assumed from profile. botocore refreshes them before they expire, and
+    every session and thread that uses the role shares them, so the role is assumed once per expiry
+    """
+    def refresh():
+        args = {"RoleArn": role,"RoleSessionName": ROLE_SESSION_NAME}
+        if external_id:
+            args["ExternalId"] = external_id
+        credentials = get_client(get_session(profile),'sts').assume_role(**args)["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+    # DEFERRED SO NOTHING IS ASSUMED UNTIL THE FIRST CALL IS SIGNED
+    return DeferredRefreshableCredentials(refresh_using=refresh,method="assume-role")
+
+def get_session(profile,region=None,role=None,external_id=None):
+    with _registry_lock:
+        key = (profile,region,role,external_id)
+        if key not in _sessions:
+            if role:
+                if (profile,role,external_id) not in _role_credentials:
+                    _role_credentials[(profile,role,external_id)] = role_credentials(profile,role,external_id)
+                core = botocore.session.Session()
+                core._credentials = _role_credentials[(profile,role,external_id)]
+                session = boto3.Session(botocore_session=core,region_name=region)
+                # EVERY CACHE KEYED ON session_key (CLIENTS, POLLERS, THE GOVERNOR, GRANTS) SEES ONE IDENTITY
+                session.teleport_key = f"{role}@{profile}" + (f"#{external_id}" if external_id else "")
+            else:
+                session = boto3.Session(profile_name=profile,region_name=region)
+            session.teleport_identity = (profile,role,external_id)
+            _sessions[key] = session
+        return _sessions[key]
+
+def region_session(session,region):
+    """
+    a session with the same identity as session in another region
+    """
+    profile,role,external_id = session.teleport_identity
+    return get_session(profile,region,role,external_id)
+
+def get_client(session,service,region_name=None):
+    region = region_name or session.region_name
+    key = (session_key(session),region,service)
+    client = _clients.get(key)
+    if client:
+        return client
+    # SESSIONS AREN'T THREAD SAFE SO CLIENT CONSTRUCTION IS SERIALIZED
+    with _registry_lock:
+        if key not in _clients:
+            # STANDARD RETRIES BACK OFF ON EVERY THROTTLE CODE, THE GOVERNOR TAKES A TOKEN FOR EVERY ATTEMPT
+            config = Config(max_pool_connections=CLIENT_POOL_SIZE,retries={"mode": "standard","max_attempts": 10})
+            client = session.client(service,region_name=region,config=config)
+            # REGISTERED FIRST SO TELEMETRY LATENCY DOESN'T INCLUDE THE TIME SPENT WAITING ON THE GOVERNOR
+            governor.instrument(client,key[0])
+            telemetry.instrument(client)
+            _clients[key] = client
+        return _clients[key]
+
 def get_account_id(profile):
-     return profile.client('sts').get_caller_identity()["Account"]
+    key = session_key(profile)
+    if key not in _account_ids:
+        role = getattr(profile,"teleport_identity",(None,None))[1]
+        # A ROLE ARN ALREADY NAMES ITS ACCOUNT, NO STS CALL NEEDED
+        _account_ids[key] = role.split(":")[4] if role else get_client(profile,'sts').get_caller_identity()["Account"]
+    return _account_ids[key]
 
 def exit_with_error(msg):
     print(msg) 
-    sys.exit()
+    sys.exit(1)
 
-def revoke_grants(session,grants):
-    log("Revoking Grants to any KMS keys used.")
-    for grant in grants:
-        key,grant_id = grant
-        client = session.client('kms')
-        client.revoke_grant(KeyId=key,GrantId=grant_id)
+class TeleportError(Exception):
+    """
+    raised by the teleport steps so batch runs can record the failure instead of exiting
+    """
 
 def grant_kms(session,key,account):
-    return session.client('kms').create_grant(
+    return get_client(session,'kms').create_grant(
         KeyId=key,
         GranteePrincipal=f"arn:aws:iam::{account}:root",
         Operations=['Decrypt','Encrypt','GenerateDataKey','GenerateDataKeyWithoutPlaintext','ReEncryptFrom','ReEncryptTo','Sign','Verify','CreateGrant','RetireGrant','DescribeKey','GenerateDataKeyPair','GenerateDataKeyPairWithoutPlaintext']
     )["GrantId"]
 
+class GrantManager:
+    """
+    one KMS grant per (identity, region, key, grantee account), shared by every concurrent teleport
+    that needs it. acquire() creates the grant for its first user, release() revokes it once the
+    last user lets go
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.grants = {}
+
+    def acquire(self,session,key,account,user):
+        grant_key = (session_key(session),session.region_name,key,account)
+        with self.lock:
+            entry = self.grants.setdefault(grant_key,{"lock": Lock(),"grant_id": None,"key": key,"session": session,"users": set()})
+            entry["users"].add(user)
+        # CONCURRENT USERS OF A NEW GRANT WAIT FOR THE FIRST ONE TO CREATE IT
+        with entry["lock"]:
+            if not entry["grant_id"]:
+                try:
+                    entry["grant_id"] = grant_kms(session,key,account)
+                except Exception:
+                    self.release(user,[grant_key])
+                    raise
+        return entry["grant_id"]
+
+    def release(self,user,grant_keys=None):
+        """
+        drop user from its grants, revoking the ones nobody else holds. returns {grant_id: released}
+        for every grant user held, released is False when the revoke failed
+        """
+        revoke = []
+        held = {}
+        with self.lock:
+            for grant_key in list(grant_keys or self.grants):
+                entry = self.grants.get(grant_key)
+                if not entry or user not in entry["users"]:
+                    continue
+                entry["users"].discard(user)
+                held[entry["grant_id"]] = True
+                if not entry["users"]:
+                    del self.grants[grant_key]
+                    revoke.append(entry)
+        for entry in revoke:
+            if not entry["grant_id"]:
+                continue
+            try:
+                log(f'Revoking grant {entry["grant_id"]} on {entry["key"]}')
+                get_client(entry["session"],'kms').revoke_grant(KeyId=entry["key"],GrantId=entry["grant_id"])
+            except Exception as e:
+                if "NotFound" not in str(e):
+                    log(f'unable to revoke grant {entry["grant_id"]}: {e}')
+                    held[entry["grant_id"]] = False
+        return held
+
+grant_manager = GrantManager()
+
 def describe_instance(session,dst_session, id):
     try:
         log(f"getting information for {id}")
         grant_ids = []
-        instance =  session.client('ec2').describe_instances(InstanceIds=[id])["Reservations"][0]["Instances"][0]
+        try:
+            instance =  get_client(session,'ec2').describe_instances(InstanceIds=[id])["Reservations"][0]["Instances"][0]
+        except Exception as e:
+            raise TeleportError(f"Couldn't find {id}: {e}")
         # DECIDE IF ENCRYPTED AND WHETHER KMS IS AWS MANAGED
-        instance["Volumes"] = session.client('ec2').describe_volumes(VolumeIds=[b["Ebs"]["VolumeId"] for b in instance["BlockDeviceMappings"]])["Volumes"]        
-        for vol in instance["Volumes"]:
+        # ONLY EBS MAPPINGS HAVE A VOLUME, AN EMPTY VolumeIds WOULD DESCRIBE EVERY VOLUME IN THE REGION
+        volume_ids = [b["Ebs"]["VolumeId"] for b in instance["BlockDeviceMappings"] if "Ebs" in b]
+        instance["Volumes"] = get_client(session,'ec2').describe_volumes(VolumeIds=volume_ids)["Volumes"] if volume_ids else []
+        # VOLUMES USUALLY SHARE A KEY, EACH DISTINCT KEY IS CHECKED AND GRANTED ONCE
+        keys = sorted({vol["KmsKeyId"] for vol in instance["Volumes"] if "KmsKeyId" in vol})
+        for key in keys:
             # BREAK IF AWS MANAGED KMS KEY USED OR IF DST ACCOUNT DOES NOT HAVE ACCESS TO KMS KEY
-            keys = []
-            if "KmsKeyId" in vol:                
-                if session.client('kms').describe_key(KeyId=vol["KmsKeyId"])["KeyMetadata"]["KeyManager"] == "AWS":
-                    exit_with_error('Unable to teleport instance since it uses AWS Managed KMS for encryption')
-                keys.append(vol["KmsKeyId"])
-            keys = list(set(keys))            
-            if len(keys):
-                for key in keys:
-                    dst_account = get_account_id(dst_session)
-                    grant_id = grant_kms(session,key,dst_account)
-                    grant_ids.append((grant_id,key,session))
-        tags = map(lambda t: { "Key": t["Key"], "Value": t["Value"] } ,session.client('ec2').describe_tags(Filters=[{'Name': 'resource-id','Values': [id]}])["Tags"])
+            if get_client(session,'kms').describe_key(KeyId=key)["KeyMetadata"]["KeyManager"] == "AWS":
+                raise TeleportError(f'Unable to teleport {id} since it uses AWS Managed KMS for encryption')
+        # NO dst_session MEANS THE CALLER GRANTS THE KEYS ITSELF
+        if keys and dst_session:
+            dst_account = get_account_id(dst_session)
+            for key in keys:
+                grant_ids.append((grant_manager.acquire(session,key,dst_account,id),key,session))
+        tags = map(lambda t: { "Key": t["Key"], "Value": t["Value"] } ,get_client(session,'ec2').describe_tags(Filters=[{'Name': 'resource-id','Values': [id]}])["Tags"])
         instance["Tags"] = list(tags)
         encrypted = True if len(keys) else False
         return (instance,grant_ids,keys,encrypted)
-    except Exception as e:
-        print(e)
-        exit_with_error(f"Couldn't find {id}")
+    except Exception:
+        # DON'T LEAK GRANTS CREATED BEFORE THE FAILURE, THE CALLER HASN'T JOURNALED THEM YET
+        grant_manager.release(id)
+        raise
+
+# BATCHED STATE POLLING, SEE StatePoller
+POLL_MIN_DELAY = 5
+POLL_MAX_DELAY = 60
+POLL_TIMEOUT = 40 * 60
+THROTTLE_CODES = ("RequestLimitExceeded","Throttling","ThrottlingException","TooManyRequestsException")
+
+def error_code(e):
+    return getattr(e,"response",{}).get("Error",{}).get("Code")
+
+def with_retries(fn,attempts=8,base_delay=1,codes=THROTTLE_CODES):
+    """
+    call fn, backing off exponentially with jitter while AWS answers with one of codes
+    """
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if error_code(e) not in codes or attempt == attempts - 1:
+                raise
+            time.sleep(min(base_delay * 2 ** attempt,30) * random.uniform(0.5,1.5))
+
+def _describe_images(client,ids):
+    for image in client.describe_images(Filters=[{"Name": "image-id","Values": ids}])["Images"]:
+        yield image["ImageId"],image["State"],image
+
+def _describe_instances(client,ids):
+    pages = client.get_paginator('describe_instances').paginate(Filters=[{"Name": "instance-id","Values": ids}])
+    for page in pages:
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                yield instance["InstanceId"],instance["State"]["Name"],instance
+
+def _describe_snapshots(client,ids):
+    for snapshot in client.describe_snapshots(Filters=[{"Name": "snapshot-id","Values": ids}])["Snapshots"]:
+        yield snapshot["SnapshotId"],snapshot["State"],snapshot
+
+POLL_KINDS = {
+    # KIND: (DESCRIBE FUNC, BATCH SIZE, STATES THAT WILL NEVER REACH THE TARGET)
+    "image": (_describe_images,100,("failed","invalid","deregistered","error")),
+    "instance": (_describe_instances,100,("terminated",)),
+    "snapshot": (_describe_snapshots,100,("error",)),
+}
+
+class StatePoller:
+    """
+    one background thread per account/region that folds every pending image and instance
+    into a single describe call per kind each tick, instead of one waiter per resource
+    """
+    def __init__(self,session):
+        self.client = get_client(session,'ec2')
+        self.cond = Condition()
+        self.waiters = {}
+        self.thread = None
+        self.delay = POLL_MIN_DELAY
+
+    def wait(self,kind,resource_id,state,timeout=POLL_TIMEOUT,progress=None):
+        waiter = {"state": state,"deadline": time.time() + timeout,"done": False,"resource": None,"error": None,"progress": progress}
+        with self.cond:
+            self.waiters.setdefault((kind,resource_id),[]).append(waiter)
+            if not self.thread:
+                self.delay = POLL_MIN_DELAY
+                self.thread = Thread(target=self._loop,name=f"poller-{self.client.meta.region_name}",daemon=True)
+                self.thread.start()
+            while not waiter["done"]:
+                self.cond.wait()
+        if waiter["error"]:
+            raise TeleportError(waiter["error"])
+        return waiter["resource"]
+
+    def _loop(self):
+        seen = {}
+        while True:
+            with self.cond:
+                if not self.waiters:
+                    self.thread = None
+                    return
+                pending = {}
+                for kind,resource_id in self.waiters:
+                    pending.setdefault(kind,[]).append(resource_id)
+            changed = False
+            throttled = False
+            observed = {}
+            for kind,ids in pending.items():
+                describe,size,dead_states = POLL_KINDS[kind]
+                for i in range(0,len(ids),size):
+                    try:
+                        for resource_id,state,resource in describe(self.client,ids[i:i + size]):
+                            observed[(kind,resource_id)] = (state,resource)
+                    except Exception as e:
+                        if error_code(e) not in THROTTLE_CODES:
+                            log(f"state poll for {kind}s failed: {e}")
+                        throttled = True
+            now = time.time()
+            updates = []
+            with self.cond:
+                for key,waiters in list(self.waiters.items()):
+                    state,resource = observed.get(key,(None,None))
+                    if seen.get(key) != state:
+                        seen[key] = state
+                        changed = True
+                    dead_states = POLL_KINDS[key[0]][2]
+                    for waiter in list(waiters):
+                        if state == waiter["state"]:
+                            waiter["resource"] = resource
+                        elif state in dead_states:
+                            waiter["error"] = f"{key[1]} is {state}, it will never be {waiter['state']}"
+                        elif now > waiter["deadline"]:
+                            waiter["error"] = f"timed out waiting for {key[1]} to be {waiter['state']}, last state {state}"
+                        else:
+                            if waiter["progress"] and resource:
+                                updates.append((waiter["progress"],resource))
+                            continue
+                        waiter["done"] = True
+                        waiters.remove(waiter)
+                    if not waiters:
+                        del self.waiters[key]
+                        seen.pop(key,None)
+                self.cond.notify_all()
+            for progress,resource in updates:
+                progress(resource)
+            # ADAPTIVE BACKOFF: TIGHTEN WHILE THINGS ARE MOVING, RELAX WHILE IDLE OR THROTTLED
+            if throttled:
+                self.delay = min(self.delay * 2,POLL_MAX_DELAY)
+            elif changed:
+                self.delay = POLL_MIN_DELAY
+            else:
+                self.delay = min(self.delay * 1.5,POLL_MAX_DELAY)
+            time.sleep(self.delay)
+
+_pollers = {}
+_pollers_lock = Lock()
+
+def get_poller(session,region=None):
+    region = region or session.region_name
+    key = (session_key(session),region)
+    with _pollers_lock:
+        if key not in _pollers:
+            _pollers[key] = StatePoller(region_session(session,region))
+        return _pollers[key]
 
 def delete_ami(session,ami,existing):
-    session.client('ec2').deregister_image(ImageId=ami)
+    get_client(session,'ec2').deregister_image(ImageId=ami)
     for exist in existing:
-        snaps = [s["Ebs"]["SnapshotId"] for s in exist["BlockDeviceMappings"]]
+        snaps = [s["Ebs"]["SnapshotId"] for s in exist["BlockDeviceMappings"] if "Ebs" in s and "SnapshotId" in s["Ebs"]]
         for snap in snaps:
-            session.client('ec2').delete_snapshot(SnapshotId=snap)
+            get_client(session,'ec2').delete_snapshot(SnapshotId=snap)
 
-def create_ami(session,instance):
+def create_ami(session,instance,reuse=None,poller=None,on_create=None):
     instance_id = instance["InstanceId"]    
     name = f"TELEPORT-{instance_id}"
-    existing = session.client('ec2').describe_images(Filters=[{"Name": "name", "Values":[name]}])["Images"]
+    existing = get_client(session,'ec2').describe_images(Filters=[{"Name": "name", "Values":[name]}])["Images"]
     if len(existing):
         ami_id = existing[0]["ImageId"]
-        use = inquire_existing_ami(f"Use existing AMI - {ami_id}")
+        use = inquire_existing_ami(f"Use existing AMI - {ami_id}") if reuse is None else reuse
         if use:
+            # A REUSED IMAGE CAN STILL BE PENDING IF THE RUN THAT STARTED IT DIED
+            if poller:
+                poller.wait("image",ami_id,"available")
             return ami_id
         delete_ami(session,ami_id,existing)
     log(f"create AMI({name}) for {instance_id}")
-    ami = session.client('ec2').create_image(Name=name,Description="USED IN EC2 TELEPORT",InstanceId=instance_id)["ImageId"]
-    waiter = session.client('ec2').get_waiter('image_available')
-    waiter.wait(ImageIds=[ami],WaiterConfig={"Delay": 20, "MaxAttempts": 120})   
+    ami = get_client(session,'ec2').create_image(Name=name,Description="USED IN EC2 TELEPORT",InstanceId=instance_id)["ImageId"]
+    if on_create:
+        on_create(ami)
+    if poller:
+        poller.wait("image",ami,"available")
+    else:
+        waiter = get_client(session,'ec2').get_waiter('image_available')
+        waiter.wait(ImageIds=[ami],WaiterConfig={"Delay": 20, "MaxAttempts": 120})   
     log(f"AMI({ami}) is available")
     return ami
 
+def describe_ami(session,ami,region=None):
+    return get_client(session,'ec2',region_name=region).describe_images(ImageIds=[ami])["Images"][0]
+
 def describe_ami_blockdevicemappings(session,ami):
-    return session.client('ec2').describe_images(ImageIds=[ami])["Images"][0]["BlockDeviceMappings"]
+    return describe_ami(session,ami)["BlockDeviceMappings"]
+
+def snapshot_size(snapshot):
+    # FullSnapshotSizeInBytes IS THE DATA THE SNAPSHOT HOLDS, NOT EVERY SNAPSHOT REPORTS IT
+    return snapshot.get("FullSnapshotSizeInBytes") or snapshot["VolumeSize"] * 2 ** 30
+
+def snapshots_gb(snapshots):
+    return round(sum(snapshot_size(s) for s in snapshots) / 2 ** 30,1)
+
+def snapshots_bytes(session,mappings):
+    """
+    data held by the snapshots of mappings, what copying the image moves. a snapshot that doesn't
+    report its size counts with its provisioned size
+    """
+    ids = [m["Ebs"]["SnapshotId"] for m in mappings if "Ebs" in m and "SnapshotId" in m["Ebs"]]
+    if not ids:
+        return 0
+    snapshots = get_client(session,'ec2').describe_snapshots(SnapshotIds=ids)["Snapshots"]
+    return sum(snapshot_size(s) for s in snapshots)
 
 def apply_mappings_edits(mappings,kms):
     # SET KMS KEY TO SELECTED DESTIONATION KMS KEY
     # SET EBS VOLUME TO DELETE ON EC2 TERMINATION
+    # INSTANCE STORE (VirtualName) AND NoDevice MAPPINGS PASS THROUGH AS THEY ARE
     def map_func(x):
+        if "Ebs" not in x:
+            return x
         if kms:
             x["Ebs"]["Encrypted"] = True 
             x["Ebs"]["KmsKeyId"] = kms
@@ -129,15 +799,18 @@ def apply_mappings_edits(mappings,kms):
         return x
     return list(map(map_func,mappings))
 
-def copy_ami(session,ami,src_region,dst_region,key):
+def copy_ami(session,ami,src_region,dst_region,key,reuse=None,poller=None,on_create=None):
     if src_region == dst_region:
         return ami   
     name = f"TELEPORT-{ami}"
-    existing = session.client('ec2').describe_images(Filters=[{"Name": "name", "Values":[name]}])["Images"]
+    existing = get_client(session,'ec2').describe_images(Filters=[{"Name": "name", "Values":[name]}])["Images"]
     if len(existing):
         ami_id = existing[0]["ImageId"]
-        use = inquire_existing_ami(f"Use existing AMI - {ami_id}")
+        use = inquire_existing_ami(f"Use existing AMI - {ami_id}") if reuse is None else reuse
         if use:
+            # A REUSED IMAGE CAN STILL BE PENDING IF THE RUN THAT STARTED IT DIED
+            if poller:
+                poller.wait("image",ami_id,"available")
             return ami_id
         delete_ami(session,ami_id,existing)
     name = f"TELEPORT-{ami}"   
@@ -151,55 +824,562 @@ def copy_ami(session,ami,src_region,dst_region,key):
     if key:
         args["Encrypted"] = True
         args["KmsKeyId"] = key
-    log(f"Copying AMI to {dst_region} region.") 
-    copied_ami = session.client('ec2').copy_image(**args)["ImageId"]     
-    log(f'Created {copied_ami} in {dst_region}')                
-    waiter = session.client('ec2',region_name=dst_region).get_waiter('image_available')
-    waiter.wait(ImageIds=[copied_ami],WaiterConfig={"Delay": 20, "MaxAttempts": 120})   
+    # A FULL COPY QUEUE MAKES THE COPY WAIT FOR A SLOT INSTEAD OF FAILING THE TELEPORT
+    with governor.slot(session,dst_region,"CopyImage"):
+        log(f"Copying AMI to {dst_region} region.") 
+        copied_ami = with_retries(lambda: get_client(session,'ec2').copy_image(**args),attempts=20,base_delay=15,codes=QUOTA_CODES)["ImageId"]
+        log(f'Created {copied_ami} in {dst_region}')                
+        if on_create:
+            on_create(copied_ami)
+        if poller:
+            poller.wait("image",copied_ami,"available")
+        else:
+            waiter = get_client(session,'ec2',region_name=dst_region).get_waiter('image_available')
+            waiter.wait(ImageIds=[copied_ami],WaiterConfig={"Delay": 20, "MaxAttempts": 120})   
     return copied_ami
 
-def share_ami(session,ami,src_account,dst_account,dst_region):
-    if src_account != dst_account:
-        log(f"Sharing AMI to {dst_account}")
-        session.client('ec2',region_name=dst_region).modify_image_attribute(ImageId=ami,Attribute='launchPermission',UserIds=[dst_account],OperationType='add',LaunchPermission={ 'Add': [{'UserId': dst_account}]})
+def copy_snapshots(session,snapshots,src_region,dst_region,key,poller=None,existing=None,on_copy=None):
+    """
+    copy {name: snapshot_id} into dst_region in parallel, returns {name: copied_snapshot_id}.
+    a copy is incremental when an earlier copy of the same volume already sits in dst_region
+    """
+    client = get_client(session,'ec2',region_name=dst_region)
+    existing = existing or {}
+    copy_lock = Lock()
+    def copy(name,snapshot_id):
+        with governor.slot(session,dst_region,"CopySnapshot"):
+            return wait(name,existing.get(name) or start(name,snapshot_id))
+    def start(name,snapshot_id):
+        args = {"SourceRegion": src_region,"SourceSnapshotId": snapshot_id,"Description": f"TELEPORT-{snapshot_id}"}
+        if key:
+            args["Encrypted"] = True
+            args["KmsKeyId"] = key
+        copied = with_retries(lambda: client.copy_snapshot(**args),attempts=20,base_delay=15,codes=QUOTA_CODES)["SnapshotId"]
+        log(f"Copying {snapshot_id} ({name}) to {dst_region} as {copied}")
+        if on_copy:
+            with copy_lock:
+                on_copy(name,copied)
+        return copied
+    def wait(name,copied):
+        def progress(snapshot):
+            log(f'{copied} ({name}) {snapshot.get("Progress") or "0%"}')
+        if poller:
+            snapshot = poller.wait("snapshot",copied,"completed",progress=progress)
+        else:
+            client.get_waiter('snapshot_completed').wait(SnapshotIds=[copied],WaiterConfig={"Delay": 20, "MaxAttempts": 120})
+            snapshot = client.describe_snapshots(SnapshotIds=[copied])["Snapshots"][0]
+        telemetry.add_bytes(snapshot_size(snapshot))
+        return name,copied
+    with ThreadPoolExecutor(max_workers=max(len(snapshots),1)) as pool:
+        return dict(pool.map(lambda item: copy(*item),snapshots.items()))
+
+def register_from_snapshots(session,image,snapshots,name,region=None):
+    """
+    register an AMI that mirrors image but points at the copied snapshots
+    """
+    mappings = []
+    for mapping in image["BlockDeviceMappings"]:
+        mapping = dict(mapping)
+        if "Ebs" in mapping:
+            ebs = {k: v for k,v in mapping["Ebs"].items() if k not in ("Encrypted","KmsKeyId","SnapshotId")}
+            ebs["SnapshotId"] = snapshots[mapping["DeviceName"]]
+            mapping["Ebs"] = ebs
+        mappings.append(mapping)
+    args = {
+        "Name": name,
+        "Description": name,
+        "Architecture": image["Architecture"],
+        "RootDeviceName": image["RootDeviceName"],
+        "VirtualizationType": image["VirtualizationType"],
+        "BlockDeviceMappings": mappings,
+    }
+    # UEFI, NITROTPM AND IMDSv2 ONLY DEFAULTS LIVE ON THE IMAGE, WITHOUT THEM A UEFI BOOT DISK WON'T BOOT
+    for field in ("EnaSupport","SriovNetSupport","BootMode","TpmSupport","ImdsSupport"):
+        if field in image:
+            args[field] = image[field]
+    return get_client(session,'ec2',region_name=region).register_image(**args)["ImageId"]
+
+def image_from_instance(instance):
+    """
+    the parts of an image register_from_snapshots needs, taken from a described instance
+    """
+    volumes = {v["VolumeId"]: v for v in instance["Volumes"]}
+    mappings = []
+    for b in instance["BlockDeviceMappings"]:
+        if "Ebs" not in b:
+            continue
+        vol = volumes[b["Ebs"]["VolumeId"]]
+        ebs = {"VolumeSize": vol["Size"],"VolumeType": vol["VolumeType"],"DeleteOnTermination": True}
+        if vol["VolumeType"] in ("io1","io2","gp3") and vol.get("Iops"):
+            ebs["Iops"] = vol["Iops"]
+        if vol.get("Throughput"):
+            ebs["Throughput"] = vol["Throughput"]
+        mappings.append({"DeviceName": b["DeviceName"],"Ebs": ebs})
+    image = {
+        "Architecture": instance["Architecture"],
+        "RootDeviceName": instance["RootDeviceName"],
+        "VirtualizationType": instance["VirtualizationType"],
+        "BlockDeviceMappings": mappings,
+    }
+    if instance.get("EnaSupport"):
+        image["EnaSupport"] = True
+    if instance.get("SriovNetSupport"):
+        image["SriovNetSupport"] = instance["SriovNetSupport"]
+    # THE FIRMWARE THE INSTANCE ACTUALLY BOOTED WITH, A uefi-preferred INSTANCE MAY BE RUNNING EITHER
+    if instance.get("CurrentInstanceBootMode") or instance.get("BootMode"):
+        image["BootMode"] = instance.get("CurrentInstanceBootMode") or instance["BootMode"]
+    if instance.get("TpmSupport"):
+        image["TpmSupport"] = instance["TpmSupport"]
+    if instance.get("MetadataOptions",{}).get("HttpTokens") == "required":
+        image["ImdsSupport"] = "v2.0"
+    return image
+
+def copy_ami_by_snapshots(session,ami,src_region,dst_region,key,poller=None,existing=None,on_copy=None):
+    """
+    fast path for copy_ami: copy the image's snapshots straight across and register the
+    AMI in dst_region instead of running copy_image
+    """
+    if src_region == dst_region:
+        return ami
+    name = f"TELEPORT-{ami}"
+    existing_images = get_client(session,'ec2',region_name=dst_region).describe_images(Filters=[{"Name": "name", "Values":[name]}])["Images"]
+    if len(existing_images):
+        if poller:
+            poller.wait("image",existing_images[0]["ImageId"],"available")
+        return existing_images[0]["ImageId"]
+    image = describe_ami(session,ami,region=src_region)
+    snapshots = {m["DeviceName"]: m["Ebs"]["SnapshotId"] for m in image["BlockDeviceMappings"] if "Ebs" in m}
+    copies = copy_snapshots(session,snapshots,src_region,dst_region,key,poller,existing,on_copy)
+    copied_ami = register_from_snapshots(session,image,copies,name,region=dst_region)
+    log(f"Registered {copied_ami} in {dst_region} from {len(copies)} copied snapshots")
+    return copied_ami
+
+def snapshot_instance(session,instance,description,poller=None):
+    """
+    crash consistent snapshots of every attached volume without stopping the instance, returns {device: snapshot_id}
+    """
+    client = get_client(session,'ec2')
+    snapshots = client.create_snapshots(
+        InstanceSpecification={"InstanceId": instance["InstanceId"],"ExcludeBootVolume": False},
+        Description=description,
+        CopyTagsFromSource='volume'
+    )["Snapshots"]
+    devices = {b["Ebs"]["VolumeId"]: b["DeviceName"] for b in instance["BlockDeviceMappings"] if "Ebs" in b}
+    for snapshot in snapshots:
+        if poller:
+            poller.wait("snapshot",snapshot["SnapshotId"],"completed")
+        else:
+            client.get_waiter('snapshot_completed').wait(SnapshotIds=[snapshot["SnapshotId"]],WaiterConfig={"Delay": 20, "MaxAttempts": 120})
+    return {devices[s["VolumeId"]]: s["SnapshotId"] for s in snapshots}
+
+def share_ami(session,ami,src_account,dst_accounts,dst_region):
+    # ONE CALL SHARES THE IMAGE WITH EVERY ACCOUNT
+    accounts = sorted({dst_accounts} if isinstance(dst_accounts,str) else set(dst_accounts))
+    accounts = [a for a in accounts if a != src_account]
+    if accounts:
+        log(f"Sharing {ami} to {', '.join(accounts)}")
+        get_client(session,'ec2',region_name=dst_region).modify_image_attribute(ImageId=ami,Attribute='launchPermission',OperationType='add',LaunchPermission={'Add': [{'UserId': a} for a in accounts]})
+
+def launch_tags(tags):
+    # aws: PREFIXED TAGS ARE RESERVED AND WOULD FAIL THE WHOLE REQUEST
+    return [t for t in tags if not t["Key"].startswith("aws:")]
 
-def tag_volumes(session,region,id,tags):
-    client = session.client('ec2',region_name=region)
-    time.sleep(15)
-    mappings = client.describe_instances(InstanceIds=[id])["Reservations"][0]["Instances"][0]["BlockDeviceMappings"]
-    # sleep for 15 seconds to give volumes chance to come up
-    tag_list = [t for t in tags]
-    client.create_tags(Resources=[x["Ebs"]["VolumeId"] for x in mappings],Tags=tag_list)
+def tag_volumes(session,region,id,tags,expected=1,timeout=300):
+    """
+    tag the instance's volumes exactly once, as soon as all of them are attached
+    """
+    client = get_client(session,'ec2',region_name=region)
+    deadline = time.time() + timeout
+    delay = 1
+    while True:
+        try:
+            mappings = client.describe_instances(InstanceIds=[id])["Reservations"][0]["Instances"][0]["BlockDeviceMappings"]
+        except Exception as e:
+            # A BRAND NEW INSTANCE CAN BE MISSING FROM DESCRIBE CALLS FOR A MOMENT
+            if "NotFound" not in str(e):
+                raise
+            mappings = []
+        volumes = [m["Ebs"] for m in mappings if "Ebs" in m]
+        if len(volumes) >= expected and all(v["Status"] == "attached" for v in volumes):
+            break
+        if time.time() > deadline:
+            raise TeleportError(f"volumes of {id} weren't attached after {timeout}s, they were not tagged")
+        time.sleep(delay)
+        delay = min(delay * 2,15)
+    client.create_tags(Resources=[v["VolumeId"] for v in volumes],Tags=launch_tags(tags))
 
-def stop_instance(session,instance):
+def stop_instance(session,instance,poller=None):
     instance_id = instance["InstanceId"]
     if instance["State"]["Name"] != "stopped":
         log(f"stopping {instance_id}...")
-        client =  session.client('ec2')
+        client =  get_client(session,'ec2')
         client.stop_instances(InstanceIds=[instance_id])
-        waiter = client.get_waiter('instance_stopped')
-        waiter.wait(InstanceIds=[instance["InstanceId"]]) 
+        if poller:
+            poller.wait("instance",instance_id,"stopped")
+        else:
+            waiter = client.get_waiter('instance_stopped')
+            waiter.wait(InstanceIds=[instance["InstanceId"]]) 
     log(f"{instance_id} has been stopped")
   
+# INSTANCE STORE DISKS DON'T SURVIVE A STOP AND AREN'T PART OF ANY AMI. THE INSTANCES STREAM THEIR
+# BLOCKS THROUGH AN S3 STAGING PREFIX THEMSELVES, DRIVEN OVER SSM
+STAGING_CHUNK_MB = 64
+STAGING_WORKERS = 8
+SSM_TIMEOUT = 12 * 3600
+# HOW LONG A STAGED INSTANCE STORE STAYS READ ONLY OR FROZEN WAITING FOR ITS STOP
+STAGING_HOLD = 30 * 60
+SSM_PENDING = ("Pending","InProgress","Delayed")
+
+# NVMe INSTANCE STORAGE ON NITRO TYPES, THE ephemeralN MAPPINGS ON OLDER ONES
+STAGING_DEVICES = r'''
+export TMPDIR=$([ -d /dev/shm ] && echo /dev/shm || echo /var/tmp)
+devices() {
+  found=$(lsblk -dnpo NAME,MODEL | awk '/Instance Storage/ {print $1}' | sort -V)
+  if [ -z "$found" ]; then
+    token=$(curl -s -X PUT -H "X-aws-ec2-metadata-token-ttl-seconds: 300" http://169.254.169.254/latest/api/token)
+    md=http://169.254.169.254/latest/meta-data/block-device-mapping
+    for e in $(curl -s -H "X-aws-ec2-metadata-token: $token" $md/ | grep ephemeral | sort -V); do
+      d=/dev/$(curl -s -H "X-aws-ec2-metadata-token: $token" $md/$e | sed 's|^/dev/||')
+      [ -b "$d" ] || d=$(echo $d | sed 's|/dev/sd|/dev/xvd|')
+      if [ -b "$d" ]; then found="$found $d"; fi
+    done
+  fi
+  echo $found
+}
+'''
+
+# EVERY FILESYSTEM A STAGING HOLDS IS LISTED IN $HELD UNDER THE STAGING'S GENERATION, SO A FAILED
+# STAGING, THE TELEPORTER OR A WATCHDOG CAN RELEASE THEM AGAIN
+STAGING_HOLDS = r'''
+HELD=/run/ec2-teleporter-held
+release() {
+  [ -f $HELD ] || return 0
+  while read -r h; do
+    case $h in
+      ro:*) mount -o remount,rw "${h#ro:}" 2>/dev/null || true ;;
+      frozen:*) fsfreeze -u "${h#frozen:}" 2>/dev/null || true ;;
+    esac
+  done < $HELD
+  rm -f $HELD
+}
+'''
+
+# EVERY CHUNK IS READ, CHECKSUMMED RAW, COMPRESSED AND UPLOADED ON ITS OWN. CHUNKS THAT ARE ALL
+# ZEROS ARE ONLY RECORDED. EVERY FILESYSTEM ON THE DISKS IS REMOUNTED READ ONLY (FROZEN IF IT'S BUSY)
+# BEFORE ITS DISK IS READ AND STAYS THAT WAY UNTIL THE STOP. A FAILED STAGING RELEASES THEM AT ONCE,
+# A STOP THAT NEVER COMES WITHIN $HOLD SECONDS LETS THE WATCHDOG RELEASE THEM
+STAGE_SCRIPT = r'''
+set -euo pipefail
+chunk() {
+  local n=$1 tmp sum bytes
+  tmp=$(mktemp)
+  dd if=$DEVICE bs=1M skip=$((n * CHUNK)) count=$CHUNK iflag=fullblock status=none > $tmp || return 1
+  sum=$(sha256sum < $tmp | cut -d' ' -f1)
+  bytes=$(stat -c %s $tmp)
+  if [ -z "$(tr -d '\0' < $tmp | head -c1)" ]; then
+    echo "$n $sum $bytes zero"
+  else
+    gzip -1 -c $tmp | aws s3 cp --only-show-errors - $URL/$INDEX/$n.gz || { rm -f $tmp; return 1; }
+    echo "$n $sum $bytes data"
+  fi
+  rm -f $tmp
+}
+export -f chunk
+# AN EARLIER STAGING WHOSE STOP NEVER CAME MAY STILL HOLD THE FILESYSTEMS
+release
+gen=$(date +%s%N)
+echo "gen $gen" > $HELD
+trap release EXIT
+i=0
+for dev in $(devices); do
+  sync
+  for mnt in $(lsblk -nlo MOUNTPOINT $dev | grep '^/' || true); do
+    if mount -o remount,ro "$mnt" 2>/dev/null; then
+      echo "ro:$mnt" >> $HELD
+    else
+      fsfreeze -f "$mnt"
+      echo "frozen:$mnt" >> $HELD
+    fi
+  done
+  size=$(blockdev --getsize64 $dev)
+  chunks=$(( (size + CHUNK * 1048576 - 1) / (CHUNK * 1048576) ))
+  seq 0 $((chunks - 1)) | DEVICE=$dev INDEX=$i xargs -P $WORKERS -n1 bash -o pipefail -c 'chunk "$1"' _ | sort -n > $TMPDIR/teleport-manifest
+  [ $(wc -l < $TMPDIR/teleport-manifest) -eq $chunks ] || { echo "only part of $dev was staged" >&2; exit 1; }
+  { echo "size $size"; cat $TMPDIR/teleport-manifest; } | aws s3 cp --only-show-errors - $URL/$i/manifest
+  i=$((i + 1))
+done
+[ $i -ge $DISKS ] || { echo "found $i instance store disks, expected $DISKS" >&2; exit 1; }
+trap - EXIT
+setsid nohup bash -c "$(declare -f release); HELD=$HELD; sleep $HOLD; [ \"\$(head -n1 $HELD 2>/dev/null)\" = 'gen $gen' ] && release" > /dev/null 2>&1 < /dev/null &
+echo "staged $i"
+'''
+
+RELEASE_SCRIPT = r'''
+release
+echo released
+'''
+
+# EVERY CHUNK IS DOWNLOADED AND VERIFIED AGAINST ITS CHECKSUM BEFORE IT IS WRITTEN. ZERO CHUNKS ARE
+# WRITTEN LOCALLY, THE DISK MAY HAVE BEEN FORMATTED BY cloud-init
+RESTORE_SCRIPT = r'''
+set -euo pipefail
+restore() {
+  local n=$1 sum=$2 bytes=$3 kind=$4 tmp
+  if [ "$kind" = zero ]; then
+    head -c $bytes /dev/zero | dd of=$DEVICE bs=1M seek=$((n * CHUNK)) iflag=fullblock conv=notrunc status=none
+    return 0
+  fi
+  tmp=$(mktemp)
+  aws s3 cp --only-show-errors $URL/$INDEX/$n.gz - | gunzip > $tmp
+  if [ "$(sha256sum < $tmp | cut -d' ' -f1)" != "$sum" ]; then
+    echo "chunk $n of instance store disk $INDEX failed its checksum" >&2
+    rm -f $tmp
+    return 1
+  fi
+  dd if=$tmp of=$DEVICE bs=1M seek=$((n * CHUNK)) conv=notrunc status=none || { rm -f $tmp; return 1; }
+  rm -f $tmp
+}
+export -f restore
+devs=($(devices))
+for i in $(seq 0 $((DISKS - 1))); do
+  dev=${devs[$i]:-}
+  [ -n "$dev" ] || { echo "no instance store disk $i on this instance" >&2; exit 1; }
+  aws s3 cp --only-show-errors $URL/$i/manifest $TMPDIR/teleport-manifest
+  size=$(awk '$1 == "size" {print $2}' $TMPDIR/teleport-manifest)
+  [ $(blockdev --getsize64 $dev) -ge $size ] || { echo "$dev is smaller than staged disk $i" >&2; exit 1; }
+  for m in $(lsblk -nlo MOUNTPOINT $dev | grep . || true); do umount "$m"; done
+  awk '$1 != "size"' $TMPDIR/teleport-manifest | DEVICE=$dev INDEX=$i xargs -P $WORKERS -n4 bash -o pipefail -c 'restore "$1" "$2" "$3" "$4"' _
+  sync
+done
+mount -a || true
+echo "restored $DISKS"
+'''
+
+STAGING_WRAPPER = """f=$(mktemp)
+cat > "$f" <<'TELEPORT_SCRIPT'
+{script}
+TELEPORT_SCRIPT
+bash "$f"; rc=$?; rm -f "$f"; exit $rc
+"""
+
+def staging_script(body,url,disks):
+    # AWS-RunShellScript RUNS THE COMMANDS WITH sh, WHICH IS DASH ON DEBIAN, SO THE BODY GOES THROUGH A FILE TO BASH
+    # (bash -s WOULD READ IT FROM STDIN, WHERE ANY COMMAND WITHOUT A REDIRECT COULD SWALLOW THE REST OF IT)
+    env = f"export URL={shlex.quote(url)} DISKS={disks} CHUNK={STAGING_CHUNK_MB} WORKERS={STAGING_WORKERS} HOLD={STAGING_HOLD}\n"
+    return STAGING_WRAPPER.format(script=(env + STAGING_DEVICES + STAGING_HOLDS + body).rstrip("\n"))
+
+def staging_url(spec):
+    return f's3://{spec["staging_bucket"]}/teleport/{spec["instance_id"]}'
+
+def instance_store_disks(session,instance_types):
+    """
+    {instance type: (number of instance store disks, total GiB)}
+    """
+    disks = {}
+    types = sorted(set(instance_types))
+    for chunk in chunks(types,100):
+        for page in get_client(session,'ec2').get_paginator('describe_instance_types').paginate(InstanceTypes=chunk):
+            for t in page["InstanceTypes"]:
+                info = t.get("InstanceStorageInfo") or {}
+                disks[t["InstanceType"]] = (sum(d["Count"] for d in info.get("Disks",[])),info.get("TotalSizeInGB",0))
+    return disks
+
+def ssm_run(session,instance_id,script,comment,timeout=SSM_TIMEOUT):
+    """
+    run a shell script on the instance with SSM Run Command and wait for it, returns its stdout
+    """
+    client = get_client(session,'ssm')
+    command_id = client.send_command(InstanceIds=[instance_id],DocumentName="AWS-RunShellScript",Comment=comment[:100],
+        Parameters={"commands": [script],"executionTimeout": [str(timeout)]})["Command"]["CommandId"]
+    deadline = time.time() + timeout
+    delay = POLL_MIN_DELAY
+    while True:
+        time.sleep(delay)
+        delay = min(delay * 2,POLL_MAX_DELAY)
+        try:
+            result = client.get_command_invocation(CommandId=command_id,InstanceId=instance_id)
+        except Exception as e:
+            # THE INVOCATION SHOWS UP A MOMENT AFTER send_command RETURNS
+            if error_code(e) != "InvocationDoesNotExist":
+                raise
+            continue
+        if result["Status"] not in SSM_PENDING:
+            break
+        if time.time() > deadline:
+            raise TeleportError(f"{comment} on {instance_id} didn't finish in {timeout}s")
+    if result["Status"] != "Success":
+        raise TeleportError(f'{comment} on {instance_id} ended {result["Status"]}: {result.get("StandardErrorContent","").strip()[-500:]}')
+    return result.get("StandardOutputContent","")
+
+def wait_for_ssm(session,instance_id,timeout=15 * 60):
+    # A NEW INSTANCE TAKES A MINUTE OR TWO TO REGISTER WITH SSM AFTER IT IS RUNNING
+    client = get_client(session,'ssm')
+    deadline = time.time() + timeout
+    delay = POLL_MIN_DELAY
+    while True:
+        info = client.describe_instance_information(Filters=[{"Key": "InstanceIds","Values": [instance_id]}])["InstanceInformationList"]
+        if info and info[0]["PingStatus"] == "Online":
+            return
+        if time.time() > deadline:
+            raise TeleportError(f"{instance_id} didn't come online in SSM, its instance profile needs AmazonSSMManagedInstanceCore")
+        time.sleep(delay)
+        delay = min(delay * 2,POLL_MAX_DELAY)
+
+def stage_instance_store(session,instance_id,url,disks):
+    log(f"Staging {disks} instance store disks of {instance_id} to {url}")
+    ssm_run(session,instance_id,staging_script(STAGE_SCRIPT,url,disks),f"TELEPORT stage instance store of {instance_id}")
+    log(f"Instance store of {instance_id} is staged")
+
+def release_instance_store(session,instance_id):
+    log(f"Releasing the held instance store filesystems of {instance_id}")
+    ssm_run(session,instance_id,staging_script(RELEASE_SCRIPT,"",0),f"TELEPORT release instance store of {instance_id}",timeout=300)
+
+def restore_instance_store(session,instance_id,url,disks):
+    wait_for_ssm(session,instance_id)
+    log(f"Restoring {disks} instance store disks onto {instance_id} from {url}")
+    ssm_run(session,instance_id,staging_script(RESTORE_SCRIPT,url,disks),f"TELEPORT restore instance store onto {instance_id}")
+    log(f"Instance store of {instance_id} is restored")
+
+def delete_staging(session,url):
+    bucket,prefix = url[len("s3://"):].split("/",1)
+    client = get_client(session,'s3')
+    keys = [o["Key"] for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket,Prefix=prefix + "/") for o in page.get("Contents",[])]
+    for chunk in chunks(keys,1000):
+        client.delete_objects(Bucket=bucket,Delete={"Objects": [{"Key": k} for k in chunk],"Quiet": True})
+    log(f"Removed {len(keys)} staged objects under {url}")
+
+# ON DISK DISCOVERY CACHE SO REPEATED RUNS INTO THE SAME LANDING ZONE DON'T RE-LIST EVERYTHING
+CACHE_DIR = os.path.join(os.path.expanduser("~"),".cache","ec2_teleporter")
+DISCOVERY_TTLS = {
+    "regions": 7 * 24 * 3600,
+    "network": 3600,
+    "profiles": 3600,
+    "kms": 3600,
+    "hosts": 300,
+}
+
+class DiscoveryCache:
+    """
+    sqlite backed store of discovery results keyed by account/region/kind
+    """
+    def __init__(self,path):
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        self.lock = Lock()
+        self.db = sqlite3.connect(path,check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS discovery (account TEXT, region TEXT, kind TEXT, payload TEXT, fetched_at REAL, PRIMARY KEY (account, region, kind))")
+        self.db.commit()
+
+    def get(self,account,region,kind):
+        with self.lock:
+            row = self.db.execute("SELECT payload, fetched_at FROM discovery WHERE account=? AND region=? AND kind=?",(account,region,kind)).fetchone()
+        return (json.loads(row[0]),row[1]) if row else None
+
+    def put(self,account,region,kind,payload):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO discovery VALUES (?,?,?,?,?)",(account,region,kind,json.dumps(payload,default=str),time.time()))
+            self.db.commit()
+
+    def invalidate(self,kinds=None):
+        with self.lock:
+            if kinds:
+                self.db.executemany("DELETE FROM discovery WHERE kind=?",[(k,) for k in kinds])
+            else:
+                self.db.execute("DELETE FROM discovery")
+            self.db.commit()
+
+_discovery = {"cache": None,"enabled": True}
+_refreshing = set()
+_refresh_lock = Lock()
+
+def configure_discovery_cache(enabled=True,refresh=False,invalidate=None,path=None):
+    _discovery["enabled"] = enabled
+    _discovery["cache"] = None
+    if not enabled:
+        return
+    _discovery["cache"] = DiscoveryCache(path or os.path.join(CACHE_DIR,"discovery.db"))
+    if refresh:
+        _discovery["cache"].invalidate()
+    elif invalidate:
+        _discovery["cache"].invalidate(invalidate)
+
+def get_discovery_cache():
+    if _discovery["enabled"] and not _discovery["cache"]:
+        configure_discovery_cache()
+    return _discovery["cache"]
+
+def cached_discovery(session,kind,loader,region=None,fresh=False):
+    """
+    serve a discovery result from disk, stale entries are returned immediately and refreshed
+    in the background so prompts open instantly, fresh always loads live and stores the result
+    """
+    cache = get_discovery_cache()
+    if not cache:
+        return loader()
+    account = get_account_id(session)
+    region = region or session.region_name or "global"
+    hit = None if fresh else cache.get(account,region,kind)
+    if hit:
+        payload,fetched_at = hit
+        if time.time() - fetched_at > DISCOVERY_TTLS[kind]:
+            key = (account,region,kind)
+            with _refresh_lock:
+                if key not in _refreshing:
+                    _refreshing.add(key)
+                    # A REFRESH STILL RUNNING WHEN THE TELEPORT IS DONE MUST NOT KEEP THE PROCESS ALIVE
+                    Thread(target=_refresh_discovery,args=(cache,key,loader),name=f"refresh-{kind}",daemon=True).start()
+        return payload
+    payload = loader()
+    cache.put(account,region,kind,payload)
+    return payload
+
+def _refresh_discovery(cache,key,loader):
+    try:
+        cache.put(*key,loader())
+    except Exception as e:
+        log(f"background refresh of {key[2]} failed: {e}")
+    finally:
+        with _refresh_lock:
+            _refreshing.discard(key)
+
+_network_inventories = {}
+_network_lock = Lock()
+
+def get_network_inventory(session,fresh=False):
+    """
+    every vpc in the account/region with its subnets and security groups, one paginated sweep
+    per resource type grouped by VpcId, cached so every teleport into the same place reuses it,
+    fresh skips every cache for checks that must see live state
+    """
+    cache_key = (get_account_id(session),session.region_name)
+    with _network_lock:
+        if not fresh and cache_key in _network_inventories:
+            return _network_inventories[cache_key]
+    client = get_client(session,'ec2')
+    def sweep(operation,key):
+        return [item for page in client.get_paginator(operation).paginate() for item in page[key]]
+    def load():
+        vpcs = {v["VpcId"]: {**v, "Subnets": [], "SecurityGroups": []} for v in sweep('describe_vpcs',"Vpcs")}
+        for subnet in sweep('describe_subnets',"Subnets"):
+            if subnet["VpcId"] in vpcs:
+                vpcs[subnet["VpcId"]]["Subnets"].append(subnet)
+        for sg in sweep('describe_security_groups',"SecurityGroups"):
+            if sg.get("VpcId") in vpcs:
+                vpcs[sg["VpcId"]]["SecurityGroups"].append(sg)
+        return list(vpcs.values())
+    inventory = cached_discovery(session,"network",load,fresh=fresh)
+    with _network_lock:
+        _network_inventories[cache_key] = inventory
+    return inventory
+
 def get_vpc(session,az_id = None):
     """
     get vpc information with subnet info and security group info
     """
-    client = session.client("ec2")
-    vpcs = client.describe_vpcs()["Vpcs"]
-    def mapVpcs(x):
-        subnet_filters = [{"Name": "vpc-id", "Values":[x["VpcId"]]}]
-        if az_id:
-            subnet_filters.append({"Name": "availability-zone-id", "Values": [az_id]})
-        subnets = client.describe_subnets(Filters=subnet_filters)["Subnets"]
-        sgs =  client.describe_security_groups(Filters=[{"Name": "vpc-id","Values":[x["VpcId"]]}])["SecurityGroups"]
-        x["Subnets"] = subnets
-        x["SecurityGroups"] = sgs
-        return x;    
+    vpcs = get_network_inventory(session)
     if not len(vpcs):
-        exit_with_error('No Vpcs in selected region')    
-    vpcs = map(mapVpcs, vpcs)
-    return list(vpcs)
+        raise TeleportError('No Vpcs in selected region')
+    # DEDICATED HOSTS ARE PINNED TO ONE AZ SO ONLY ITS SUBNETS ARE OFFERED
+    return [{**x, "Subnets": [s for s in x["Subnets"] if not az_id or s["AvailabilityZoneId"] == az_id]} for x in vpcs]
 
 def inquire_instance_id():
     questions = [
@@ -209,11 +1389,12 @@ def inquire_instance_id():
             'message': "What instance id are we teleporting?",
         }
     ]    
-    value = prompt(questions, style=style)["id"]
+    value = _prompt(questions)["id"]
     return value
 
 def inquire_regions(session,msg):
-    regions = [{"name": r["RegionName"]} for r in session.client('ec2',region_name="us-east-1").describe_regions()["Regions"]]    
+    load = lambda: [r["RegionName"] for r in get_client(session,'ec2',region_name="us-east-1").describe_regions()["Regions"]]
+    regions = [{"name": r} for r in cached_discovery(session,"regions",load,region="global")]    
     region_questions = [
         {
             'type': 'checkbox',
@@ -222,7 +1403,7 @@ def inquire_regions(session,msg):
             'choices': regions
         }
     ]    
-    region = prompt(region_questions, style=style)["region"][0]
+    region = _prompt(region_questions)["region"][0]
     return region
 
 def inquire_existing_ami(msg):
@@ -234,7 +1415,7 @@ def inquire_existing_ami(msg):
             "default": False
         }
     ]    
-    value = prompt(questions, style=style)["use"]
+    value = _prompt(questions)["use"]
     return value
 
 def inquire_vpc(vpcs):
@@ -253,9 +1434,12 @@ def inquire_vpc(vpcs):
                 'choices': list(map(mapVpcs,vpcs))
             }
         ]    
-        vpc = "".join(prompt(vpc_questions, style=style)["vpc"][0].split()[1:])
+        vpc = "".join(_prompt(vpc_questions)["vpc"][0].split()[1:])
         return vpc
-    except:
+    except TeleportError:
+        # A HEADLESS RUN WITHOUT A VPC IN ITS PLAN, THE CALLER REPORTS IT
+        raise
+    except Exception:
         exit_with_error('Unable to inquire about Vpcs')
 
 def inquire_subnet(subnets):
@@ -273,7 +1457,7 @@ def inquire_subnet(subnets):
             'choices': list(map(mapSubnets,subnets))
         }
     ]    
-    subnet = "".join(prompt(subnet_questions, style=style)["subnet"][0].split()[1:])
+    subnet = "".join(_prompt(subnet_questions)["subnet"][0].split()[1:])
     return subnet
 
 def inquire_sg(sgs):
@@ -289,7 +1473,7 @@ def inquire_sg(sgs):
             'choices': list(map(mapSgs,sgs))
         }
     ]    
-    sg = "".join(prompt(sg_questions, style=style)["sg"][0].split()[1:])
+    sg = "".join(_prompt(sg_questions)["sg"][0].split()[1:])
     return sg
 
 def inquire_instance_type():
@@ -300,12 +1484,13 @@ def inquire_instance_type():
             'name': 'instance_type',
         }
     ]    
-    instance_type = prompt(questions, style=style)["instance_type"]
+    instance_type = _prompt(questions)["instance_type"]
     instance_type = instance_type if instance_type != "" else None
     return instance_type
 
 def inquire_profile(session):
-    profiles = session.client("iam").list_instance_profiles()["InstanceProfiles"]
+    load = lambda: [p for page in get_client(session,"iam").get_paginator('list_instance_profiles').paginate() for p in page["InstanceProfiles"]]
+    profiles = cached_discovery(session,"profiles",load,region="global")
     def mapProfiles(x):        
         return {
             "name": x["InstanceProfileName"] + " " + x["InstanceProfileId"]
@@ -318,11 +1503,12 @@ def inquire_profile(session):
             'choices': list(map(mapProfiles,profiles))
         }
     ]    
-    profile = "".join(prompt(profile_questions, style=style)["profile"][0].split()[0])
+    profile = "".join(_prompt(profile_questions)["profile"][0].split()[0])
     return profile 
 
 def inquire_dedicated_host(session):
-    hosts = [{"name" : h["HostId"], 'az_id': h["AvailabilityZoneId"], 'cpu': h["AvailableCapacity"]["AvailableVCpus"], 'family':  h["HostProperties"]["InstanceFamily"]} for h in session.client("ec2").describe_hosts()["Hosts"]]
+    load = lambda: [{"name" : h["HostId"], 'az_id': h["AvailabilityZoneId"], 'cpu': h["AvailableCapacity"]["AvailableVCpus"], 'family':  h["HostProperties"]["InstanceFamily"]} for page in get_client(session,"ec2").get_paginator('describe_hosts').paginate() for h in page["Hosts"]]
+    hosts = cached_discovery(session,"hosts",load)
     hosts_options = [{"name" : f'{h["name"]}, {h["cpu"]} vcpus available, {h["family"]} family type'} for h in hosts]
     host_questions = [
         {
@@ -332,7 +1518,7 @@ def inquire_dedicated_host(session):
             'choices': hosts_options
         }
     ]    
-    host = prompt(host_questions, style=style)["host"][0].split(',')[0].strip()
+    host = _prompt(host_questions)["host"][0].split(',')[0].strip()
     return [h for h in hosts if h['name'] == host][0]
 
 def inquire_deploy_type():
@@ -344,9 +1530,55 @@ def inquire_deploy_type():
             'choices': [{"name": "dedicated host"}, {"name": "dedicated instance"}, {"name": "on demand"}]
         }
     ]    
-    deploy_type = prompt(deploy_questions, style=style)["type"][0]
+    deploy_type = _prompt(deploy_questions)["type"][0]
     return deploy_type 
     
+KMS_DESCRIBE_WORKERS = 16
+_kms_catalogs = {}
+_kms_lock = Lock()
+
+def get_kms_catalog(session,fresh=False):
+    """
+    every kms key in the account/region with its aliases, manager and state, cached for the run,
+    fresh skips every cache for checks that must see live state
+    """
+    cache_key = (get_account_id(session),session.region_name)
+    with _kms_lock:
+        if not fresh and cache_key in _kms_catalogs:
+            return _kms_catalogs[cache_key]
+    client = get_client(session,'kms')
+    def load():
+        # ONE PAGINATED SWEEP OF ALIASES INSTEAD OF A list_aliases CALL PER KEY
+        aliases = {}
+        for page in client.get_paginator('list_aliases').paginate():
+            for alias in page["Aliases"]:
+                if "TargetKeyId" in alias:
+                    aliases.setdefault(alias["TargetKeyId"],[]).append(alias["AliasName"])
+        key_ids = [k["KeyId"] for page in client.get_paginator('list_keys').paginate() for k in page["Keys"]]
+        def describe(key_id):
+            try:
+                return client.describe_key(KeyId=key_id)["KeyMetadata"]
+            except Exception as e:
+                log(f"unable to describe kms key {key_id}: {e}")
+                return {"KeyId": key_id,"KeyManager": None,"KeyState": None}
+        with ThreadPoolExecutor(max_workers=KMS_DESCRIBE_WORKERS) as pool:
+            metadata = list(pool.map(describe,key_ids))
+        return [{
+            "KeyId": m["KeyId"],
+            "Arn": m.get("Arn"),
+            "KeyManager": m["KeyManager"],
+            "KeyState": m["KeyState"],
+            "Aliases": sorted(aliases.get(m["KeyId"],[])),
+        } for m in metadata]
+    catalog = cached_discovery(session,"kms",load,fresh=fresh)
+    with _kms_lock:
+        _kms_catalogs[cache_key] = catalog
+    return catalog
+
+def usable_kms_keys(session):
+    # AWS MANAGED KEYS CAN'T BE SHARED ACROSS ACCOUNTS SO ONLY ENABLED CMKS ARE OFFERED
+    return [k for k in get_kms_catalog(session) if k["KeyManager"] == "CUSTOMER" and k["KeyState"] == "Enabled"]
+
 def inquire_kms(session,encrypted):
     continue_inquire = True
     if not encrypted:
@@ -358,16 +1590,15 @@ def inquire_kms(session,encrypted):
                 "default": False
             }
         ]    
-        value = prompt(questions, style=style)["use"]
+        value = _prompt(questions)["use"]
         continue_inquire = value
     if not continue_inquire:
         return False
-    kms = [(k["KeyId"],session.client('kms').list_aliases(KeyId=k["KeyId"])["Aliases"]) for k in session.client("kms").list_keys()["Keys"]]
+    kms = usable_kms_keys(session)
     def map_kms(x): 
-        id,alias = x   
-        alias = "No Alias" if len(alias) == 0 else alias[0]["AliasName"]  
+        alias = "No Alias" if len(x["Aliases"]) == 0 else x["Aliases"][0]
         return {
-            "name": alias + " " + id
+            "name": alias + " " + x["KeyId"]
         }
     kms_questions = [
         {
@@ -377,15 +1608,15 @@ def inquire_kms(session,encrypted):
             'choices': list(map(map_kms,kms))
         }
     ]    
-    kms = "".join(prompt(kms_questions, style=style)["kms"][0].split()[1:])
+    kms = "".join(_prompt(kms_questions)["kms"][0].split()[1:])
     return kms  
 
-def inquire_region_kms(session,dst_account):
-    kms = [(k["KeyId"],session.client('kms').list_aliases(KeyId=k["KeyId"])["Aliases"][0]["AliasName"]) for k in session.client("kms").list_keys()["Keys"]]
-    def map_kms(x):
-        id,alias = x        
+def inquire_region_kms(session,dst_account,user):
+    kms = usable_kms_keys(session)
+    def map_kms(x): 
+        alias = "No Alias" if len(x["Aliases"]) == 0 else x["Aliases"][0]
         return {
-            "name": alias + " " + id
+            "name": alias + " " + x["KeyId"]
         }
     kms_questions = [
         {
@@ -395,78 +1626,195 @@ def inquire_region_kms(session,dst_account):
             'choices': list(map(map_kms,kms))
         }
     ]    
-    kmskey = "".join(prompt(kms_questions, style=style)["kms"][0].split()[1:])
-    grant_id = grant_kms(session,kmskey,dst_account)
+    kmskey = "".join(_prompt(kms_questions)["kms"][0].split()[1:])
+    grant_id = grant_manager.acquire(session,kmskey,dst_account,user)
     return (kmskey,(grant_id,kmskey,session))       
 
 def remove_ami(session,ami):
     log(f"Removing AMI - {ami}")
-    session.client('ec2').deregister_image(ImageId=ami)
+    get_client(session,'ec2').deregister_image(ImageId=ami)
 
 def remove_snapshots(session,mappings):
-    for x in mappings:
-        id = x["Ebs"]["SnapshotId"]
+    delete_snapshots(session,[x["Ebs"]["SnapshotId"] for x in mappings if "Ebs" in x])
+
+CLEANUP_WORKERS = 10
+
+def delete_snapshots(session,snapshot_ids,region=None,raise_errors=True):
+    """
+    delete snapshots concurrently, retrying throttled calls, returns {snapshot_id: error} for failures
+    """
+    client = get_client(session,'ec2',region_name=region)
+    def delete(id):
         log(f"Removing Snapshot - {id}")
-        session.client('ec2').delete_snapshot(SnapshotId=id)
+        try:
+            with_retries(lambda: client.delete_snapshot(SnapshotId=id))
+        except Exception as e:
+            if "NotFound" not in str(e):
+                return id,e
+        return id,None
+    with ThreadPoolExecutor(max_workers=CLEANUP_WORKERS) as pool:
+        failed = {id: e for id,e in pool.map(delete,list(snapshot_ids)) if e}
+    if failed and raise_errors:
+        raise TeleportError(f"unable to delete {len(failed)} snapshots: " + "; ".join(f"{id}: {e}" for id,e in failed.items()))
+    return failed
 
 def remove_instance(session,region,instance_id):
     log(f"Terminating instance - {instance_id}")
-    client = session.client('ec2',region_name=region)
+    client = get_client(session,'ec2',region_name=region)
     client.modify_instance_attribute(InstanceId=instance_id,DisableApiTermination={'Value': False})
     client.terminate_instances(InstanceIds=[instance_id])
 
 def write_title(title):
+    from pyfiglet import Figlet
     f = Figlet(font='slant')
     print(f.renderText(title))
 
-def deploy_instance(session,ami,instanceType,tags,mappings,subnet,security_group,profile,host,deploy_type):
-        client = session.client('ec2')
-        tenancy = 'host' if deploy_type == "dedicated host" else 'dedicated' if deploy_type == 'dedicated instance' else 'default'
-        placement_options = {'Tenancy':tenancy}
-        if tenancy == 'host':
-            placement_options["HostId"] = host
-        result = client.run_instances(
-            Placement=placement_options,
-            BlockDeviceMappings=mappings,
-            ImageId=ami,
-            InstanceType=instanceType,
-            SecurityGroupIds=[security_group],
-            SubnetId=subnet,
-            DisableApiTermination=True,
-            MaxCount=1,
-            MinCount=1,
-            IamInstanceProfile={'Name': profile}
-            )
-        if "Instances" in result and len(result["Instances"]) > 0:
-            # CREATE TAGS FOR INSTANCE
-            client.create_tags(
-                Resources=[result["Instances"][0]["InstanceId"]],
-                Tags=tags
-            )
-            return result["Instances"][0]["InstanceId"]
-            
-        return "FAIL"
-
-def get_sessions():
-    s_reg = inquire_regions(boto3.Session(profile_name="src"),"Select Source Region")
-    d_reg = inquire_regions(boto3.Session(profile_name="dst"),"Select Destination Region")
+# OUT OF CAPACITY FOR THIS TYPE IN THIS AZ, ANOTHER SUBNET OR TYPE CAN STILL WORK
+CAPACITY_CODES = ("InsufficientInstanceCapacity","InsufficientHostCapacity","InsufficientCapacity","Unsupported")
+# THE SHARED TEMPLATE WAS DELETED UNDER THE LAUNCH, BY ANOTHER RUN THAT FINISHED OR BY --cleanup
+TEMPLATE_NOT_FOUND_CODES = ("InvalidLaunchTemplateName.NotFoundException","InvalidLaunchTemplateId.NotFound")
+# TAGGING AT LAUNCH REFUSED, e.g. NO ec2:CreateTags ON LAUNCH OR A TAG POLICY
+TAG_CODES = ("UnauthorizedOperation","TagPolicyViolation","InvalidParameterValue")
+TAG_MESSAGE = re.compile(r"CreateTags|TagSpecification|\btags?\b",re.IGNORECASE)
+
+def tagging_refused(e):
+    # UnauthorizedOperation AND InvalidParameterValue ALSO COVER EVERY OTHER PART OF THE LAUNCH,
+    # ONLY A REFUSAL THAT NAMES THE TAGS IS WORTH LAUNCHING UNTAGGED FOR
+    code = error_code(e)
+    if code not in TAG_CODES:
+        return False
+    return code == "TagPolicyViolation" or bool(TAG_MESSAGE.search(getattr(e,"response",{}).get("Error",{}).get("Message","")))
+
+_launch_templates = {}
+_templates_lock = Lock()
+
+def launch_template(session,security_group,profile,host,deploy_type,recreate=False):
+    """
+    TELEPORT-* launch template with the placement, security group, profile and termination protection,
+    named after its settings so every launch with the same settings shares it, returns its name.
+    the image, type, subnet, mappings and tags are given per launch. recreate makes it again
+    after someone else deleted it
+    """
+    tenancy = 'host' if deploy_type == "dedicated host" else 'dedicated' if deploy_type == 'dedicated instance' else 'default'
+    placement = {'Tenancy': tenancy}
+    if tenancy == 'host':
+        placement["HostId"] = host
+    data = dict(Placement=placement,SecurityGroupIds=[security_group],IamInstanceProfile={'Name': profile},DisableApiTermination=True)
+    name = "TELEPORT-" + hashlib.sha256(json.dumps(data,sort_keys=True).encode()).hexdigest()[:16]
+    with _templates_lock:
+        entry = _launch_templates.setdefault((session_key(session),session.region_name,name),{"lock": Lock(),"id": None,"session": session})
+    with entry["lock"]:
+        if not entry["id"] or recreate:
+            client = get_client(session,'ec2')
+            try:
+                entry["id"] = client.create_launch_template(LaunchTemplateName=name,LaunchTemplateData=data)["LaunchTemplate"]["LaunchTemplateId"]
+            except Exception as e:
+                if error_code(e) != "InvalidLaunchTemplateName.AlreadyExistsException":
+                    raise
+                # MADE BY ANOTHER RUN WITH THE SAME SETTINGS, OR ANOTHER THREAD THAT FOUND IT DELETED TOO
+                entry["id"] = client.describe_launch_templates(LaunchTemplateNames=[name])["LaunchTemplates"][0]["LaunchTemplateId"]
+    return name
+
+def delete_launch_templates():
+    with _templates_lock:
+        entries = list(_launch_templates.values())
+        _launch_templates.clear()
+    for entry in entries:
+        if entry["id"]:
+            try:
+                get_client(entry["session"],'ec2').delete_launch_template(LaunchTemplateId=entry["id"])
+            except Exception as e:
+                log(f'Unable to delete launch template {entry["id"]}: {e}')
+
+def launch_instances(session,ami,instance_types,tags,mappings,subnets,security_group,profile,host,deploy_type,count=1,token=None):
+    """
+    launch up to count instances from a shared launch template. every instance type is tried in
+    every subnet in order, moving on whenever AWS runs out of capacity, and each call asks for all
+    the instances still missing. returns the new instance ids, fewer than count if every fallback ran dry.
+    with a token every call carries a ClientToken derived from it, so a resumed run gets back the
+    instances a crashed one launched instead of launching them again
+    """
+    client = get_client(session,'ec2')
+    # BY NAME, SO A TEMPLATE MADE AGAIN LEAVES THE LAUNCH PARAMETERS, AND SO THE CLIENT TOKENS, AS THEY WERE
+    template = {"LaunchTemplateName": launch_template(session,security_group,profile,host,deploy_type),"Version": "$Latest"}
+    tags = launch_tags(tags)
+    tag_at_launch = bool(tags)
+    def run(**args):
+        nonlocal tag_at_launch
+        if tag_at_launch:
+            # TAG THE INSTANCE AND ITS VOLUMES AS PART OF THE LAUNCH, NO UNTAGGED WINDOW AND NO EXTRA CALLS
+            try:
+                return client.run_instances(TagSpecifications=[{"ResourceType": "instance","Tags": tags},{"ResourceType": "volume","Tags": tags}],**args)["Instances"]
+            except Exception as e:
+                if not tagging_refused(e):
+                    raise
+                log(f"Unable to tag at launch, tagging after launch instead: {e}")
+                tag_at_launch = False
+            # THE SAME TOKEN WITH OTHER PARAMETERS IS REFUSED AS A MISMATCH
+            if "ClientToken" in args:
+                args["ClientToken"] += "-untagged"
+        instances = client.run_instances(**args)["Instances"]
+        if tags and instances:
+            client.create_tags(Resources=[i["InstanceId"] for i in instances],Tags=tags)
+            for instance in instances:
+                tag_volumes(session,session.region_name,instance["InstanceId"],tags,expected=len([m for m in mappings if "Ebs" in m]))
+        return instances
+    def launch(**args):
+        for attempt in range(3):
+            try:
+                return run(**args)
+            except Exception as e:
+                if error_code(e) not in TEMPLATE_NOT_FOUND_CODES or attempt == 2:
+                    raise
+                log(f'Launch template {template["LaunchTemplateName"]} was deleted by another run, creating it again')
+                launch_template(session,security_group,profile,host,deploy_type,recreate=True)
+    launched,misses = [],[]
+    for instance_type in dict.fromkeys(instance_types):
+        for subnet in dict.fromkeys(subnets):
+            while len(launched) < count:
+                args = {"LaunchTemplate": template,"ImageId": ami,"InstanceType": instance_type,"SubnetId": subnet,"BlockDeviceMappings": mappings,"MinCount": 1,"MaxCount": count - len(launched)}
+                if token:
+                    args["ClientToken"] = hashlib.sha256(f"{token}|{instance_type}|{subnet}|{len(launched)}".encode()).hexdigest()[:48]
+                try:
+                    instances = launch(**args)
+                except Exception as e:
+                    if error_code(e) not in CAPACITY_CODES:
+                        raise
+                    misses.append(f"{instance_type} in {subnet}: {error_code(e)}")
+                    log(f"No capacity for {instance_type} in {subnet}, falling back")
+                    break
+                if not instances:
+                    break
+                launched += [i["InstanceId"] for i in instances]
+    if not launched and misses:
+        raise TeleportError(f"no capacity in any fallback: {'; '.join(misses)}")
+    return launched
+
+def deploy_instance(session,ami,instanceType,tags,mappings,subnet,security_group,profile,host,deploy_type,fallback_subnets=(),fallback_types=(),token=None):
+    launched = launch_instances(session,ami,[instanceType,*fallback_types],tags,mappings,[subnet,*fallback_subnets],security_group,profile,host,deploy_type,token=token)
+    return launched[0] if launched else "FAIL"
+
+def get_sessions(identity=None):
+    identity = {**MANIFEST_DEFAULTS, **(identity or {})}
+    s_reg = inquire_regions(spec_session(identity,"src",None),"Select Source Region")
+    d_reg = inquire_regions(spec_session(identity,"dst",None),"Select Destination Region")
     return (
-        boto3.Session(profile_name="src",region_name=s_reg ),
-        boto3.Session(profile_name="src",region_name=d_reg),
-        boto3.Session(profile_name="dst",region_name=d_reg ),
+        spec_session(identity,"src",s_reg),
+        spec_session(identity,"src",d_reg),
+        spec_session(identity,"dst",d_reg),
         s_reg,
         d_reg
     ) 
 def get_account_ids(accounts):
-    return (x.client('sts').get_caller_identity()["Account"] for x in accounts)
+    return (get_account_id(x) for x in accounts)
 def get_destinfo(sess,encrypted):
     deploy_type = inquire_deploy_type()
     az_id = None
     host = None
     if deploy_type == "dedicated host":
         host = inquire_dedicated_host(sess)
-        host = host["name"]
         az_id = host["az_id"]
+        host = host["name"]
     vpcs = get_vpc(sess,az_id)    
     vpc = inquire_vpc(vpcs)
     subnet = inquire_subnet([i for i in vpcs if i["VpcId"] == vpc][0]["Subnets"])
@@ -475,86 +1823,1486 @@ def get_destinfo(sess,encrypted):
     kms = inquire_kms(sess,encrypted)
     return (vpc,subnet,security_group,profile,kms,host,deploy_type)
 
-if __name__ == "__main__":
+def teleport_interactive(identity=None):
     write_title('EC2 Teleporter')
     # GET ACCOUNT IDS
-    (src_pro,src_copy_pro,dst_pro,src_region,dst_region) = get_sessions()
+    (src_pro,src_copy_pro,dst_pro,src_region,dst_region) = get_sessions(identity)
     (src_account,dst_account) = get_account_ids([src_pro,dst_pro]) 
     # VAR FOR DENOTING WHETHER CROSS REGION
     x_region = src_region != dst_region
     # GET SOURCE INSTANCE INFORMATION
     instance_id = inquire_instance_id().strip()
-    instance,grant_ids,keys,encrypted = describe_instance(src_pro,dst_pro,instance_id)
-    # STOP INSTANCE
-    stop_instance(src_pro,instance)  
-    # CREATE AMI
-    original_ami = create_ami(src_pro, instance) 
-    original_mappings = describe_ami_blockdevicemappings(src_pro,original_ami)
-
-    # GET DESTINATION INFORMATION    
-    (vpc,subnet,security_group,profile,kms,host,deploy_type) = get_destinfo(dst_pro,encrypted) 
-    region_kms,grant = inquire_region_kms(src_copy_pro,dst_account) if x_region and kms != False and src_account != dst_account else (False,None)
-    if grant:
-        grant_ids.append(grant)
-    # DESCRIBE AMI TO GET BLOCKDEVICEMAPPINGS
-    ami = copy_ami(src_copy_pro,original_ami,src_region,dst_region,region_kms if region_kms else kms)
-    # BASED ON WHETHER COPIED AMI TO NEW REGION 
-    mappings = apply_mappings_edits(describe_ami_blockdevicemappings(src_copy_pro if x_region else src_pro,ami),kms)
-    share_ami(src_pro,ami,src_account,dst_account,dst_region)
-    confirm_dic = {"vpc": vpc, "subnet": subnet, "security_group": security_group,"profile": profile,"kms": kms, 'deploy_type': deploy_type, 'host':host}
-    confirm_str = '''\
-        Teleporter would like to confirm your selections:
-                -----> vpc =            {vpc}
-                -----> subnet =         {subnet}
-                -----> security_group = {security_group}
-                -----> profile =        {profile}
-                -----> kms =            {kms}
-                -----> deploy type  =   {deploy_type}
-                -----> host  =          {host}
-          Are these right? Press 'n' to pull the eject cord
-        '''.format(**confirm_dic)
-    confirm(string=confirm_str,eject=True)
-    # DEPLOY INSTANCE IN DESTINATION
-    instance_type = inquire_instance_type()
-    instance_type = instance_type if instance_type else instance["InstanceType"]
-    new_instance = deploy_instance(dst_pro,ami,instance_type,instance["Tags"],mappings,subnet,security_group,profile,host,deploy_type)
-    log(f"Instance has been teleported.")
-    log(f"Instance id is {new_instance}")
-    # TAG ATTACHED EBS VOLUMES
-    tag_volumes(dst_pro,dst_region,new_instance,instance["Tags"])
-    #REMOVE GRANTS FOR ANY KMS KEYS
-    for grant,kms,sess in grant_ids:
-        sess.client('kms').revoke_grant(KeyId=kms,GrantId=grant)
-    # DELETE SNAPSHOTS AND AMI
-    if x_region:
+    journal = Journal.start(instance_id)
+    try:
+        instance,grant_ids,keys,encrypted = describe_instance(src_pro,dst_pro,instance_id)
+        for grant,kms,sess in grant_ids:
+            journal.add_grant(grant,kms,sess)
+        # INSTANCE STORE DATA IS LOST AT THE STOP, ONLY PLAN AND MANIFEST RUNS STAGE IT ACROSS
+        if instance_store_disks(src_pro,[instance["InstanceType"]])[instance["InstanceType"]][0]:
+            confirm(f"{instance_id} has instance store disks, their data is lost when it stops (use --plan with --staging-bucket to keep it). Continue?",eject=True)
+        # STOP INSTANCE
+        with telemetry.stage("stop",instance_id):
+            stop_instance(src_pro,instance)  
+        # CREATE AMI
+        with telemetry.stage("ami",instance_id):
+            original_ami = create_ami(src_pro, instance, on_create=lambda ami: journal.record(original_ami=ami)) 
+        journal.record(original_ami=original_ami)
+        original_mappings = describe_ami_blockdevicemappings(src_pro,original_ami)
+
+        # GET DESTINATION INFORMATION    
+        (vpc,subnet,security_group,profile,kms,host,deploy_type) = get_destinfo(dst_pro,encrypted) 
+        region_kms,grant = inquire_region_kms(src_copy_pro,dst_account,instance_id) if x_region and kms != False and src_account != dst_account else (False,None)
+        if grant:
+            journal.add_grant(*grant)
+        # DESCRIBE AMI TO GET BLOCKDEVICEMAPPINGS
+        with telemetry.stage("copy",instance_id):
+            ami = copy_ami(src_copy_pro,original_ami,src_region,dst_region,region_kms if region_kms else kms,on_create=lambda ami: journal.record(ami=ami))
+        if x_region:
+            telemetry.add_bytes(snapshots_bytes(src_pro,original_mappings),instance_id)
+        journal.record(ami=ami)
+        # BASED ON WHETHER COPIED AMI TO NEW REGION 
+        mappings = apply_mappings_edits(describe_ami_blockdevicemappings(src_copy_pro if x_region else src_pro,ami),kms)
+        with telemetry.stage("share",instance_id):
+            share_ami(src_pro,ami,src_account,dst_account,dst_region)
+        confirm_dic = {"vpc": vpc, "subnet": subnet, "security_group": security_group,"profile": profile,"kms": kms, 'deploy_type': deploy_type, 'host':host}
+        confirm_str = '''\
+            Teleporter would like to confirm your selections:
+                    -----> vpc =            {vpc}
+                    -----> subnet =         {subnet}
+                    -----> security_group = {security_group}
+                    -----> profile =        {profile}
+                    -----> kms =            {kms}
+                    -----> deploy type  =   {deploy_type}
+                    -----> host  =          {host}
+              Are these right? Press 'n' to pull the eject cord
+            '''.format(**confirm_dic)
+        confirm(string=confirm_str,eject=True)
+        # DEPLOY INSTANCE IN DESTINATION
+        instance_type = inquire_instance_type()
+        instance_type = instance_type if instance_type else instance["InstanceType"]
+        # ONLY A CONFIRMED TELEPORT GETS A SPEC, --resume CARRIES ON WITH ANY JOURNAL THAT HAS ONE
+        journal.set_spec({**MANIFEST_DEFAULTS, **(identity or {}), "instance_id": instance_id, "src_region": src_region, "dst_region": dst_region, "subnet": subnet, "security_group": security_group,
+            "profile": profile, "kms": kms, "region_kms": region_kms, "host": host, "deploy_type": deploy_type, "instance_type": instance_type})
+        with telemetry.stage("launch",instance_id):
+            new_instance = deploy_instance(dst_pro,ami,instance_type,instance["Tags"],mappings,subnet,security_group,profile,host,deploy_type)
+        delete_launch_templates()
+        journal.record(new_instance_id=new_instance)
+        log(f"Instance has been teleported.")
+        log(f"Instance id is {new_instance}")
+        #REMOVE GRANTS FOR ANY KMS KEYS
+        revoke_journal_grants(journal)
+        # DELETE SNAPSHOTS AND AMI
+        if x_region:
+            confirm_str = '''\
+                Would you like to cleanup the following resources in the source account destination region?
+                        -----> ami =            {ami}
+                Press 'y' to teleport them to the shadown realm.
+                '''.format(ami=ami)
+            should_clean = confirm(confirm_str)
+            if should_clean:
+                remove_ami(src_copy_pro,ami)
+                remove_snapshots(src_copy_pro,mappings)         
         confirm_str = '''\
-            Would you like to cleanup the following resources in the source account destination region?
+            Would you like to cleanup the following resources?
                     -----> ami =            {ami}
-            Press 'y' to teleport them to the shadown realm.
-            '''.format(ami=ami)
+              Press 'y' to teleport them to the shadown realm.
+            '''.format(ami=original_ami)
         should_clean = confirm(confirm_str)
         if should_clean:
-            remove_ami(src_copy_pro,ami)
-            remove_snapshots(src_copy_pro,mappings)         
-    confirm_str = '''\
-        Would you like to cleanup the following resources?
-                -----> ami =            {ami}
-          Press 'y' to teleport them to the shadown realm.
-        '''.format(ami=original_ami)
-    should_clean = confirm(confirm_str)
-    if should_clean:
-        remove_ami(src_pro,original_ami)
-        remove_snapshots(src_pro,original_mappings) 
-    # DELETE ORIGINAL INSTANCE
-    confirm_str = '''\
-    Would you like to terminate the original instance?
-            -----> instance_id =            {instance_id}
-        Press 'y' to teleport it to the shadown realm.
-    '''.format(instance_id=instance_id)
-    should_clean = confirm(confirm_str)
-    if should_clean:
-        remove_instance(src_pro,src_region,instance_id)
+            remove_ami(src_pro,original_ami)
+            remove_snapshots(src_pro,original_mappings) 
+        # DELETE ORIGINAL INSTANCE
+        confirm_str = '''\
+        Would you like to terminate the original instance?
+                -----> instance_id =            {instance_id}
+            Press 'y' to teleport it to the shadown realm.
+        '''.format(instance_id=instance_id)
+        should_clean = confirm(confirm_str)
+        if should_clean:
+            remove_instance(src_pro,src_region,instance_id)
+        journal.finish("teleported")
+    except (SystemExit,KeyboardInterrupt):
+        # EJECTED OR INTERRUPTED, NOTHING MAY RESUME WHAT THE USER CALLED OFF
+        revoke_journal_grants(journal)
+        journal.finish("aborted")
+        raise
+    except Exception:
+        # A FAILED RUN MUST NOT STAY "running", THAT WOULD PIN THE CLEANUP WINDOW FOREVER
+        revoke_journal_grants(journal)
+        journal.finish("failed")
+        raise
     log("Teleporter has finished")
     log(f"Your new instance is {new_instance}")
-    
-       
+
+MANIFEST_DEFAULTS = {
+    "src_profile": "src",
+    "dst_profile": "dst",
+    "src_role": None,
+    "dst_role": None,
+    "role_name": DEFAULT_ROLE_NAME,
+    "external_id": None,
+    "deploy_type": "on demand",
+    "host": None,
+    "kms": False,
+    "region_kms": False,
+    "instance_type": None,
+    "reuse_ami": True,
+    "cleanup": False,
+    "terminate_source": False,
+    "mode": "ami",
+    "seed": False,
+    # TRIED IN ORDER WHEN AWS IS OUT OF CAPACITY, EVERY TYPE IN EVERY SUBNET
+    "fallback_subnets": [],
+    "fallback_types": [],
+    # S3 BUCKET BOTH INSTANCES CAN REACH, INSTANCE STORE DISKS ARE STAGED THROUGH IT
+    "staging_bucket": None,
+}
+
+COPY_MODES = ("ami","snapshot")
+
+def read_document(path):
+    with open(path) as f:
+        raw = f.read()
+    if path.endswith((".yml",".yaml")):
+        try:
+            import yaml
+        except ImportError:
+            raise TeleportError(f"PyYAML is required for YAML files like {path} (pip install pyyaml)")
+        return yaml.safe_load(raw) or {}
+    return json.loads(raw)
+
+DESTINATION_KEYS = ("dst_region","subnet","security_group","profile")
+FALLBACK_KEYS = ("fallback_subnets","fallback_types")
+
+def as_list(value):
+    # FLAGS AND HAND WRITTEN PLANS GIVE A COMMA SEPARATED STRING
+    return [v.strip() for v in value.split(",") if v.strip()] if isinstance(value,str) else list(value or [])
+
+def launch_candidates(spec,instance_type):
+    return [instance_type,*as_list(spec["fallback_types"])],[spec["subnet"],*as_list(spec["fallback_subnets"])]
+
+def expand_targets(spec):
+    """
+    one spec per fan-out target, every target inherits what it doesn't set from its spec. a spec
+    without targets is its own single target
+    """
+    if not spec.get("targets"):
+        return [spec]
+    base = {k: v for k,v in spec.items() if k != "targets"}
+    targets = []
+    for i,target in enumerate(spec["targets"]):
+        target = {**base, **target}
+        target["target"] = target.get("target") or f'{i}:{target.get("dst_region")}:{target.get("subnet")}'
+        targets.append(target)
+    return targets
+
+def resolve_spec(spec,source="manifest entry"):
+    required = ("instance_id","src_region") if spec.get("targets") else ("instance_id","src_region") + DESTINATION_KEYS
+    missing = [k for k in required if not spec.get(k)]
+    for target in expand_targets(spec) if spec.get("targets") else []:
+        missing += [f'{k} of target {target["target"]}' for k in DESTINATION_KEYS if not target.get(k)]
+    if missing:
+        raise TeleportError(f"{source} {spec.get('instance_id')} is missing {', '.join(missing)}")
+    # AN UNQUOTED ACCOUNT ID IN YAML IS READ AS A NUMBER AND LOSES ITS LEADING ZEROS
+    for target in expand_targets(spec):
+        for key in ("src_role","dst_role","role_name","external_id"):
+            if target.get(key) is not None and not isinstance(target[key],str):
+                raise TeleportError(f"{source} {spec['instance_id']} has {key} {target[key]!r}, it must be a string, quote account ids")
+    if spec["mode"] not in COPY_MODES:
+        raise TeleportError(f"{source} {spec['instance_id']} has unknown mode {spec['mode']}, expected one of {', '.join(COPY_MODES)}")
+    # ONLY A SNAPSHOT COPY REUSES THE SEEDED COPIES, copy_image WOULD COPY EVERYTHING AGAIN
+    if spec["seed"] and spec["mode"] != "snapshot":
+        raise TeleportError(f"{source} {spec['instance_id']} sets seed, which needs mode snapshot")
+    return spec
+
+def load_manifest(path,overrides=None):
+    """
+    read a YAML/JSON manifest into a list of fully resolved per-instance specs, overrides
+    replace the manifest's defaults but not what an instance sets itself
+    """
+    manifest = read_document(path)
+    defaults = {**MANIFEST_DEFAULTS, **manifest.get("defaults",{}), **(overrides or {})}
+    specs = []
+    for entry in manifest.get("instances",[]):
+        entry = {"instance_id": entry} if isinstance(entry,str) else entry
+        specs.append(resolve_spec({**defaults, **entry}))
+    if not specs:
+        raise TeleportError(f"no instances listed in {path}")
+    # ONE JOURNAL PER INSTANCE, THE SAME INSTANCE TWICE WOULD RACE ITSELF AND STOP ITS OWN SOURCE TWICE
+    seen,duplicates = set(),set()
+    for spec in specs:
+        (duplicates if spec["instance_id"] in seen else seen).add(spec["instance_id"])
+    if duplicates:
+        raise TeleportError(f"{path} lists {', '.join(sorted(duplicates))} more than once, use targets to teleport one instance to several places")
+    return specs
+
+def load_plan(plan):
+    """
+    a plan is one instance's manifest entry, as a dict or a YAML/JSON file
+    """
+    plan = read_document(plan) if isinstance(plan,str) else plan
+    return resolve_spec({**MANIFEST_DEFAULTS, **plan},"plan")
+
+def spec_session(spec,side,region):
+    """
+    the session of the spec's "src" or "dst" side in region, assuming its role when it has one
+    """
+    role = spec.get(f"{side}_role")
+    return get_session(spec[f"{side}_profile"],region,role_arn(role,spec.get("role_name") or DEFAULT_ROLE_NAME) if role else None,spec.get("external_id"))
+
+def get_batch_sessions(spec):
+    return (
+        spec_session(spec,"src",spec["src_region"]),
+        spec_session(spec,"src",spec["dst_region"]),
+        spec_session(spec,"dst",spec["dst_region"]),
+    )
+
+# PREFLIGHT, EVERY PLANNED TELEPORT IS VALIDATED WITH BULK DESCRIBES BEFORE ANY INSTANCE IS STOPPED
+DESCRIBE_CHUNK = 200
+# ON DEMAND vCPU QUOTA CODE PER INSTANCE FAMILY PREFIX, FAMILIES NOT LISTED AREN'T CHECKED
+STANDARD_VCPU_QUOTA = "L-1216C47A"
+VCPU_QUOTAS = {
+    **{prefix: STANDARD_VCPU_QUOTA for prefix in ("a","c","d","h","i","im","is","m","r","t","z")},
+    "f": "L-74FC7D96",
+    "g": "L-DB2E81BA",
+    "vt": "L-DB2E81BA",
+    "p": "L-417A185B",
+    "x": "L-7295265B",
+    "inf": "L-1945791B",
+}
+
+def chunks(items,size=DESCRIBE_CHUNK):
+    items = list(items)
+    return [items[i:i + size] for i in range(0,len(items),size)]
+
+def instance_family(instance_type):
+    return instance_type.split(".")[0]
+
+def vcpu_quota_code(instance_type):
+    return VCPU_QUOTAS.get(re.match(r"[a-z]*",instance_family(instance_type)).group(0))
+
+def group_specs(specs,*keys):
+    groups = {}
+    for spec in specs:
+        groups.setdefault(tuple(tuple(spec[k]) if isinstance(spec[k],list) else spec[k] for k in keys),[]).append(spec)
+    return groups
+
+def distinct(checks):
+    # A FAN-OUT INSTANCE SHOWS UP ONCE PER TARGET, ITS CHECK SHOULD ONLY HEAR ABOUT A PROBLEM ONCE
+    return list({id(c): c for c in checks}.values())
+
+def find_kms_key(catalog,key):
+    if ":alias/" in key:
+        key = "alias/" + key.split(":alias/",1)[1]
+    return next((k for k in catalog if key in (k["KeyId"],k["Arn"]) or key in k["Aliases"]),None)
+
+def check_kms_key(check,catalogs,session,key,account,field):
+    if key.startswith("arn:") and key.split(":")[4] != account:
+        check["warnings"].append(f"{field} {key} belongs to another account, it wasn't checked")
+        return
+    # ONE LIVE CATALOG PER ACCOUNT/REGION FOR THE WHOLE PREFLIGHT, A CACHED ONE MAY MISS NEW KEYS
+    if (account,session.region_name) not in catalogs:
+        catalogs[(account,session.region_name)] = get_kms_catalog(session,fresh=True)
+    found = find_kms_key(catalogs[(account,session.region_name)],key)
+    if not found:
+        check["errors"].append(f"{field} {key} doesn't exist in {account} {session.region_name}")
+    elif found["KeyManager"] != "CUSTOMER":
+        check["errors"].append(f"{field} {key} is AWS managed, it can't be shared across accounts")
+    elif found["KeyState"] != "Enabled":
+        check["errors"].append(f'{field} {key} is {found["KeyState"]}')
+
+def preflight_sources(session,specs,checks,phase="full"):
+    """
+    bulk describe the source instances, their volumes and every distinct kms key behind them
+    """
+    client = get_client(session,'ec2')
+    instances = {}
+    for chunk in chunks(s["instance_id"] for s in specs):
+        for page in client.get_paginator('describe_instances').paginate(Filters=[{"Name": "instance-id","Values": chunk}]):
+            instances.update({i["InstanceId"]: i for r in page["Reservations"] for i in r["Instances"]})
+    volumes = {}
+    volume_ids = [b["Ebs"]["VolumeId"] for i in instances.values() for b in i.get("BlockDeviceMappings",[]) if "Ebs" in b]
+    for chunk in chunks(volume_ids):
+        for page in client.get_paginator('describe_volumes').paginate(Filters=[{"Name": "volume-id","Values": chunk}]):
+            volumes.update({v["VolumeId"]: v for v in page["Volumes"]})
+    kms = get_client(session,'kms')
+    def describe_key(key):
+        try:
+            return key,kms.describe_key(KeyId=key)["KeyMetadata"]
+        except Exception as e:
+            return key,{"error": str(e)}
+    with ThreadPoolExecutor(max_workers=KMS_DESCRIBE_WORKERS) as pool:
+        keys = dict(pool.map(describe_key,{v["KmsKeyId"] for v in volumes.values() if v.get("KmsKeyId")}))
+    stores = instance_store_disks(session,[i["InstanceType"] for i in instances.values()]) if instances else {}
+    # STAGING RUNS OVER SSM, THE INSTANCES THAT NEED IT MUST BE MANAGED AND ONLINE
+    staged = [s["instance_id"] for s in specs if s["staging_bucket"] and s["instance_id"] in instances and stores.get(instances[s["instance_id"]]["InstanceType"],(0,0))[0]]
+    managed,ssm_error = {},None
+    try:
+        for chunk in chunks(staged,50):
+            for page in get_client(session,'ssm').get_paginator('describe_instance_information').paginate(Filters=[{"Key": "InstanceIds","Values": chunk}]):
+                managed.update({i["InstanceId"]: i["PingStatus"] for i in page["InstanceInformationList"]})
+    except Exception as e:
+        ssm_error = str(e)
+    src_account = get_account_id(session)
+    for spec in specs:
+        check = checks[spec["instance_id"]]
+        instance = instances.get(spec["instance_id"])
+        if not instance:
+            check["errors"].append(f'{spec["instance_id"]} doesn\'t exist in {spec["src_region"]}')
+            continue
+        if instance["State"]["Name"] in ("shutting-down","terminated"):
+            check["errors"].append(f'{spec["instance_id"]} is {instance["State"]["Name"]}')
+        if instance.get("RootDeviceType","ebs") != "ebs":
+            check["errors"].append(f'{spec["instance_id"]} has an instance store root volume, only EBS backed instances can be teleported')
+        vols = [volumes[b["Ebs"]["VolumeId"]] for b in instance.get("BlockDeviceMappings",[]) if "Ebs" in b and b["Ebs"]["VolumeId"] in volumes]
+        for key in sorted({v["KmsKeyId"] for v in vols if v.get("KmsKeyId")}):
+            meta = keys[key]
+            if "error" in meta:
+                check["errors"].append(f'unable to describe kms key {key}: {meta["error"]}')
+            elif meta["KeyManager"] == "AWS":
+                check["errors"].append(f"volumes are encrypted with the AWS managed kms key {key}, it can't be shared")
+            elif meta["KeyState"] != "Enabled":
+                check["errors"].append(f'kms key {key} is {meta["KeyState"]}')
+        # AN AMI REGISTERED FROM SNAPSHOTS LOSES THE BILLING PRODUCT AND MARKETPLACE CODES OF THE SOURCE
+        billed = instance.get("Platform") == "windows" or instance.get("UsageOperation","RunInstances") != "RunInstances"
+        # A CUTOVER ALWAYS REGISTERS FROM THE DELTA SNAPSHOTS, PRESTAGING SUCH AN INSTANCE WOULD BE WASTED
+        if (spec["mode"] == "snapshot" or phase in ("prestage","cutover")) and (billed or instance.get("ProductCodes")):
+            billing = "marketplace product codes" if instance.get("ProductCodes") else instance.get("PlatformDetails","Windows")
+            check["errors"].append(f"the instance is billed for {billing}, an AMI registered from snapshots drops that, use mode ami and phase full")
+        elif instance.get("ProductCodes"):
+            check["warnings"].append("the instance carries marketplace product codes, copying its AMI across accounts can be refused")
+        disks,store_gib = stores.get(instance["InstanceType"],(0,0))
+        if disks and not spec["staging_bucket"]:
+            check["warnings"].append(f"{disks} instance store disks ({store_gib} GB) aren't copied, their data is lost at the stop unless staging_bucket is set")
+        elif disks and ssm_error:
+            check["errors"].append(f"unable to check SSM for staging the instance store: {ssm_error}")
+        elif disks and managed.get(spec["instance_id"]) != "Online":
+            check["errors"].append(f'the instance store can\'t be staged, {spec["instance_id"]} isn\'t online in SSM ({managed.get(spec["instance_id"],"not registered")})')
+        check["plan"].update(
+            source_type=instance["InstanceType"],
+            instance_type=spec["instance_type"] or instance["InstanceType"],
+            volumes=len(vols),
+            gib=sum(v["Size"] for v in vols),
+            encrypted=any(v.get("KmsKeyId") for v in vols),
+            src_account=src_account,
+            # (DISKS, GB) STAGED ACROSS, NOTHING WITHOUT A staging_bucket
+            store=(disks,store_gib) if spec["staging_bucket"] else (0,0),
+        )
+
+def preflight_destination(session,specs,checks):
+    """
+    check subnets, security groups, instance type offerings, dedicated hosts, kms keys and
+    on demand vCPU quota headroom for every spec landing in one account/region
+    """
+    client = get_client(session,'ec2')
+    dst_account = get_account_id(session)
+    specs = [s for s in specs if checks[s["instance_id"]]["plan"]]
+    # PREFLIGHT READS LIVE STATE, A CACHED INVENTORY CAN MISS NEW SUBNETS OR KEEP DELETED ONES
+    inventory = get_network_inventory(session,fresh=True)
+    subnets = {s["SubnetId"]: s for v in inventory for s in v["Subnets"]}
+    sgs = {g["GroupId"]: g for v in inventory for g in v["SecurityGroups"]}
+    types = sorted({t for s in specs for t in launch_candidates(s,s["instance_type"] or checks[s["instance_id"]]["plan"]["source_type"])[0]})
+    offered = set()
+    for chunk in chunks(types):
+        pages = client.get_paginator('describe_instance_type_offerings').paginate(LocationType='availability-zone',Filters=[{"Name": "instance-type","Values": chunk}])
+        offered.update((o["InstanceType"],o["Location"]) for page in pages for o in page["InstanceTypeOfferings"])
+    vcpus,stores = {},{}
+    known = sorted({t for t,_ in offered})
+    for chunk in chunks(known,100):
+        for page in client.get_paginator('describe_instance_types').paginate(InstanceTypes=chunk):
+            vcpus.update({t["InstanceType"]: t["VCpuInfo"]["DefaultVCpus"] for t in page["InstanceTypes"]})
+            stores.update({t["InstanceType"]: (sum(d["Count"] for d in (t.get("InstanceStorageInfo") or {}).get("Disks",[])),(t.get("InstanceStorageInfo") or {}).get("TotalSizeInGB",0)) for t in page["InstanceTypes"]})
+    host_ids = sorted({s["host"] for s in specs if s["deploy_type"] == "dedicated host" and s["host"]})
+    hosts,host_error = {},None
+    if host_ids:
+        try:
+            hosts = {h["HostId"]: h for h in client.describe_hosts(HostIds=host_ids)["Hosts"]}
+        except Exception as e:
+            host_error = str(e)
+    subnet_use,host_use,quota_use,catalogs = {},{},{},{}
+    for spec in specs:
+        check = checks[spec["instance_id"]]
+        plan = check["plan"]
+        # A FAN-OUT TARGET COLLECTS ITS OWN ERRORS AND WARNINGS, THEY ARE FOLDED INTO THE INSTANCE'S CHECK BELOW
+        errors = [] if "target" in spec else check["errors"]
+        warnings = [] if "target" in spec else check["warnings"]
+        instance_type = spec["instance_type"] or plan["source_type"]
+        subnet = subnets.get(spec["subnet"])
+        sg = sgs.get(spec["security_group"])
+        types,candidates = launch_candidates(spec,instance_type)
+        for subnet_id in candidates:
+            if subnet_id not in subnets:
+                errors.append(f'subnet {subnet_id} doesn\'t exist in {dst_account} {spec["dst_region"]}')
+            elif sg and sg["VpcId"] != subnets[subnet_id]["VpcId"]:
+                errors.append(f'security group {spec["security_group"]} is in {sg["VpcId"]} but subnet {subnet_id} is in {subnets[subnet_id]["VpcId"]}')
+        if not sg:
+            errors.append(f'security group {spec["security_group"]} doesn\'t exist in {dst_account} {spec["dst_region"]}')
+        zones = [subnets[c]["AvailabilityZone"] for c in candidates if c in subnets]
+        if subnet:
+            if "target" not in spec:
+                plan["az"] = subnet["AvailabilityZone"]
+            subnet_use.setdefault(spec["subnet"],[]).append(check)
+            # WITH FALLBACKS THE FIRST CHOICE BEING UNAVAILABLE IS ONLY A PROBLEM IF NOTHING ELSE IS OFFERED
+            if (instance_type,subnet["AvailabilityZone"]) not in offered:
+                if any((t,z) in offered for t in types for z in zones):
+                    warnings.append(f'{instance_type} isn\'t offered in {subnet["AvailabilityZone"]}, the launch will fall back')
+                else:
+                    errors.append(f'{instance_type} isn\'t offered in {subnet["AvailabilityZone"]}')
+        for fallback in types[1:]:
+            if zones and not any((fallback,z) in offered for z in zones):
+                warnings.append(f'fallback type {fallback} isn\'t offered in any of the subnets\' zones')
+        # THE STAGED INSTANCE STORE HAS TO FIT WHICHEVER TYPE THE LAUNCH ENDS UP WITH
+        disks,store_gib = plan["store"]
+        for candidate in types if disks else []:
+            if candidate in stores and (stores[candidate][0] < disks or stores[candidate][1] < store_gib):
+                errors.append(f"{candidate} has {stores[candidate][0]} instance store disks ({stores[candidate][1]} GB), the staged {disks} disks ({store_gib} GB) won't fit")
+        cross_account = plan["src_account"] != dst_account
+        if plan["encrypted"] and not spec["kms"]:
+            errors.append("the instance is encrypted, a destination kms key is required")
+        if spec["src_region"] != spec["dst_region"] and spec["kms"] and cross_account and not spec["region_kms"]:
+            errors.append("region_kms is required for a cross region cross account copy")
+        if spec["kms"]:
+            check_kms_key({"errors": errors,"warnings": warnings},catalogs,session,spec["kms"],dst_account,"kms")
+        if spec["region_kms"]:
+            src_copy = spec_session(spec,"src",spec["dst_region"])
+            check_kms_key({"errors": errors,"warnings": warnings},catalogs,src_copy,spec["region_kms"],plan["src_account"],"region_kms")
+        if spec["deploy_type"] == "dedicated host":
+            host = hosts.get(spec["host"])
+            if not spec["host"]:
+                errors.append("deploy type is dedicated host but no host is set")
+            elif host_error:
+                errors.append(f"unable to describe dedicated hosts: {host_error}")
+            elif not host:
+                errors.append(f'dedicated host {spec["host"]} doesn\'t exist in {spec["dst_region"]}')
+            else:
+                properties = host.get("HostProperties",{})
+                if host.get("State") != "available":
+                    errors.append(f'dedicated host {spec["host"]} is {host.get("State")}')
+                if subnet and host.get("AvailabilityZone") != subnet["AvailabilityZone"]:
+                    errors.append(f'dedicated host {spec["host"]} is in {host.get("AvailabilityZone")} but subnet {spec["subnet"]} is in {subnet["AvailabilityZone"]}')
+                if properties.get("InstanceType") and properties["InstanceType"] != instance_type:
+                    errors.append(f'dedicated host {spec["host"]} only runs {properties["InstanceType"]}, not {instance_type}')
+                elif properties.get("InstanceFamily") and properties["InstanceFamily"] != instance_family(instance_type):
+                    errors.append(f'dedicated host {spec["host"]} runs the {properties["InstanceFamily"]} family, not {instance_family(instance_type)}')
+                host_use.setdefault((spec["host"],instance_type),[]).append(check)
+        # THE SOURCE IS STOPPED BEFORE THE LAUNCH, SO A TELEPORT WITHIN ONE ACCOUNT AND REGION NEEDS NO NEW QUOTA
+        elif instance_type in vcpus and vcpu_quota_code(instance_type) and (cross_account or spec["src_region"] != spec["dst_region"]):
+            quota_use.setdefault(vcpu_quota_code(instance_type),[]).append((check,vcpus[instance_type]))
+        if "target" in spec:
+            check["errors"] += [f'target {spec["target"]}: {e}' for e in errors]
+            check["warnings"] += [f'target {spec["target"]}: {w}' for w in warnings]
+    for subnet_id,planned in subnet_use.items():
+        free = subnets[subnet_id].get("AvailableIpAddressCount")
+        if free is not None and len(planned) > free:
+            for check in distinct(planned):
+                check["errors"].append(f"{len(planned)} instances are planned into {subnet_id} but it only has {free} free addresses")
+    for (host_id,instance_type),planned in host_use.items():
+        capacity = hosts[host_id].get("AvailableCapacity",{}).get("AvailableInstanceCapacity",[])
+        free = next((c["AvailableCapacity"] for c in capacity if c["InstanceType"] == instance_type),None)
+        if free is not None and len(planned) > free:
+            for check in distinct(planned):
+                check["errors"].append(f"{len(planned)} {instance_type} instances are planned onto {host_id} but it only has room for {free}")
+    if quota_use:
+        check_vcpu_quotas(session,quota_use)
+
+def check_vcpu_quotas(session,quota_use):
+    """
+    compare the vCPUs a region already runs on demand plus the planned ones against each quota
+    """
+    in_use = {}
+    pages = get_client(session,'ec2').get_paginator('describe_instances').paginate(Filters=[{"Name": "instance-state-name","Values": ["pending","running"]}])
+    for instance in (i for page in pages for r in page["Reservations"] for i in r["Instances"]):
+        if instance.get("InstanceLifecycle") == "spot" or instance.get("Placement",{}).get("Tenancy") == "host":
+            continue
+        code = vcpu_quota_code(instance["InstanceType"])
+        cpu = instance.get("CpuOptions",{})
+        in_use[code] = in_use.get(code,0) + cpu.get("CoreCount",1) * cpu.get("ThreadsPerCore",1)
+    quotas = get_client(session,'service-quotas')
+    for code,planned in quota_use.items():
+        needed = sum(v for _,v in planned)
+        try:
+            limit = quotas.get_service_quota(ServiceCode='ec2',QuotaCode=code)["Quota"]["Value"]
+        except Exception as e:
+            for check in distinct(c for c,_ in planned):
+                check["warnings"].append(f"unable to read vCPU quota {code} in {session.region_name}, headroom wasn't checked: {e}")
+            continue
+        if in_use.get(code,0) + needed > limit:
+            for check in distinct(c for c,_ in planned):
+                check["errors"].append(f"the batch needs {needed} more vCPUs of quota {code} but {in_use.get(code,0)} of {int(limit)} are already in use")
+
+def preflight(specs,phase="full"):
+    """
+    validate every planned teleport up front, returns one check per spec with the resolved plan,
+    errors that would fail the teleport and warnings
+    """
+    log(f"Preflight checks for {len(specs)} instances")
+    checks = {s["instance_id"]: {"spec": s,"plan": {},"errors": [],"warnings": []} for s in specs}
+    sources = group_specs(specs,"src_profile","src_role","role_name","external_id","src_region")
+    destinations = group_specs([t for s in specs for t in expand_targets(s)],"dst_profile","dst_role","role_name","external_id","dst_region")
+    with ThreadPoolExecutor(max_workers=max(len(sources),len(destinations),1)) as pool:
+        list(pool.map(lambda group: preflight_sources(spec_session(group[0],"src",group[0]["src_region"]),group,checks,phase),sources.values()))
+        list(pool.map(lambda group: preflight_destination(spec_session(group[0],"dst",group[0]["dst_region"]),group,checks),destinations.values()))
+    return list(checks.values())
+
+def report_preflight(checks):
+    """
+    print the consolidated plan, returns the number of teleports that would fail
+    """
+    print(f'{"instance":<20} {"route":<24} {"type":<12} {"az":<12} {"deploy":<18} {"mode":<8} {"volumes":<13} {"kms":<8} status')
+    for c in checks:
+        spec,plan = c["spec"],c["plan"]
+        route = f'{spec["src_region"]} -> {len(spec["targets"])} targets' if spec.get("targets") else f'{spec["src_region"]} -> {spec["dst_region"]}'
+        volumes = f'{plan.get("volumes","-")} / {plan.get("gib","-")} GiB' + (f' +{plan["store"][0]} store' if plan.get("store",(0,0))[0] else "")
+        status = "FAIL" if c["errors"] else "warn" if c["warnings"] else "ok"
+        print(f'{spec["instance_id"]:<20} {route:<24} {plan.get("instance_type","-"):<12} {plan.get("az","-"):<12} {spec["deploy_type"]:<18} {spec["mode"]:<8} {volumes:<13} {"yes" if spec["kms"] else "no":<8} {status}')
+        for error in c["errors"]:
+            print(f"    error: {error}")
+        for warning in c["warnings"]:
+            print(f"    warning: {warning}")
+    failed = len([c for c in checks if c["errors"]])
+    log(f'preflight: {len(checks) - failed}/{len(checks)} teleports ready, {sum(c["plan"].get("gib",0) for c in checks)} GiB of volumes to copy')
+    return failed
+
+JOURNAL_DIR = os.path.join(CACHE_DIR,"journal")
+
+def configure_journal(path):
+    global JOURNAL_DIR
+    JOURNAL_DIR = path
+
+class Journal:
+    """
+    durable checkpoint file for one teleport, rewritten atomically after every step so a
+    crashed run can be resumed and the grants it created revoked
+    """
+    def __init__(self,path,data):
+        self.path = path
+        self.data = data
+        self.lock = Lock()
+
+    @staticmethod
+    def path_for(instance_id):
+        return os.path.join(JOURNAL_DIR,f'{instance_id}.json')
+
+    @classmethod
+    def start(cls,instance_id,spec=None):
+        path = cls.path_for(instance_id)
+        previous = cls.load(path) if os.path.exists(path) else None
+        if previous:
+            # A NEW RUN REPLACES THE OLD JOURNAL, DON'T LOSE TRACK OF ITS GRANTS
+            revoke_journal_grants(previous)
+        journal = cls(path,{"instance_id": instance_id,"spec": spec,"status": "running","completed": [],"checkpoint": {},"grants": [],"started": datetime.now().isoformat(),"updated": None})
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls,path):
+        with open(path) as f:
+            return cls(path,json.load(f))
+
+    @classmethod
+    def all(cls):
+        if not os.path.isdir(JOURNAL_DIR):
+            return []
+        return [cls.load(os.path.join(JOURNAL_DIR,name)) for name in sorted(os.listdir(JOURNAL_DIR)) if name.endswith(".json")]
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path),exist_ok=True)
+            self.data["updated"] = datetime.now().isoformat()
+            tmp = self.path + ".tmp"
+            with open(tmp,'w') as f:
+                json.dump(self.data,f,indent=2,default=str)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp,self.path)
+
+    def record(self,**values):
+        self.data["checkpoint"].update(values)
+        self.save()
+
+    def complete(self,stage):
+        self.data["completed"].append(stage)
+        self.save()
+
+    def add_grant(self,grant_id,key,session):
+        self.data["grants"].append({"grant_id": grant_id,"key": key,"profile": session_key(session),"identity": list(session.teleport_identity),"region": session.region_name,"revoked": False})
+        self.save()
+
+    def set_spec(self,spec):
+        self.data["spec"] = spec
+        self.save()
+
+    def finish(self,status):
+        self.data["status"] = status
+        self.save()
+
+def revoke_journal_grants(journal):
+    # GRANTS THIS PROCESS SHARES ARE RELEASED, THE MANAGER REVOKES THEM WITH THEIR LAST USER.
+    # ANYTHING ELSE WAS LEFT BY A RUN THAT DIED AND IS REVOKED HERE
+    released = grant_manager.release(journal.data["instance_id"])
+    for grant in journal.data["grants"]:
+        if grant["revoked"]:
+            continue
+        if grant["grant_id"] in released:
+            grant["revoked"] = released[grant["grant_id"]]
+            continue
+        try:
+            log(f'Revoking grant {grant["grant_id"]} on {grant["key"]} left by {journal.data["instance_id"]}')
+            profile,role,external_id = grant.get("identity") or (grant["profile"],None,None)
+            get_client(get_session(profile,grant["region"],role,external_id),'kms').revoke_grant(KeyId=grant["key"],GrantId=grant["grant_id"])
+        except Exception as e:
+            if "NotFound" not in str(e):
+                log(f'unable to revoke grant {grant["grant_id"]}: {e}')
+                continue
+        grant["revoked"] = True
+    journal.save()
+
+def cleanup_grants():
+    journals = Journal.all()
+    for journal in journals:
+        revoke_journal_grants(journal)
+    log(f"Checked grants in {len(journals)} journals")
+
+def journaled_image(session,ami):
+    # AN IMAGE FROM THE JOURNAL MAY HAVE BEEN CLEANED UP SINCE
+    if not ami:
+        return None
+    images = get_client(session,'ec2').describe_images(Filters=[{"Name": "image-id","Values": [ami]}])["Images"]
+    return ami if images and images[0]["State"] in ("pending","available") else None
+
+def protected_artifacts():
+    # ANYTHING AN UNFINISHED TELEPORT STILL NEEDS, PRESTAGED SEEDS INCLUDED
+    ids = set()
+    for journal in Journal.all():
+        if journal.data["status"] in ("teleported","aborted"):
+            continue
+        checkpoint = journal.data["checkpoint"]
+        ids.update(v for k,v in checkpoint.items() if k in ("original_ami","ami") and v)
+        ids.update(checkpoint.get("snapshot_copies",{}).values())
+        ids.update(checkpoint.get("copies",{}).values())
+        for name in ("seed","delta"):
+            entry = checkpoint.get(name) or {}
+            ids.update(entry.get("source",{}).values())
+            ids.update(entry.get("copies",{}).values())
+    return ids
+
+# A RUNNING JOURNAL THAT HASN'T BEEN WRITTEN FOR THIS LONG BELONGS TO A RUN THAT DIED
+JOURNAL_STALE_AFTER = 3 * 24 * 3600
+
+def oldest_running_teleport():
+    """
+    the oldest local journal that is still running, cleanup keeps everything made since it started
+    """
+    # TELEPORTS OF OTHER PROCESSES, HOSTS OR --journal-dir ARE INVISIBLE HERE, ANYTHING MADE SINCE THE
+    # OLDEST LOCAL ONE STARTED MAY BELONG TO ONE OF THEM. A JOURNAL WITHOUT A SPEC NEVER GOT PAST THE
+    # PROMPTS OR ITS IMAGES ARE PROTECTED BY ID, AND A STALE ONE WON'T RESUME ON ITS OWN
+    now = datetime.now().astimezone()
+    running = []
+    for journal in Journal.all():
+        if journal.data["status"] != "running" or not journal.data.get("spec") or not journal.data.get("started"):
+            continue
+        updated = datetime.fromisoformat(journal.data.get("updated") or journal.data["started"]).astimezone()
+        if (now - updated).total_seconds() > JOURNAL_STALE_AFTER:
+            continue
+        running.append(journal)
+    return min(running,key=lambda j: datetime.fromisoformat(j.data["started"]).astimezone(),default=None)
+
+def in_flight(artifact,created,since):
+    # A PENDING IMAGE OR SNAPSHOT IS STILL BEING MADE BY SOMEONE
+    if artifact["State"] == "pending":
+        return True
+    if isinstance(created,str):
+        created = datetime.fromisoformat(created.replace("Z","+00:00"))
+    return bool(since and created and created >= since)
+
+def find_teleport_artifacts(session,region):
+    """
+    TELEPORT-* images owned by the account in region with their snapshots, plus snapshots
+    the teleporter copied or took on its own and its launch templates
+    """
+    client = get_client(session,'ec2',region_name=region)
+    images = client.describe_images(Owners=["self"],Filters=[{"Name": "name","Values": ["TELEPORT-*"]}])["Images"]
+    def sweep(filters):
+        pages = client.get_paginator('describe_snapshots').paginate(OwnerIds=["self"],Filters=filters)
+        return {s["SnapshotId"]: s for page in pages for s in page["Snapshots"]}
+    owned = sweep([{"Name": "description","Values": ["TELEPORT-*"]}])
+    image_snapshots = [m["Ebs"]["SnapshotId"] for i in images for m in i["BlockDeviceMappings"] if "Ebs" in m and "SnapshotId" in m["Ebs"]]
+    for i in range(0,len(image_snapshots),200):
+        owned.update(sweep([{"Name": "snapshot-id","Values": image_snapshots[i:i + 200]}]))
+    pages = client.get_paginator('describe_launch_templates').paginate(Filters=[{"Name": "launch-template-name","Values": ["TELEPORT-*"]}])
+    templates = [t for page in pages for t in page["LaunchTemplates"]]
+    return {"region": region,"images": images,"snapshots": list(owned.values()),"templates": templates}
+
+def cleanup_artifacts(session,regions,dry_run=False):
+    """
+    find and delete teleport AMIs and snapshots in every region in parallel, returns a per region report
+    """
+    protected = protected_artifacts()
+    oldest = oldest_running_teleport()
+    since = datetime.fromisoformat(oldest.data["started"]).astimezone() if oldest else None
+    if oldest:
+        log(f'Keeping teleport artifacts made since {since.isoformat()}, when the running teleport of {oldest.data["instance_id"]} started')
+    def clean(region):
+        # A REGION THE ACCOUNT CAN'T READ (OPT-IN, SCP DENIED) IS REPORTED, THE OTHERS ARE STILL CLEANED
+        try:
+            found = find_teleport_artifacts(session,region)
+        except Exception as e:
+            return {"region": region,"images": 0,"snapshots": 0,"templates": 0,"gb": 0,"failed": {region: str(e)},"skipped": 0}
+        images = [i for i in found["images"] if i["ImageId"] not in protected and not in_flight(i,i.get("CreationDate"),since)]
+        # THE SNAPSHOTS OF A KEPT IMAGE ARE KEPT WITH IT
+        kept = protected | {m["Ebs"]["SnapshotId"] for i in found["images"] if i not in images for m in i["BlockDeviceMappings"] if "Ebs" in m and "SnapshotId" in m["Ebs"]}
+        snapshots = [s for s in found["snapshots"] if s["SnapshotId"] not in kept and not in_flight(s,s.get("StartTime"),since)]
+        report = {"region": region,"images": len(images),"snapshots": len(snapshots),"templates": len(found["templates"]),"gb": snapshots_gb(snapshots),"failed": {},"skipped": len(found["images"]) + len(found["snapshots"]) - len(images) - len(snapshots)}
+        if dry_run:
+            for image in images:
+                print(f'{region:<16} would remove {image["ImageId"]} {image["Name"]}')
+            for snapshot in snapshots:
+                print(f'{region:<16} would remove {snapshot["SnapshotId"]} {snapshots_gb([snapshot])} GB')
+            for template in found["templates"]:
+                print(f'{region:<16} would remove {template["LaunchTemplateId"]} {template["LaunchTemplateName"]}')
+            return report
+        client = get_client(session,'ec2',region_name=region)
+        # A TEMPLATE HOLDS NO DATA, A RUN THAT STILL NEEDS ONE SIMPLY CREATES IT AGAIN
+        for template in found["templates"]:
+            try:
+                with_retries(lambda: client.delete_launch_template(LaunchTemplateId=template["LaunchTemplateId"]))
+            except Exception as e:
+                report["failed"][template["LaunchTemplateId"]] = str(e)
+        # IMAGES FIRST, A SNAPSHOT CAN'T BE DELETED WHILE A REGISTERED IMAGE USES IT
+        held = set()
+        for image in images:
+            log(f'Removing AMI - {image["ImageId"]} in {region}')
+            try:
+                with_retries(lambda: client.deregister_image(ImageId=image["ImageId"]))
+            except Exception as e:
+                report["failed"][image["ImageId"]] = str(e)
+                held.update(m["Ebs"]["SnapshotId"] for m in image["BlockDeviceMappings"] if "Ebs" in m and "SnapshotId" in m["Ebs"])
+        # THE SNAPSHOTS OF AN IMAGE THAT IS STILL REGISTERED ARE LEFT FOR THE NEXT SWEEP
+        snapshots = [s for s in snapshots if s["SnapshotId"] not in held]
+        report["failed"].update(delete_snapshots(session,[s["SnapshotId"] for s in snapshots],region=region,raise_errors=False))
+        report["gb"] = snapshots_gb([s for s in snapshots if s["SnapshotId"] not in report["failed"]])
+        return report
+    with ThreadPoolExecutor(max_workers=max(len(regions),1)) as pool:
+        return list(pool.map(clean,regions))
+
+def report_cleanup(reports,dry_run=False):
+    verb = "would free" if dry_run else "freed"
+    for r in reports:
+        if r["images"] or r["snapshots"] or r["templates"] or r["skipped"] or r["failed"]:
+            print(f'{r["region"]:<16} {r["images"]} AMIs, {r["snapshots"]} snapshots, {r["templates"]} launch templates, {verb} {r["gb"]} GB, {len(r["failed"])} failed, {r["skipped"]} kept for unfinished teleports')
+            for id,e in r["failed"].items():
+                print(f"    {id}: {e}")
+    log(f'{sum(r["images"] for r in reports)} AMIs and {sum(r["snapshots"] for r in reports)} snapshots, {verb} {round(sum(r["gb"] for r in reports),1)} GB')
+
+def run_cleanup(profiles=None,regions=None,dry_run=False,identity=None):
+    """
+    sweep every profile, and every side of identity that assumes a role. with no profiles and
+    no roles the src profile is swept
+    """
+    identity = {**MANIFEST_DEFAULTS, **(identity or {})}
+    targets = [(f"profile {profile}",{**identity,"src_profile": profile,"src_role": None}) for profile in profiles or []]
+    targets += [(f'role {identity[f"{side}_role"]}',{**identity,"src_profile": identity[f"{side}_profile"],"src_role": identity[f"{side}_role"]}) for side in ("src","dst") if identity[f"{side}_role"]]
+    for name,spec in targets or [(f'profile {identity["src_profile"]}',identity)]:
+        session = spec_session(spec,"src",None)
+        if not regions:
+            regions = cached_discovery(session,"regions",lambda: [r["RegionName"] for r in get_client(session,'ec2',region_name="us-east-1").describe_regions()["Regions"]],region="global")
+        log(f"Looking for teleport artifacts of {name} in {len(regions)} regions")
+        report_cleanup(cleanup_artifacts(session,regions,dry_run),dry_run)
+
+def new_job(spec,journal=None,phase="full"):
+    if spec.get("targets") and phase != "full":
+        raise TeleportError(f'{spec["instance_id"]} fans out to several targets, which only the full phase supports')
+    job = {
+        "spec": spec,
+        "phase": phase,
+        "stages": FANOUT_STAGES if spec.get("targets") else PHASES[phase],
+        "journal": journal or Journal.start(spec["instance_id"],spec),
+        "result": {"instance_id": spec["instance_id"], "state": "pending", "stage": None, "new_instance_id": None, "error": None, "duration": None, "downtime": None},
+    }
+    job["journal"].data.update(phase=phase,status="running")
+    job["journal"].save()
+    # PICK UP WHATEVER A PREVIOUS RUN ALREADY FINISHED
+    checkpoint = job["journal"].data["checkpoint"]
+    for field in ("original_ami","ami","original_mappings","mappings","copies","region_mappings"):
+        if checkpoint.get(field):
+            job[field] = checkpoint[field]
+    job["result"]["new_instance_id"] = checkpoint.get("new_instance_id")
+    job["skip"] = set(job["journal"].data["completed"]) & set(RESUMABLE_STAGES)
+    return job
+
+def add_grant(job,grant_id,key,session):
+    job["journal"].add_grant(grant_id,key,session)
+
+def stage_prepare(job):
+    spec = job["spec"]
+    instance_id = spec["instance_id"]
+    (job["src_pro"],job["src_copy_pro"],job["dst_pro"]) = get_batch_sessions(spec)
+    (job["src_account"],job["dst_account"]) = get_account_ids([job["src_pro"],job["dst_pro"]])
+    job["x_region"] = spec["src_region"] != spec["dst_region"]
+    instance,grant_ids,keys,encrypted = describe_instance(job["src_pro"],job["dst_pro"],instance_id)
+    job["instance"] = instance
+    for grant_id,key,sess in grant_ids:
+        add_grant(job,grant_id,key,sess)
+    if encrypted and not spec["kms"]:
+        raise TeleportError(f"{instance_id} is encrypted, a destination kms key is required")
+    job["region_kms"] = False
+    if job["x_region"] and spec["kms"] and job["src_account"] != job["dst_account"]:
+        if not spec["region_kms"]:
+            raise TeleportError(f"{instance_id} needs region_kms for a cross region cross account copy")
+        job["region_kms"] = spec["region_kms"]
+        add_grant(job,grant_manager.acquire(job["src_copy_pro"],spec["region_kms"],job["dst_account"],instance_id),spec["region_kms"],job["src_copy_pro"])
+    prepare_instance_store(job)
+
+def prepare_instance_store(job):
+    spec = job["spec"]
+    job["instance_store"] = 0
+    if spec["staging_bucket"]:
+        instance_type = job["instance"]["InstanceType"]
+        job["instance_store"] = instance_store_disks(job["src_pro"],[instance_type])[instance_type][0]
+
+def hold_and_stage_ephemeral(job):
+    # INSTANCE STORE DATA IS GONE ONCE THE INSTANCE STOPS, SO THE STOP STAGE STAGES IT RIGHT BEFORE THE
+    # STOP. A STAGING WHOSE STOP NEVER CAME HAS BEEN RELEASED SINCE AND IS DONE AGAIN
+    spec,journal = job["spec"],job["journal"]
+    if not job["instance_store"]:
+        return
+    entry = {"url": staging_url(spec),"disks": job["instance_store"],"restored": [],"staged": False}
+    journal.record(ephemeral=entry)
+    stage_instance_store(job["src_pro"],spec["instance_id"],entry["url"],entry["disks"])
+    journal.record(ephemeral={**entry,"staged": True})
+
+def release_ephemeral(job):
+    # A TELEPORT THAT STAGED THE INSTANCE STORE BUT NEVER STOPPED THE SOURCE MUST NOT LEAVE ITS
+    # FILESYSTEMS READ ONLY OR FROZEN
+    spec,checkpoint = job["spec"],job["journal"].data["checkpoint"]
+    if not checkpoint.get("ephemeral") or checkpoint.get("stopped"):
+        return
+    try:
+        release_instance_store(spec_session(spec,"src",spec["src_region"]),spec["instance_id"])
+    except Exception as e:
+        log(f"unable to release the instance store filesystems of {spec['instance_id']}, the watchdog releases them {STAGING_HOLD // 60} minutes after staging: {e}")
+
+def restore_ephemeral(job,launches):
+    """
+    restore the staged instance store onto every (name, session, instance id) in launches in parallel
+    """
+    journal = job["journal"]
+    entry = journal.data["checkpoint"].get("ephemeral")
+    if not entry or not entry.get("staged"):
+        return
+    restored = set(entry["restored"])
+    restore_lock = Lock()
+    def restore(launch):
+        name,session,instance_id = launch
+        if name in restored:
+            return
+        restore_instance_store(session,instance_id,entry["url"],entry["disks"])
+        with restore_lock:
+            restored.add(name)
+            journal.record(ephemeral={**entry,"restored": sorted(restored)})
+    with ThreadPoolExecutor(max_workers=max(len(launches),1)) as pool:
+        list(pool.map(restore,launches))
+
+def stage_restore(job):
+    restore_ephemeral(job,[(job["result"]["new_instance_id"],job["dst_pro"],job["result"]["new_instance_id"])])
+
+def remove_staging(job):
+    entry = job["journal"].data["checkpoint"].get("ephemeral")
+    if entry and not entry.get("removed"):
+        delete_staging(job["src_pro"],entry["url"])
+        job["journal"].record(ephemeral={**entry,"removed": True})
+
+def copy_key(job):
+    return job["region_kms"] if job["region_kms"] else job["spec"]["kms"]
+
+def snapshot_and_copy(job,name):
+    """
+    snapshot the instance as it is now and copy the snapshots to the destination region,
+    journaled under name so an interrupted run only redoes what is missing
+    """
+    spec,journal = job["spec"],job["journal"]
+    entry = journal.data["checkpoint"].get(name) or {}
+    if entry.get("done"):
+        return entry
+    if not entry.get("source"):
+        log(f"Snapshotting volumes of {spec['instance_id']} ({name})")
+        entry = {"source": snapshot_instance(job["src_pro"],job["instance"],f"TELEPORT-{name.upper()}-{spec['instance_id']}",poller=get_poller(job["src_pro"])),"copies": {}}
+        journal.record(**{name: entry})
+    if job["x_region"]:
+        def on_copy(device,copied):
+            entry["copies"][device] = copied
+            journal.record(**{name: entry})
+        copy_snapshots(job["src_copy_pro"],entry["source"],spec["src_region"],spec["dst_region"],copy_key(job),poller=get_poller(job["src_copy_pro"]),existing=entry["copies"],on_copy=on_copy)
+    entry["done"] = True
+    journal.record(**{name: entry})
+    return entry
+
+def stage_seed(job):
+    # COPY THE VOLUMES ONCE WHILE THE INSTANCE IS STILL RUNNING SO THE COPIES MADE AFTER
+    # THE STOP ONLY HAVE TO MOVE THE BLOCKS THAT CHANGED SINCE
+    if job["spec"]["seed"] and job["spec"]["mode"] == "snapshot" and job["x_region"]:
+        snapshot_and_copy(job,"seed")
+
+def stage_prestage(job):
+    # NO REBOOT, CRASH CONSISTENT SNAPSHOTS OF THE RUNNING INSTANCE PRE-COPIED TO THE DESTINATION
+    snapshot_and_copy(job,"seed")
+    log(f"{job['spec']['instance_id']} is prestaged, it is still running")
+
+def stage_delta(job):
+    # AFTER THE STOP ONLY THE BLOCKS WRITTEN SINCE THE PRESTAGE ARE SNAPSHOT AND COPIED
+    spec,journal = job["spec"],job["journal"]
+    if not (journal.data["checkpoint"].get("seed") or {}).get("done"):
+        raise TeleportError(f"{spec['instance_id']} hasn't been prestaged, run --phase prestage first")
+    poller = get_poller(job["src_copy_pro"])
+    if journaled_image(job["src_copy_pro"],job.get("ami")):
+        poller.wait("image",job["ami"],"available")
+    else:
+        delta = snapshot_and_copy(job,"delta")
+        snapshots = delta["copies"] if job["x_region"] else delta["source"]
+        job["ami"] = register_from_snapshots(job["src_copy_pro"],image_from_instance(job["instance"]),snapshots,f"TELEPORT-{spec['instance_id']}-CUTOVER",region=spec["dst_region"])
+        journal.record(ami=job["ami"])
+        poller.wait("image",job["ami"],"available")
+    job["mappings"] = apply_mappings_edits(describe_ami_blockdevicemappings(job["src_copy_pro"],job["ami"]),spec["kms"])
+    journal.record(mappings=job["mappings"])
+
+def stage_stop(job):
+    # DOWNTIME IS MEASURED FROM HERE UNTIL THE NEW INSTANCE IS RUNNING, STAGING THE INSTANCE STORE
+    # INCLUDED SINCE ITS FILESYSTEMS ARE HELD FROM THE START. A SOURCE THAT IS STILL RUNNING WHEN A
+    # RUN IS RESUMED STARTS THE CLOCK AGAIN
+    journal = job["journal"]
+    running = job["instance"]["State"]["Name"] not in ("stopping","stopped")
+    if running or not journal.data["checkpoint"].get("stopped_at"):
+        journal.record(stopped_at=time.time())
+    if running:
+        hold_and_stage_ephemeral(job)
+    stop_instance(job["src_pro"],job["instance"],poller=get_poller(job["src_pro"]))
+    journal.record(stopped=True)
+
+def stage_ami(job):
+    poller = get_poller(job["src_pro"])
+    if journaled_image(job["src_pro"],job.get("original_ami")):
+        poller.wait("image",job["original_ami"],"available")
+    else:
+        job["original_ami"] = create_ami(job["src_pro"],job["instance"],reuse=job["spec"]["reuse_ami"],poller=poller,on_create=lambda ami: job["journal"].record(original_ami=ami))
+        job["journal"].record(original_ami=job["original_ami"])
+    job["original_mappings"] = describe_ami_blockdevicemappings(job["src_pro"],job["original_ami"])
+    job["journal"].record(original_mappings=job["original_mappings"])
+
+def stage_copy(job):
+    spec = job["spec"]
+    poller = get_poller(job["src_copy_pro"])
+    if job["x_region"] and journaled_image(job["src_copy_pro"],job.get("ami")):
+        poller.wait("image",job["ami"],"available")
+    elif spec["mode"] == "snapshot":
+        copies = dict(job["journal"].data["checkpoint"].get("snapshot_copies",{}))
+        def on_copy(name,copied):
+            copies[name] = copied
+            job["journal"].record(snapshot_copies=copies)
+        job["ami"] = copy_ami_by_snapshots(job["src_copy_pro"],job["original_ami"],spec["src_region"],spec["dst_region"],copy_key(job),poller=poller,existing=copies,on_copy=on_copy)
+        job["journal"].record(ami=job["ami"])
+    else:
+        job["ami"] = copy_ami(job["src_copy_pro"],job["original_ami"],spec["src_region"],spec["dst_region"],copy_key(job),reuse=spec["reuse_ami"],poller=poller,on_create=lambda ami: job["journal"].record(ami=ami))
+        job["journal"].record(ami=job["ami"])
+        if job["x_region"]:
+            telemetry.add_bytes(snapshots_bytes(job["src_pro"],job["original_mappings"]),spec["instance_id"])
+    job["mappings"] = apply_mappings_edits(describe_ami_blockdevicemappings(job["src_copy_pro"] if job["x_region"] else job["src_pro"],job["ami"]),spec["kms"])
+    job["journal"].record(mappings=job["mappings"])
+
+def stage_share(job):
+    share_ami(job["src_pro"],job["ami"],job["src_account"],job["dst_account"],job["spec"]["dst_region"])
+
+def launch_token(journal,*parts):
+    # ONE TOKEN PER TELEPORT RUN, TELEPORTING THE SAME INSTANCE AGAIN LATER MUST LAUNCH NEW ONES
+    return "|".join([journal.data["instance_id"],journal.data.get("started",""),*parts])
+
+def stage_launch(job):
+    spec,instance = job["spec"],job["instance"]
+    checkpoint = job["journal"].data["checkpoint"]
+    if not job["result"]["new_instance_id"]:
+        instance_type = spec["instance_type"] or instance["InstanceType"]
+        new_instance = deploy_instance(job["dst_pro"],job["ami"],instance_type,instance["Tags"],job["mappings"],spec["subnet"],spec["security_group"],spec["profile"],spec["host"],spec["deploy_type"],
+            fallback_subnets=as_list(spec["fallback_subnets"]),fallback_types=as_list(spec["fallback_types"]),token=launch_token(job["journal"]))
+        if new_instance == "FAIL":
+            raise TeleportError(f"run_instances returned no instance for {spec['instance_id']}")
+        job["result"]["new_instance_id"] = new_instance
+        job["journal"].record(new_instance_id=new_instance)
+        log(f"{spec['instance_id']} has been teleported to {new_instance}")
+    if checkpoint.get("downtime") is None and checkpoint.get("stopped_at"):
+        get_poller(job["dst_pro"]).wait("instance",job["result"]["new_instance_id"],"running")
+        job["journal"].record(downtime=round(time.time() - checkpoint["stopped_at"],1))
+    job["result"]["downtime"] = checkpoint.get("downtime")
+
+def stage_cleanup(job):
+    spec = job["spec"]
+    checkpoint = job["journal"].data["checkpoint"]
+    if spec["cleanup"]:
+        src_snapshots,copied_snapshots = set(),set()
+        if job.get("ami") and job["ami"] != job.get("original_ami"):
+            copied_snapshots.update(m["Ebs"]["SnapshotId"] for m in job["mappings"] if "Ebs" in m)
+            if not checkpoint.get("removed_ami"):
+                remove_ami(job["src_copy_pro"],job["ami"])
+                job["journal"].record(removed_ami=True)
+        if job.get("original_ami"):
+            src_snapshots.update(m["Ebs"]["SnapshotId"] for m in job["original_mappings"] if "Ebs" in m)
+            if not checkpoint.get("removed_original_ami"):
+                remove_ami(job["src_pro"],job["original_ami"])
+                job["journal"].record(removed_original_ami=True)
+        for name in ("seed","delta"):
+            entry = checkpoint.get(name) or {}
+            src_snapshots.update(entry.get("source",{}).values())
+            copied_snapshots.update(entry.get("copies",{}).values())
+        delete_snapshots(job["src_pro"],src_snapshots)
+        delete_snapshots(job["src_copy_pro"],copied_snapshots - src_snapshots)
+        remove_staging(job)
+    if spec["terminate_source"]:
+        remove_instance(job["src_pro"],spec["src_region"],spec["instance_id"])
+
+def stage_fanout_prepare(job):
+    """
+    fan-out: one source image copied once into every target region, shared with every target
+    account there and launched once per target
+    """
+    spec = job["spec"]
+    instance_id = spec["instance_id"]
+    job["src_pro"] = spec_session(spec,"src",spec["src_region"])
+    job["src_account"] = get_account_id(job["src_pro"])
+    job["targets"] = expand_targets(spec)
+    for target in job["targets"]:
+        target["dst_pro"] = spec_session(target,"dst",target["dst_region"])
+        target["dst_account"] = get_account_id(target["dst_pro"])
+    instance,_,keys,encrypted = describe_instance(job["src_pro"],None,instance_id)
+    job["instance"] = instance
+    for target in job["targets"]:
+        if encrypted and not target["kms"]:
+            raise TeleportError(f'{instance_id} is encrypted, target {target["target"]} needs a destination kms key')
+    # OTHER ACCOUNTS IN THE SOURCE REGION LAUNCH FROM THE ORIGINAL SNAPSHOTS AND NEED THE SOURCE KEYS,
+    # ELSEWHERE THEY LAUNCH FROM THE REGION'S COPY AND NEED THE KEY IT WAS COPIED WITH
+    job["region_keys"] = {}
+    for (region,),targets in group_specs(job["targets"],"dst_region").items():
+        accounts = sorted({t["dst_account"] for t in targets} - {job["src_account"]})
+        if region == spec["src_region"]:
+            job["region_keys"][region] = False
+            for account in accounts:
+                for key in keys:
+                    add_grant(job,grant_manager.acquire(job["src_pro"],key,account,instance_id),key,job["src_pro"])
+            continue
+        region_kms = next((t["region_kms"] for t in targets if t["region_kms"]),False)
+        if accounts and any(t["kms"] for t in targets) and not region_kms:
+            raise TeleportError(f"{instance_id} needs region_kms for the cross account copy to {region}")
+        job["region_keys"][region] = region_kms or next((t["kms"] for t in targets if t["kms"]),False)
+        if region_kms and accounts:
+            src_copy = spec_session(spec,"src",region)
+            for account in accounts:
+                add_grant(job,grant_manager.acquire(src_copy,region_kms,account,instance_id),region_kms,src_copy)
+    prepare_instance_store(job)
+
+def stage_fanout_copy(job):
+    spec,journal = job["spec"],job["journal"]
+    copies = dict(journal.data["checkpoint"].get("copies",{}))
+    copied = []
+    copy_lock = Lock()
+    def on_create(region,ami):
+        with copy_lock:
+            copies[region] = ami
+            journal.record(copies=dict(copies))
+    def copy(region):
+        if region == spec["src_region"]:
+            return region,job["original_ami"]
+        session = spec_session(spec,"src",region)
+        poller = get_poller(session)
+        if journaled_image(session,copies.get(region)):
+            poller.wait("image",copies[region],"available")
+            return region,copies[region]
+        # THE GOVERNOR'S CopyImage SLOTS KEEP EVERY REGION WITHIN ITS CONCURRENT COPY LIMIT
+        ami = copy_ami(session,job["original_ami"],spec["src_region"],region,job["region_keys"][region],reuse=spec["reuse_ami"],poller=poller,on_create=lambda ami: on_create(region,ami))
+        on_create(region,ami)
+        copied.append(region)
+        return region,ami
+    with ThreadPoolExecutor(max_workers=len(job["region_keys"])) as pool:
+        job["copies"] = dict(pool.map(copy,job["region_keys"]))
+    if copied:
+        size = snapshots_bytes(job["src_pro"],job["original_mappings"])
+        for region in copied:
+            telemetry.add_bytes(size,spec["instance_id"])
+    job["region_mappings"] = {region: describe_ami_blockdevicemappings(spec_session(spec,"src",region),ami) for region,ami in job["copies"].items()}
+    journal.record(copies=job["copies"],region_mappings=job["region_mappings"])
+
+def stage_fanout_share(job):
+    spec = job["spec"]
+    def share(item):
+        region,ami = item
+        accounts = [t["dst_account"] for t in job["targets"] if t["dst_region"] == region]
+        share_ami(spec_session(spec,"src",region),ami,job["src_account"],accounts,region)
+    with ThreadPoolExecutor(max_workers=len(job["copies"])) as pool:
+        list(pool.map(share,job["copies"].items()))
+
+def stage_fanout_launch(job):
+    instance,journal = job["instance"],job["journal"]
+    checkpoint = journal.data["checkpoint"]
+    launches = dict(checkpoint.get("launches",{}))
+    launch_lock = Lock()
+    # TARGETS THAT WOULD LAUNCH THE SAME WAY GO OUT AS ONE MULTI-COUNT run_instances
+    groups = group_specs([t for t in job["targets"] if not launches.get(t["target"])],"dst_profile","dst_role","role_name","external_id","dst_region","subnet","security_group","profile",
+        "kms","host","deploy_type","instance_type",*FALLBACK_KEYS)
+    def launch(targets):
+        first = targets[0]
+        region = first["dst_region"]
+        mappings = apply_mappings_edits([dict(m,Ebs=dict(m["Ebs"])) if "Ebs" in m else dict(m) for m in job["region_mappings"][region]],first["kms"])
+        types,subnets = launch_candidates(first,first["instance_type"] or instance["InstanceType"])
+        launched = launch_instances(first["dst_pro"],job["copies"][region],types,instance["Tags"],mappings,subnets,first["security_group"],first["profile"],first["host"],first["deploy_type"],count=len(targets),
+            token=launch_token(journal,*[t["target"] for t in targets]))
+        with launch_lock:
+            for target,new_instance in zip(targets,launched):
+                log(f'{instance["InstanceId"]} has been teleported to {new_instance} ({target["target"]})')
+                launches[target["target"]] = new_instance
+            journal.record(launches=dict(launches))
+        if len(launched) < len(targets):
+            raise TeleportError(f'only {len(launched)} of {len(targets)} instances launched for targets {", ".join(t["target"] for t in targets)}, out of capacity')
+    with ThreadPoolExecutor(max_workers=max(len(groups),1)) as pool:
+        list(pool.map(launch,groups.values()))
+    for target in job["targets"]:
+        get_poller(target["dst_pro"]).wait("instance",launches[target["target"]],"running")
+    # DOWNTIME RUNS UNTIL THE LAST TARGET IS RUNNING
+    if checkpoint.get("downtime") is None and checkpoint.get("stopped_at"):
+        journal.record(downtime=round(time.time() - checkpoint["stopped_at"],1))
+    job["result"]["launches"] = launches
+    job["result"]["new_instance_id"] = ",".join(launches[t["target"]] for t in job["targets"])
+    job["result"]["downtime"] = checkpoint.get("downtime")
+
+def stage_fanout_restore(job):
+    launches = job["journal"].data["checkpoint"].get("launches",{})
+    restore_ephemeral(job,[(t["target"],t["dst_pro"],launches[t["target"]]) for t in job["targets"]])
+
+def stage_fanout_cleanup(job):
+    spec = job["spec"]
+    checkpoint = dict(job["journal"].data["checkpoint"])
+    if spec["cleanup"]:
+        removed = set(checkpoint.get("removed_copies",[]))
+        def clean(item):
+            region,ami = item
+            if region == spec["src_region"] or region in removed:
+                return
+            session = spec_session(spec,"src",region)
+            remove_ami(session,ami)
+            delete_snapshots(session,[m["Ebs"]["SnapshotId"] for m in job["region_mappings"][region] if "Ebs" in m])
+            return region
+        with ThreadPoolExecutor(max_workers=len(job["copies"])) as pool:
+            removed.update(r for r in pool.map(clean,job["copies"].items()) if r)
+        job["journal"].record(removed_copies=sorted(removed))
+        if not checkpoint.get("removed_original_ami"):
+            remove_ami(job["src_pro"],job["original_ami"])
+            job["journal"].record(removed_original_ami=True)
+        delete_snapshots(job["src_pro"],[m["Ebs"]["SnapshotId"] for m in job["original_mappings"] if "Ebs" in m])
+        remove_staging(job)
+    if spec["terminate_source"]:
+        remove_instance(job["src_pro"],spec["src_region"],spec["instance_id"])
+
+def finish_job(job,error=None):
+    result = job["result"]
+    if error:
+        result["state"] = "failed"
+        result["error"] = str(error)
+        log(f"{result['instance_id']} failed during {result['stage']}: {error}")
+        release_ephemeral(job)
+    else:
+        result["state"] = "prestaged" if job["phase"] == "prestage" else "teleported"
+        result["stage"] = "done"
+    revoke_journal_grants(job["journal"])
+    job["journal"].finish(result["state"])
+    result["duration"] = round(time.time() - job["started"],1)
+
+TELEPORT_STAGES = [
+    ("prepare", stage_prepare),
+    ("seed", stage_seed),
+    ("stop", stage_stop),
+    ("ami", stage_ami),
+    ("copy", stage_copy),
+    ("share", stage_share),
+    ("launch", stage_launch),
+    ("restore", stage_restore),
+    ("cleanup", stage_cleanup),
+]
+
+# ONE SOURCE IMAGE, COPIED ONCE PER DESTINATION REGION AND LAUNCHED ONCE PER TARGET
+FANOUT_STAGES = [
+    ("prepare", stage_fanout_prepare),
+    ("stop", stage_stop),
+    ("ami", stage_ami),
+    ("copy", stage_fanout_copy),
+    ("share", stage_fanout_share),
+    ("launch", stage_fanout_launch),
+    ("restore", stage_fanout_restore),
+    ("cleanup", stage_fanout_cleanup),
+]
+
+PHASES = {
+    "full": TELEPORT_STAGES,
+    # PRESTAGE WHILE THE SOURCE KEEPS SERVING, THEN A SHORT CUTOVER THAT ONLY MOVES THE DELTA
+    "prestage": [
+        ("prepare", stage_prepare),
+        ("prestage", stage_prestage),
+    ],
+    "cutover": [
+        ("prepare", stage_prepare),
+        ("stop", stage_stop),
+        ("delta", stage_delta),
+        ("share", stage_share),
+        ("launch", stage_launch),
+        ("restore", stage_restore),
+        ("cleanup", stage_cleanup),
+    ],
+}
+
+# STAGES THAT JOURNAL EVERYTHING LATER STAGES NEED FROM THEM. ONCE ONE COMPLETED, A RESUMED RUN
+# DOESN'T DO IT AGAIN, REDOING ami OR copy AFTER THE CLEANUP STARTED WOULD MAKE IMAGES NOBODY REMOVES
+RESUMABLE_STAGES = ("seed","prestage","ami","copy","delta","share")
+
+# WORKERS PER STAGE, THE STAGES THAT SIT IN WAITERS GET THE MOST
+STAGE_LIMITS = {"prepare": 5, "seed": 20, "prestage": 20, "stop": 20, "ami": 20, "copy": 20, "delta": 20, "share": 5, "launch": 5, "restore": 20, "cleanup": 5}
+
+class Pipeline:
+    """
+    runs jobs through a list of stages, every stage has its own worker pool so an
+    instance stuck in a long stage never holds up another instance in a different stage.
+    a job can bring its own stage list in job["stages"] and the stages to pass over in job["skip"]
+    """
+    def __init__(self,stages,limits=None,concurrency=None,finish=finish_job,on_stage=None):
+        self.limits = {**STAGE_LIMITS, **(limits or {})}
+        self.stages = stages
+        self.finish = finish
+        self.on_stage = on_stage
+        self.pools = {}
+        self.slots = BoundedSemaphore(concurrency) if concurrency else None
+        self.cond = Condition()
+        self.in_flight = 0
+
+    def _pool(self,name):
+        with self.cond:
+            if name not in self.pools:
+                self.pools[name] = ThreadPoolExecutor(max_workers=self.limits.get(name,5),thread_name_prefix=f"teleport-{name}")
+            return self.pools[name]
+
+    def submit(self,job):
+        if self.slots:
+            self.slots.acquire()
+        with self.cond:
+            self.in_flight += 1
+        job.setdefault("started",time.time())
+        stages = job.get("stages") or self.stages
+        self._pool(stages[0][0]).submit(self._run,job,0)
+
+    def _run(self,job,index):
+        stages = job.get("stages") or self.stages
+        name,fn = stages[index]
+        job["result"]["stage"] = name
+        try:
+            if name in job.get("skip",()):
+                log(f'{job["result"]["instance_id"]} already finished {name}')
+            else:
+                with telemetry.stage(name,job["result"]["instance_id"]):
+                    fn(job)
+                if self.on_stage:
+                    self.on_stage(job,name)
+        except Exception as e:
+            return self._done(job,e)
+        if index + 1 < len(stages):
+            self._pool(stages[index + 1][0]).submit(self._run,job,index + 1)
+        else:
+            self._done(job)
+
+    def _done(self,job,error=None):
+        try:
+            self.finish(job,error)
+        finally:
+            if self.slots:
+                self.slots.release()
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+
+    def join(self):
+        with self.cond:
+            while self.in_flight:
+                self.cond.wait()
+        for pool in self.pools.values():
+            pool.shutdown()
+
+def checkpoint_stage(job,name):
+    job["journal"].complete(name)
+
+def run_jobs(jobs,concurrency=None,limits=None):
+    log(f"Teleporting {len(jobs)} instances")
+    pipeline = Pipeline(TELEPORT_STAGES,limits,concurrency,on_stage=checkpoint_stage)
+    for job in jobs:
+        pipeline.submit(job)
+    pipeline.join()
+    delete_launch_templates()
+    return [job["result"] for job in jobs]
+
+def run_batch(specs,concurrency=None,limits=None,phase="full",check=True):
+    if check:
+        failed = report_preflight(preflight(specs,phase))
+        if failed:
+            raise TeleportError(f"preflight failed for {failed} of {len(specs)} instances, nothing was stopped")
+    if phase == "cutover":
+        jobs = cutover_jobs(specs)
+    else:
+        jobs = [new_job(spec,phase=phase) for spec in specs]
+    return run_jobs(jobs,concurrency,limits)
+
+def teleport(plan,phase="full",limits=None,check=True):
+    """
+    teleport one instance without prompting, plan is a dict or plan file path, see load_plan.
+    returns the result that batch mode reports, a failed teleport is returned, not raised.
+    a plan that fails preflight raises TeleportError before anything is touched
+    """
+    previous = HEADLESS
+    configure_headless()
+    try:
+        return run_batch([load_plan(plan)],limits=limits,phase=phase,check=check)[0]
+    finally:
+        configure_headless(previous)
+
+def cutover_jobs(specs):
+    jobs = []
+    for spec in specs:
+        path = Journal.path_for(spec["instance_id"])
+        if not os.path.exists(path):
+            raise TeleportError(f"{spec['instance_id']} has no prestage journal, run --phase prestage first")
+        journal = Journal.load(path)
+        journal.data["spec"] = spec
+        jobs.append(new_job(spec,journal,"cutover"))
+    return jobs
+
+def resume_jobs():
+    """
+    jobs for every journal that didn't finish, grants the crashed run left behind are revoked first
+    """
+    jobs = []
+    for journal in Journal.all():
+        # A PRESTAGED INSTANCE WAITS FOR AN EXPLICIT CUTOVER, THAT'S WHERE THE DOWNTIME IS
+        if journal.data["status"] in ("teleported","prestaged","aborted"):
+            continue
+        revoke_journal_grants(journal)
+        if not journal.data.get("spec"):
+            if journal.data["status"] == "running":
+                log(f'{journal.data["instance_id"]} was interrupted before its destination was chosen, it can\'t be resumed')
+            continue
+        jobs.append(new_job(journal.data["spec"],journal,journal.data.get("phase","full")))
+    if not jobs:
+        raise TeleportError("Nothing to resume")
+    return jobs
+
+def parse_stage_limits(values):
+    limits = {}
+    for value in values or []:
+        name,_,count = value.partition("=")
+        if name not in STAGE_LIMITS or not count.isdigit():
+            raise TeleportError(f"invalid stage limit {value}, expected one of {', '.join(STAGE_LIMITS)} as stage=N")
+        limits[name] = int(count)
+    return limits
+
+def report_results(results,path=None):
+    for r in results:
+        downtime = f'{r["downtime"]}s' if r["downtime"] is not None else "-"
+        line = f'{r["instance_id"]:<20} {r["state"]:<11} {r["stage"]:<8} {r["new_instance_id"] or "-":<20} {r["duration"]}s  downtime {downtime}'
+        print(line + (f'  {r["error"]}' if r["error"] else ""))
+    ok = len([r for r in results if r["state"] != "failed"])
+    log(f"{ok}/{len(results)} instances succeeded")
+    downtimes = [r["downtime"] for r in results if r["downtime"] is not None]
+    if downtimes:
+        log(f"downtime max {max(downtimes)}s, mean {round(sum(downtimes) / len(downtimes),1)}s")
+    if path:
+        with open(path,'w') as f:
+            json.dump(results,f,indent=2)
+        log(f"Report written to {path}")
+
+PLAN_FLAGS = {"instance_id": "instance_id","src_region": "src_region","dst_region": "dst_region","subnet": "subnet","security_group": "security_group",
+              "instance_profile": "profile","kms": "kms","region_kms": "region_kms","instance_type": "instance_type","deploy_type": "deploy_type","host": "host","mode": "mode",
+              "fallback_subnets": "fallback_subnets","fallback_types": "fallback_types","staging_bucket": "staging_bucket"}
+
+IDENTITY_FLAGS = ("src_profile","dst_profile","src_role","dst_role","role_name","external_id")
+
+def identity_from_args(args):
+    return {key: getattr(args,key) for key in IDENTITY_FLAGS if getattr(args,key) is not None}
+
+def plan_from_args(args):
+    plan = read_document(args.plan) if args.plan else {}
+    plan.update({key: getattr(args,flag) for flag,key in PLAN_FLAGS.items() if getattr(args,flag) is not None})
+    return plan
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Teleport EC2 instances across regions and accounts")
+    parser.add_argument("--manifest",help="YAML/JSON manifest of instances to teleport in batch mode")
+    parser.add_argument("--phase",choices=sorted(PHASES),default="full",help="full teleport, or prestage while running then cutover with a short downtime")
+    parser.add_argument("--plan",help="YAML/JSON plan file to teleport one instance headless")
+    # PLAN KEYS AS FLAGS, THEY OVERRIDE THE PLAN FILE AND ARE ENOUGH ON THEIR OWN FOR A HEADLESS RUN
+    for flag,help in (("instance-id","instance to teleport"),("src-region",None),("dst-region",None),("subnet","destination subnet id"),("security-group","destination security group id"),
+                      ("instance-profile","destination instance profile name"),("kms","destination account KMS key"),("region-kms","source account KMS key in the destination region"),
+                      ("instance-type","defaults to the source instance type"),("deploy-type","on demand, dedicated instance or dedicated host"),("host","dedicated host id"),("mode","ami or snapshot"),
+                      ("fallback-subnets","comma separated subnets to try when the first one is out of capacity"),("fallback-types","comma separated instance types to try when out of capacity"),
+                      ("staging-bucket","S3 bucket to stage instance store disks through")):
+        parser.add_argument(f"--{flag}",help=help)
+    parser.add_argument("--preflight",action="store_true",help="only validate the manifest or plan and print the plan, change nothing")
+    parser.add_argument("--skip-preflight",action="store_true",help="start teleporting without the preflight checks")
+    # WHO TO BE ON EACH SIDE, FOR ANY MODE
+    for flag,help in (("src-profile","profile for the source side, or to assume --src-role from"),("dst-profile","profile for the destination side, or to assume --dst-role from"),
+                      ("src-role","role ARN or account id to assume on the source side"),("dst-role","role ARN or account id to assume on the destination side"),
+                      ("role-name",f"role assumed when a role is given as an account id, {DEFAULT_ROLE_NAME} by default"),("external-id","external id for the role assumptions")):
+        parser.add_argument(f"--{flag}",help=help)
+    parser.add_argument("--concurrency",type=int,help="max number of instances in flight at once in batch mode")
+    parser.add_argument("--stage-limit",action="append",metavar="STAGE=N",help="worker count for a pipeline stage, e.g. copy=30 (repeatable)")
+    parser.add_argument("--report",help="write the batch result report as JSON to this file")
+    parser.add_argument("--pool-size",type=int,default=CLIENT_POOL_SIZE,help="max HTTP connections per shared AWS client")
+    parser.add_argument("--no-governor",action="store_true",help="don't pace AWS calls, rely on botocore retries alone")
+    parser.add_argument("--refresh",action="store_true",help="ignore and rebuild the local discovery cache")
+    parser.add_argument("--invalidate",action="append",choices=sorted(DISCOVERY_TTLS),help="drop one kind of cached discovery data (repeatable)")
+    parser.add_argument("--no-cache",action="store_true",help="don't read or write the local discovery cache")
+    parser.add_argument("--journal-dir",default=JOURNAL_DIR,help="where teleport checkpoint journals are kept")
+    parser.add_argument("--resume",action="store_true",help="resume every teleport whose journal didn't finish")
+    parser.add_argument("--cleanup-grants",action="store_true",help="revoke KMS grants left behind by interrupted teleports")
+    parser.add_argument("--telemetry",help="append stage timings and an API call summary to this JSON lines file")
+    parser.add_argument("--prometheus",help="write run metrics to this prometheus textfile when the run ends")
+    parser.add_argument("--cleanup",action="store_true",help="delete TELEPORT-* AMIs and snapshots left in every region")
+    parser.add_argument("--dry-run",action="store_true",help="with --cleanup, only report what would be deleted")
+    parser.add_argument("--profiles",help="comma separated profiles to clean up with --cleanup, --src-role and --dst-role accounts are cleaned up too")
+    parser.add_argument("--regions",help="comma separated regions to clean up, all regions otherwise")
+    args = parser.parse_args(argv)
+    configure_clients(args.pool_size)
+    governor.configure(not args.no_governor)
+    configure_discovery_cache(not args.no_cache,args.refresh,args.invalidate)
+    configure_journal(args.journal_dir)
+    telemetry.configure(args.telemetry)
+    try:
+        if args.cleanup_grants:
+            return cleanup_grants()
+        if args.cleanup:
+            return run_cleanup(args.profiles.split(",") if args.profiles else None,args.regions.split(",") if args.regions else None,args.dry_run,identity_from_args(args))
+        limits = parse_stage_limits(args.stage_limit)
+        plan = plan_from_args(args)
+        identity = identity_from_args(args)
+        if args.preflight:
+            specs = load_manifest(args.manifest,identity) if args.manifest else [load_plan({**plan, **identity})]
+            if report_preflight(preflight(specs,args.phase)):
+                sys.exit(1)
+            return
+        if args.resume:
+            configure_headless()
+            results = run_jobs(resume_jobs(),args.concurrency,limits)
+        elif args.manifest:
+            configure_headless()
+            results = run_batch(load_manifest(args.manifest,identity),args.concurrency,limits,args.phase,not args.skip_preflight)
+        elif plan:
+            results = [teleport({**plan, **identity},args.phase,limits,not args.skip_preflight)]
+        else:
+            return teleport_interactive(identity)
+        report_results(results,args.report)
+        if any(r["state"] == "failed" for r in results):
+            sys.exit(1)
+    except TeleportError as e:
+        exit_with_error(str(e))
+    finally:
+        telemetry.finish(args.prometheus)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,569 @@
+"""
+unit tests for the teleporter's shared grant and rate limit state and its resume journal, every AWS client is a stub
+
+    pip install -r requirements.txt
+    python -m unittest test_ec2_teleporter
+"""
+import json
+import tempfile
+import threading
+import unittest
+from datetime import datetime,timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import ec2_teleporter as teleporter
+
+def fake_session(profile="src",region="us-east-1"):
+    return SimpleNamespace(profile_name=profile,region_name=region,teleport_identity=(profile,None,None))
+
+class FakeError(Exception):
+    def __init__(self,code,message=""):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code,"Message": message}}
+
+class FakeKMS:
+    def __init__(self,create_errors=(),revoke_errors=()):
+        self.created = []
+        self.revoked = []
+        self.create_errors = list(create_errors)
+        self.revoke_errors = list(revoke_errors)
+
+    def create_grant(self,KeyId,GranteePrincipal,Operations):
+        if self.create_errors:
+            error = self.create_errors.pop(0)
+            if error:
+                raise error
+        self.created.append(KeyId)
+        return {"GrantId": f"grant-{len(self.created)}"}
+
+    def revoke_grant(self,KeyId,GrantId):
+        if self.revoke_errors:
+            error = self.revoke_errors.pop(0)
+            if error:
+                raise error
+        self.revoked.append(GrantId)
+
+    def describe_key(self,KeyId):
+        return {"KeyMetadata": {"KeyManager": "CUSTOMER"}}
+
+class FakeEC2:
+    def __init__(self,keys):
+        self.keys = keys
+
+    def describe_instances(self,InstanceIds):
+        mappings = [{"DeviceName": f"/dev/sd{chr(ord('f') + i)}","Ebs": {"VolumeId": f"vol-{i}"}} for i in range(len(self.keys))]
+        return {"Reservations": [{"Instances": [{"InstanceId": InstanceIds[0],"BlockDeviceMappings": mappings}]}]}
+
+    def describe_volumes(self,VolumeIds):
+        return {"Volumes": [{"VolumeId": v,"KmsKeyId": key} for v,key in zip(VolumeIds,self.keys)]}
+
+    def describe_tags(self,Filters):
+        return {"Tags": []}
+
+def temp_journal(test):
+    journal_dir = tempfile.TemporaryDirectory()
+    test.addCleanup(journal_dir.cleanup)
+    teleporter.configure_journal(journal_dir.name)
+
+class StubbedKMSTest(unittest.TestCase):
+    def setUp(self):
+        self.kms = FakeKMS()
+        self.session = fake_session()
+        self.manager = teleporter.GrantManager()
+        patches = [
+            mock.patch.object(teleporter,"get_client",lambda session,service,region_name=None: self.kms),
+            mock.patch.object(teleporter,"log",lambda obj: None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+class GrantManagerTest(StubbedKMSTest):
+    def test_users_of_one_key_and_account_share_one_grant(self):
+        first = self.manager.acquire(self.session,"key-1","222233334444","i-1")
+        second = self.manager.acquire(self.session,"key-1","222233334444","i-2")
+        self.assertEqual(first,second)
+        self.assertEqual(self.kms.created,["key-1"])
+
+    def test_other_accounts_and_keys_get_their_own_grant(self):
+        self.manager.acquire(self.session,"key-1","222233334444","i-1")
+        self.manager.acquire(self.session,"key-1","555566667777","i-1")
+        self.manager.acquire(self.session,"key-2","222233334444","i-1")
+        self.assertEqual(len(self.kms.created),3)
+
+    def test_grant_is_revoked_once_by_its_last_user(self):
+        grant_id = self.manager.acquire(self.session,"key-1","222233334444","i-1")
+        self.manager.acquire(self.session,"key-1","222233334444","i-2")
+        self.assertEqual(self.manager.release("i-1"),{grant_id: True})
+        self.assertEqual(self.kms.revoked,[])
+        self.assertEqual(self.manager.release("i-2"),{grant_id: True})
+        self.assertEqual(self.kms.revoked,[grant_id])
+        self.assertEqual(self.manager.release("i-2"),{})
+        self.assertEqual(self.kms.revoked,[grant_id])
+
+    def test_failed_create_leaves_nothing_behind(self):
+        self.kms.create_errors = [FakeError("AccessDeniedException")]
+        with self.assertRaises(FakeError):
+            self.manager.acquire(self.session,"key-1","222233334444","i-1")
+        self.assertEqual(self.manager.grants,{})
+        self.assertEqual(self.manager.release("i-1"),{})
+        self.assertEqual(self.kms.revoked,[])
+        # THE NEXT USER CREATES THE GRANT AFRESH
+        self.manager.acquire(self.session,"key-1","222233334444","i-2")
+        self.assertEqual(self.kms.created,["key-1"])
+
+    def test_failed_revoke_is_reported(self):
+        grant_id = self.manager.acquire(self.session,"key-1","222233334444","i-1")
+        self.kms.revoke_errors = [FakeError("KMSInternalException")]
+        self.assertEqual(self.manager.release("i-1"),{grant_id: False})
+
+    def test_grant_already_gone_counts_as_revoked(self):
+        grant_id = self.manager.acquire(self.session,"key-1","222233334444","i-1")
+        self.kms.revoke_errors = [FakeError("NotFoundException")]
+        self.assertEqual(self.manager.release("i-1"),{grant_id: True})
+
+class JournalGrantsTest(StubbedKMSTest):
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(teleporter,"grant_manager",self.manager)
+        patch.start()
+        self.addCleanup(patch.stop)
+        temp_journal(self)
+
+    def journal(self,instance_id):
+        journal = teleporter.Journal.start(instance_id)
+        grant_id = self.manager.acquire(self.session,"key-1","222233334444",instance_id)
+        journal.add_grant(grant_id,"key-1",self.session)
+        return journal
+
+    def test_shared_grant_is_revoked_once_across_journals(self):
+        first,second = self.journal("i-1"),self.journal("i-2")
+        teleporter.revoke_journal_grants(first)
+        teleporter.revoke_journal_grants(second)
+        teleporter.revoke_journal_grants(second)
+        self.assertEqual(self.kms.revoked,["grant-1"])
+        self.assertTrue(first.data["grants"][0]["revoked"])
+        self.assertTrue(second.data["grants"][0]["revoked"])
+
+    def test_failed_revoke_is_retried_by_the_next_sweep(self):
+        journal = self.journal("i-1")
+        self.kms.revoke_errors = [FakeError("KMSInternalException")]
+        teleporter.revoke_journal_grants(journal)
+        self.assertFalse(journal.data["grants"][0]["revoked"])
+        # THE MANAGER LET GO OF IT, THE JOURNAL'S RECORD IS WHAT REVOKES IT NOW
+        with mock.patch.object(teleporter,"get_session",lambda *args: self.session):
+            teleporter.revoke_journal_grants(journal)
+        self.assertTrue(journal.data["grants"][0]["revoked"])
+        self.assertEqual(self.kms.revoked,["grant-1"])
+
+class OldestRunningTeleportTest(unittest.TestCase):
+    def setUp(self):
+        temp_journal(self)
+
+    def journal(self,instance_id,spec,started,updated=None):
+        journal = teleporter.Journal.start(instance_id,spec)
+        journal.data["started"] = started
+        journal.save()
+        if updated:
+            journal.data["updated"] = updated
+            with open(journal.path,"w") as f:
+                json.dump(journal.data,f)
+        return journal
+
+    def test_oldest_running_journal_with_a_spec_pins_the_window(self):
+        now = datetime.now()
+        self.journal("i-new",{"instance_id": "i-new"},now.isoformat())
+        self.journal("i-old",{"instance_id": "i-old"},(now - timedelta(hours=5)).isoformat())
+        self.journal("i-prompting",None,(now - timedelta(hours=9)).isoformat())
+        self.journal("i-done",{"instance_id": "i-done"},(now - timedelta(hours=9)).isoformat()).finish("failed")
+        self.assertEqual(teleporter.oldest_running_teleport().data["instance_id"],"i-old")
+
+    def test_stale_journal_doesnt_pin_the_window(self):
+        stale = (datetime.now() - timedelta(days=4)).isoformat()
+        self.journal("i-dead",{"instance_id": "i-dead"},stale,updated=stale)
+        self.assertIsNone(teleporter.oldest_running_teleport())
+
+SPEC = {**teleporter.MANIFEST_DEFAULTS,"instance_id": "i-1","src_region": "us-east-1","dst_region": "us-west-2","subnet": "subnet-1","security_group": "sg-1","profile": "app"}
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        temp_journal(self)
+        patch = mock.patch.object(teleporter,"log",lambda obj: None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_new_job_picks_up_the_checkpoint(self):
+        journal = teleporter.Journal.start("i-1",SPEC)
+        journal.record(original_ami="ami-1",ami="ami-2",mappings=[{"DeviceName": "/dev/sda1"}],new_instance_id="i-new")
+        for stage in ("prepare","stop","ami","copy"):
+            journal.complete(stage)
+        journal.finish("failed")
+        job = teleporter.new_job(SPEC,teleporter.Journal.load(journal.path))
+        self.assertEqual((job["original_ami"],job["ami"],job["mappings"]),("ami-1","ami-2",[{"DeviceName": "/dev/sda1"}]))
+        self.assertEqual(job["result"]["new_instance_id"],"i-new")
+        # prepare AND stop ONLY SET UP THE JOB, THEY RUN AGAIN
+        self.assertEqual(job["skip"],{"ami","copy"})
+        self.assertEqual(job["journal"].data["status"],"running")
+
+    def test_pipeline_passes_over_skipped_stages(self):
+        ran,finished = [],[]
+        stages = [(name,lambda job,name=name: ran.append(name)) for name in ("prepare","ami","copy","launch")]
+        pipeline = teleporter.Pipeline(stages,finish=lambda job,error: finished.append(error))
+        pipeline.submit({"result": {"instance_id": "i-1"},"skip": {"ami","copy"}})
+        pipeline.join()
+        self.assertEqual(ran,["prepare","launch"])
+        self.assertEqual(finished,[None])
+
+    def test_finished_job_finishes_its_journal(self):
+        for error,status in ((None,"teleported"),(RuntimeError("boom"),"failed")):
+            job = teleporter.new_job(SPEC)
+            job["started"] = teleporter.time.time()
+            teleporter.finish_job(job,error)
+            self.assertEqual(teleporter.Journal.load(job["journal"].path).data["status"],status)
+
+class FakeLaunchEC2:
+    def __init__(self):
+        self.tokens = []
+
+    def run_instances(self,**args):
+        self.tokens.append(args["ClientToken"])
+        return {"Instances": [{"InstanceId": f"i-{len(self.tokens)}"}]}
+
+class LaunchTokenTest(unittest.TestCase):
+    def setUp(self):
+        temp_journal(self)
+        self.ec2 = FakeLaunchEC2()
+        patches = [
+            mock.patch.object(teleporter,"get_client",lambda session,service,region_name=None: self.ec2),
+            mock.patch.object(teleporter,"launch_template",lambda *args,**kwargs: "TELEPORT-template"),
+            mock.patch.object(teleporter,"log",lambda obj: None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def launch(self,journal):
+        return teleporter.launch_instances(fake_session(),"ami-1",["m5.large"],[],[],["subnet-1"],"sg-1","app",None,"on demand",token=teleporter.launch_token(journal))
+
+    def test_relaunch_of_a_resumed_run_reuses_the_client_token(self):
+        journal = teleporter.Journal.start("i-1",SPEC)
+        self.launch(journal)
+        self.launch(teleporter.Journal.load(journal.path))
+        self.assertEqual(len(set(self.ec2.tokens)),1)
+
+    def test_new_run_gets_a_new_client_token(self):
+        first = teleporter.Journal.start("i-1",SPEC)
+        second = teleporter.Journal.start("i-1",SPEC)
+        second.data["started"] = "2100-01-01T00:00:00"
+        self.launch(first)
+        self.launch(second)
+        self.assertEqual(len(set(self.ec2.tokens)),2)
+
+class InteractiveJournalTest(StubbedKMSTest):
+    def setUp(self):
+        super().setUp()
+        temp_journal(self)
+        src,dst = fake_session(),fake_session("dst","us-west-2")
+        def describe_instance(session,dst_session,instance_id):
+            grant_id = self.manager.acquire(session,"key-1","222233334444",instance_id)
+            return {"InstanceId": instance_id,"InstanceType": "m5.large"},[(grant_id,"key-1",session)],["key-1"],True
+        patches = [
+            mock.patch.object(teleporter,"grant_manager",self.manager),
+            mock.patch.object(teleporter,"write_title",lambda title: None),
+            mock.patch.object(teleporter,"get_sessions",lambda identity=None: (src,src,dst,"us-east-1","us-west-2")),
+            mock.patch.object(teleporter,"get_account_ids",lambda sessions: ("111122223333","222233334444")),
+            mock.patch.object(teleporter,"inquire_instance_id",lambda: "i-1"),
+            mock.patch.object(teleporter,"describe_instance",describe_instance),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_failing(self,error):
+        with mock.patch.object(teleporter,"instance_store_disks",side_effect=error):
+            with self.assertRaises(type(error)):
+                teleporter.teleport_interactive()
+        return teleporter.Journal.load(teleporter.Journal.path_for("i-1"))
+
+    def test_failure_revokes_the_grants_and_fails_the_journal(self):
+        journal = self.run_failing(RuntimeError("boom"))
+        self.assertEqual(journal.data["status"],"failed")
+        self.assertEqual(self.kms.revoked,["grant-1"])
+        self.assertIsNone(teleporter.oldest_running_teleport())
+
+    def test_interrupt_aborts_the_journal(self):
+        journal = self.run_failing(KeyboardInterrupt())
+        self.assertEqual(journal.data["status"],"aborted")
+        self.assertEqual(self.kms.revoked,["grant-1"])
+
+class DescribeInstanceGrantsTest(StubbedKMSTest):
+    def setUp(self):
+        super().setUp()
+        self.ec2 = FakeEC2(["key-1","key-2"])
+        clients = {"kms": self.kms,"ec2": self.ec2}
+        patches = [
+            mock.patch.object(teleporter,"grant_manager",self.manager),
+            mock.patch.object(teleporter,"get_client",lambda session,service,region_name=None: clients[service]),
+            mock.patch.object(teleporter,"get_account_id",lambda session: "222233334444"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_grants_every_key_once(self):
+        _,grant_ids,keys,encrypted = teleporter.describe_instance(self.session,fake_session("dst","us-west-2"),"i-1")
+        self.assertEqual(keys,["key-1","key-2"])
+        self.assertTrue(encrypted)
+        self.assertEqual([g[0] for g in grant_ids],["grant-1","grant-2"])
+
+    def test_aws_error_on_a_later_key_releases_the_earlier_grants(self):
+        self.kms.create_errors = [None,FakeError("LimitExceededException")]
+        with self.assertRaises(FakeError):
+            teleporter.describe_instance(self.session,fake_session("dst","us-west-2"),"i-1")
+        self.assertEqual(self.kms.revoked,["grant-1"])
+        self.assertEqual(self.manager.grants,{})
+
+class FakeEvents:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self,event,handler):
+        self.handlers[event] = handler
+
+    register_first = register
+
+def fake_client(service="ec2",region="us-east-1"):
+    return SimpleNamespace(meta=SimpleNamespace(service_model=SimpleNamespace(service_name=service),region_name=region,events=FakeEvents()))
+
+def started(fn):
+    thread = threading.Thread(target=fn,daemon=True)
+    thread.start()
+    return thread
+
+class TokenBucketTest(unittest.TestCase):
+    def test_throttle_halves_the_limit_and_drains_the_bucket(self):
+        bucket = teleporter.TokenBucket(10,20,8)
+        bucket.throttled()
+        self.assertEqual(bucket.limit,4)
+        self.assertLessEqual(bucket.tokens,0)
+        for _ in range(5):
+            bucket.throttled()
+        self.assertEqual(bucket.limit,1)
+
+    def test_clean_calls_grow_the_limit_back_to_the_maximum(self):
+        bucket = teleporter.TokenBucket(10,20,8)
+        bucket.throttled()
+        bucket.throttled()
+        releases = 0
+        while bucket.limit < 8:
+            bucket.active += 1
+            bucket.release(clean=True)
+            releases += 1
+        # ADDITIVE, ONE WHOLE SLOT PER limit CLEAN CALLS
+        self.assertGreater(releases,6)
+        bucket.active += 1
+        bucket.release(clean=True)
+        self.assertEqual(bucket.limit,8)
+        self.assertEqual(bucket.active,0)
+
+    def test_unclean_release_frees_the_slot_without_growing(self):
+        bucket = teleporter.TokenBucket(10,20,8)
+        bucket.throttled()
+        bucket.acquire()
+        bucket.release(clean=False)
+        self.assertEqual(bucket.limit,4)
+        self.assertEqual(bucket.active,0)
+
+    def test_acquire_waits_for_a_released_slot(self):
+        bucket = teleporter.TokenBucket(1000,1000,1)
+        bucket.acquire()
+        waiter = started(bucket.acquire)
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        bucket.release(clean=True)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(bucket.active,1)
+
+    def test_retry_takes_a_token_but_no_slot(self):
+        bucket = teleporter.TokenBucket(10,2,1)
+        bucket.acquire()
+        bucket.acquire(slot=False)
+        self.assertEqual(bucket.active,1)
+        self.assertLess(bucket.tokens,1)
+
+class QuotaTest(unittest.TestCase):
+    def test_exceeded_shrinks_below_what_is_running_and_success_grows_back(self):
+        quota = teleporter.Quota(5)
+        for _ in range(3):
+            quota.acquire()
+        quota.exceeded()
+        self.assertEqual(quota.limit,2)
+        for _ in range(5):
+            quota.succeeded()
+        self.assertEqual(quota.limit,5)
+
+    def test_exceeded_keeps_one_slot(self):
+        quota = teleporter.Quota(5)
+        quota.exceeded()
+        self.assertEqual(quota.limit,1)
+
+    def test_acquire_waits_until_a_slot_is_released(self):
+        quota = teleporter.Quota(1)
+        quota.acquire()
+        waiter = started(quota.acquire)
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        quota.release()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+
+class GovernorTest(unittest.TestCase):
+    def setUp(self):
+        self.governor = teleporter.Governor()
+        self.client = fake_client()
+        self.governor.instrument(self.client,"111122223333")
+        self.handlers = self.client.meta.events.handlers
+
+    def call(self,operation,parsed=None,throttled=False,error=False):
+        model = SimpleNamespace(name=operation)
+        context = {}
+        self.handlers["before-call"](model=model,context=context)
+        if throttled:
+            self.handlers["needs-retry"](response=(None,{"Error": {"Code": "RequestLimitExceeded"}}),request_dict={"context": context})
+        if error:
+            self.handlers["after-call-error"](context=context)
+        else:
+            self.handlers["after-call"](model=model,context=context,parsed=parsed or {})
+        return self.governor.bucket("111122223333","us-east-1","ec2",operation)
+
+    def test_clean_call_releases_its_slot(self):
+        bucket = self.call("DescribeInstances")
+        self.assertEqual(bucket.active,0)
+        self.assertEqual(bucket.limit,bucket.max_limit)
+
+    def test_throttled_call_halves_its_bucket(self):
+        bucket = self.call("DescribeInstances",throttled=True)
+        self.assertEqual(bucket.active,0)
+        self.assertEqual(bucket.limit,bucket.max_limit / 2)
+
+    def test_failed_call_releases_its_slot(self):
+        bucket = self.call("RunInstances",error=True)
+        self.assertEqual(bucket.active,0)
+        for _ in range(bucket.max_limit * 2):
+            bucket = self.call("RunInstances",error=True)
+        self.assertEqual(bucket.active,0)
+
+    def test_every_retry_waits_for_a_token(self):
+        context = {}
+        self.handlers["before-call"](model=SimpleNamespace(name="DescribeImages"),context=context)
+        bucket = context["governor_bucket"]
+        tokens = bucket.tokens
+        self.handlers["request-created"](request=SimpleNamespace(context=context))
+        self.assertAlmostEqual(bucket.tokens,tokens,places=2)
+        context["retries"] = {"attempt": 2}
+        self.handlers["request-created"](request=SimpleNamespace(context=context))
+        self.assertAlmostEqual(bucket.tokens,tokens - 1,places=2)
+        self.assertEqual(bucket.active,1)
+
+    def test_api_classes_have_their_own_buckets(self):
+        describe = self.governor.bucket("111122223333","us-east-1","ec2","DescribeImages")
+        self.assertIs(describe,self.governor.bucket("111122223333","us-east-1","ec2","DescribeInstances"))
+        self.assertIsNot(describe,self.governor.bucket("111122223333","us-east-1","ec2","CopyImage"))
+        self.assertIsNot(describe,self.governor.bucket("111122223333","us-west-2","ec2","DescribeImages"))
+
+    def test_full_copy_quota_shrinks_the_quota(self):
+        quota = self.governor.quota("111122223333","us-east-1","CopyImage")
+        quota.acquire()
+        quota.acquire()
+        self.call("CopyImage",parsed={"Error": {"Code": "ResourceLimitExceeded"}})
+        self.assertEqual(quota.limit,1)
+        self.call("CopyImage")
+        self.assertEqual(quota.limit,2)
+
+    def test_slot_is_released_when_the_work_fails(self):
+        session = fake_session()
+        with self.assertRaises(RuntimeError):
+            with self.governor.slot(session,"us-east-1","CopySnapshot"):
+                raise RuntimeError("copy failed")
+        self.assertEqual(self.governor.quota("src","us-east-1","CopySnapshot").active,0)
+
+    def test_disabled_governor_takes_no_slots(self):
+        self.governor.configure(False)
+        context = {}
+        self.handlers["before-call"](model=SimpleNamespace(name="DescribeInstances"),context=context)
+        self.assertNotIn("governor_bucket",context)
+        self.assertEqual(self.governor.buckets,{})
+
+class TelemetryTest(unittest.TestCase):
+    def setUp(self):
+        self.telemetry = teleporter.Telemetry()
+        self.client = fake_client()
+        self.telemetry.instrument(self.client)
+        self.handlers = self.client.meta.events.handlers
+
+    def test_every_throttled_attempt_counts(self):
+        model = SimpleNamespace(name="DescribeImages")
+        context = {}
+        self.handlers["before-call"](model=model,context=context)
+        for code in ("RequestLimitExceeded","Throttling",None):
+            self.handlers["needs-retry"](response=(None,{"Error": {"Code": code}} if code else {}),request_dict={"context": context})
+        self.handlers["after-call"](model=model,context=context,parsed={"ResponseMetadata": {"RetryAttempts": 2}})
+        self.assertEqual(self.telemetry.api[("ec2","DescribeImages")],{"calls": 1,"seconds": mock.ANY,"retries": 2,"throttles": 2,"errors": 0})
+
+    def test_call_without_a_response_is_an_error(self):
+        context = {}
+        self.handlers["before-call"](model=SimpleNamespace(name="CopyImage"),context=context)
+        self.handlers["needs-retry"](response=None,request_dict={"context": context})
+        context["retries"] = {"attempt": 3}
+        self.handlers["after-call-error"](context=context,exception=ConnectionError("reset"))
+        totals = self.telemetry.api[("ec2","CopyImage")]
+        self.assertEqual((totals["calls"],totals["retries"],totals["errors"]),(1,2,1))
+
+class TaggingRefusedTest(unittest.TestCase):
+    def test_only_refusals_that_name_the_tags_fall_back(self):
+        refused = teleporter.tagging_refused
+        self.assertTrue(refused(FakeError("UnauthorizedOperation","User: arn:aws:iam::1:user/x is not authorized to perform: ec2:CreateTags on resource")))
+        self.assertTrue(refused(FakeError("InvalidParameterValue","Tag value exceeds the maximum length")))
+        self.assertTrue(refused(FakeError("TagPolicyViolation")))
+        self.assertFalse(refused(FakeError("UnauthorizedOperation","User: arn:aws:iam::1:user/x is not authorized to perform: ec2:RunInstances")))
+        self.assertFalse(refused(FakeError("InvalidParameterValue","Value (m5.huge) for parameter instanceType is invalid")))
+        self.assertFalse(refused(FakeError("InsufficientInstanceCapacity","We currently do not have sufficient capacity for tagged launches")))
+
+class IdentityTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.dict(teleporter._sessions,clear=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_external_ids_are_separate_identities(self):
+        role = teleporter.role_arn("012345678901")
+        first = teleporter.get_session("hub","us-east-1",role,"one")
+        second = teleporter.get_session("hub","us-east-1",role,"two")
+        self.assertNotEqual(teleporter.session_key(first),teleporter.session_key(second))
+        self.assertIs(first,teleporter.get_session("hub","us-east-1",role,"one"))
+
+    def test_role_account_ids_must_be_strings(self):
+        plan = {"instance_id": "i-1","src_region": "us-east-1","dst_region": "us-west-2","subnet": "subnet-1","security_group": "sg-1","profile": "app"}
+        self.assertEqual(teleporter.load_plan({**plan,"src_role": "012345678901"})["src_role"],"012345678901")
+        with self.assertRaises(teleporter.TeleportError):
+            teleporter.load_plan({**plan,"src_role": 12345678901})
+        with self.assertRaises(teleporter.TeleportError):
+            teleporter.load_plan({**plan,"targets": [{"dst_role": 12345678901}]})
+
+class HeadlessTest(unittest.TestCase):
+    def test_teleport_restores_the_previous_mode(self):
+        with mock.patch.object(teleporter,"load_plan",side_effect=teleporter.TeleportError("bad plan")):
+            with self.assertRaises(teleporter.TeleportError):
+                teleporter.teleport({})
+        self.assertFalse(teleporter.HEADLESS)
+
+    def test_headless_vpc_prompt_raises_instead_of_exiting(self):
+        self.addCleanup(teleporter.configure_headless,False)
+        teleporter.configure_headless()
+        with self.assertRaises(teleporter.TeleportError):
+            teleporter.inquire_vpc([{"VpcId": "vpc-1","Tags": [{"Key": "Name","Value": "main"}]}])
+
+if __name__ == "__main__":
+    unittest.main()